@@ -0,0 +1,84 @@
+'''
+Accounts Module
+
+This module defines where the files of each mailbox the application forecasts
+are kept. Every account has a directory under the accounts directory holding
+its stored user credentials, its data (message store, sync cursor and training
+data) and its models. The default account is the single mailbox the
+application was first written for, whose files stay where they always were.
+
+Author: Daryle J. Serrant
+'''
+
+import os
+import re
+
+ACCOUNTS_DIR = '../accounts'
+
+# Account names appear in URLs and file paths, so they are limited to the
+# characters of an email address and may not start with a dot
+ACCOUNT_NAME = re.compile(r'^[A-Za-z0-9_][A-Za-z0-9_.@+-]*$')
+
+# Names taken by the dashboard routes of the default account
+RESERVED_NAMES = set(['api', 'static', 'index', 'cache_stats',
+                      'wkly_plt.png', 'hrly_plt.png'])
+
+
+def is_account_name(name):
+    '''
+    Returns True if name is a valid account name
+    '''
+    return ACCOUNT_NAME.match(name) is not None and name not in RESERVED_NAMES
+
+
+class Account(object):
+    '''
+    The locations of the files of one mailbox
+    '''
+
+    def __init__(self, name=None, accounts_dir=ACCOUNTS_DIR):
+        '''
+        Instantiate a new instance of the Account class
+
+        Arguments:
+          name - The name of the account, i.e. the mailbox address. The default
+                 account if None.
+          accounts_dir - The directory holding the account directories
+        '''
+        if name is None:
+            self.credentials = 'storage.json'
+            self.data_dir = '../data'
+            self.models_dir = '../models'
+        else:
+            if not is_account_name(name):
+                raise ValueError('Invalid account name: {}'.format(name))
+            root = os.path.join(accounts_dir, name)
+            self.credentials = os.path.join(root, 'storage.json')
+            self.data_dir = os.path.join(root, 'data')
+            self.models_dir = os.path.join(root, 'models')
+
+        self.name = name
+        self.message_store = os.path.join(self.data_dir, 'messages.db')
+        self.sync_cursor = os.path.join(self.data_dir, 'sync_cursor.txt')
+
+    def create(self):
+        '''
+        Creates the data and models directories of the account
+        '''
+        for directory in [self.data_dir, self.models_dir]:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+    def __repr__(self):
+        return 'Account({!r})'.format(self.name)
+
+
+def list_accounts(accounts_dir=ACCOUNTS_DIR):
+    '''
+    Returns the names of the accounts in the accounts directory
+    '''
+    if not os.path.isdir(accounts_dir):
+        return []
+    return sorted(name for name in os.listdir(accounts_dir)
+                  if is_account_name(name) and
+                  os.path.isdir(os.path.join(accounts_dir, name)))
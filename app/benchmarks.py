@@ -0,0 +1,482 @@
+'''
+Benchmarks Script
+
+This script times the performance sensitive parts of the forecasting pipeline
+on synthetic data so that optimizations can be checked without a Gmail account.
+Run a single benchmark with "python benchmarks.py <name>" or all of them with
+"python benchmarks.py".
+
+Author: Daryle J. Serrant
+'''
+
+from __future__ import division
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+from multiprocessing import cpu_count
+import numpy as np
+import pandas as pd
+from pytz import timezone
+from scipy.optimize import fmin_l_bfgs_b
+from httplib2 import Http
+import holtwinters as hw
+import gmail_data_processing as gdp
+import gmail_data_collection as gdc
+import gmail_data_modeling as gdm
+import timeseries_store as tss
+from gmail_stub_server import StubGmailServer, StubMailbox
+
+HOURLY_PERIOD = 24
+
+
+def synthetic_hourly_counts(n, seed=0):
+    '''
+    Creates a synthetic hourly email count series with a daily season
+
+    Arguments:
+        n - The number of hours in the series
+        seed - Random seed
+
+    Returns:
+        A list of integer counts
+    '''
+    rng = np.random.RandomState(seed)
+    hours = np.arange(n)
+    level = 4 + 3 * np.sin(2 * np.pi * hours / HOURLY_PERIOD)
+    return (level.clip(0) + rng.poisson(2, n)).astype(int).tolist()
+
+
+def time_call(func, *args, **kwargs):
+    '''
+    Returns the best wall time (in seconds) of several calls to func
+    '''
+    repeat = kwargs.pop('repeat', 3)
+    best = np.inf
+    for _ in range(repeat):
+        start = time.time()
+        func(*args)
+        best = min(best, time.time() - start)
+    return best
+
+
+def legacy_additive_rmse(params, Y, m):
+    '''
+    The list based additive RMSE recursion that holtwinters.RMSE used before the
+    smoothing kernels were introduced. Kept here as the benchmark baseline.
+    '''
+    alpha, beta, gamma = params
+    a = [sum(Y[0:m]) / float(m)]
+    b = [(sum(Y[m:2 * m]) - sum(Y[0:m])) / m ** 2]
+    s = [Y[i] - a[0] for i in range(m)]
+    y = [a[0] + b[0] + s[0]]
+
+    for i in range(len(Y)):
+        a.append(alpha * (Y[i] - s[i]) + (1 - alpha) * (a[i] + b[i]))
+        b.append(beta * (a[i + 1] - a[i]) + (1 - beta) * b[i])
+        s.append(gamma * (Y[i] - a[i] - b[i]) + (1 - gamma) * s[i])
+        y.append(a[i + 1] + b[i + 1] + s[i + 1])
+
+    return np.sqrt(sum([(u - v) ** 2 for u, v in zip(Y, y[:-1])]) / len(Y))
+
+
+def bench_holtwinters(sizes=(1000, 10000, 100000)):
+    '''
+    Compares the additive RMSE objective evaluated by the smoothing kernel against
+    the legacy list based recursion.
+    '''
+    params = np.array([0.3, 0.1, 0.1])
+    print 'holtwinters additive RMSE (numba: {})'.format(hw.njit is not None)
+
+    for n in sizes:
+        Y = synthetic_hourly_counts(n)
+        buf = hw._buffer(Y)
+        # Warm up (compiles the kernel when numba is installed)
+        hw.RMSE(params, buf, 'additive', HOURLY_PERIOD)
+
+        legacy = time_call(legacy_additive_rmse, params, Y, HOURLY_PERIOD)
+        kernel = time_call(hw.RMSE, params, buf, 'additive', HOURLY_PERIOD)
+        print '  n={:>7}: legacy {:.4f}s  kernel {:.4f}s  speedup {:.1f}x'.format(
+            n, legacy, kernel, legacy / kernel)
+
+
+def bench_holtwinters_fit(n=4400):
+    '''
+    Compares fitting the additive model (as build_hourly_holt_winters_model does on
+    six months of hourly data) with finite difference and analytic gradients, and
+    checks the analytic gradient against central differences.
+    '''
+    Y = hw._buffer(synthetic_hourly_counts(n))
+    args = (Y, 'additive', HOURLY_PERIOD)
+    x0 = np.array([0.3, 0.1, 0.1])
+    bounds = [(0, 1), (0, 1), (0, 1)]
+    print 'holtwinters additive fit, n={} (numba: {})'.format(n, hw.njit is not None)
+
+    rmse, gradient = hw.RMSE_gradient(x0, *args)
+    h = 1e-6
+    central = [(hw.RMSE(x0 + step, *args) - hw.RMSE(x0 - step, *args)) / (2 * h)
+               for step in np.eye(len(x0)) * h]
+    print '  gradient check: max abs error {:.2e}'.format(
+        np.abs(gradient - central).max())
+
+    start = time.time()
+    approx = fmin_l_bfgs_b(hw.RMSE, x0=x0, args=args, bounds=bounds,
+                           approx_grad=True)
+    approx_time = time.time() - start
+
+    start = time.time()
+    exact = fmin_l_bfgs_b(hw.RMSE_gradient, x0=x0, args=args, bounds=bounds)
+    exact_time = time.time() - start
+
+    for name, result, elapsed in [('approx_grad', approx, approx_time),
+                                  ('analytic', exact, exact_time)]:
+        print '  {:<11}: {:.4f}s  {:>3} evaluations  rmse {:.6f}'.format(
+            name, elapsed, result[2]['funcalls'], result[1])
+
+
+def synthetic_messages_frame(n, days=730, seed=0):
+    '''
+    Creates a dataframe with the columns messages_to_dataframe produces for
+    counting (msg_id, date and its components) for n messages spread over a
+    number of days, with timestamps in US/Pacific.
+    '''
+    rng = np.random.RandomState(seed)
+    end = 1477958400000  # 2016-11-01 UTC, so the range crosses DST changes
+    ms = np.sort(rng.randint(end - days * 86400000, end, n).astype(np.int64))
+    dates = pd.to_datetime(ms, unit='ms', utc=True).tz_convert('US/Pacific')
+    return pd.DataFrame({'msg_id': ['%x' % v for v in ms], 'date': dates,
+                         'year': dates.year, 'month': dates.month,
+                         'day': dates.day, 'hour': dates.hour})
+
+
+def legacy_aggregate_hourly(df):
+    '''
+    The row by row aggregate_hourly implementation, kept as the benchmark
+    baseline.
+    '''
+    hourly_agg = df[['year', 'month', 'day', 'hour', 'msg_id']
+                    ].groupby(['year', 'month', 'day', 'hour']).count()
+    hourly_index = pd.date_range(df['date'].min().floor('H'), df['date'].max().replace(hour=23, minute=0, second=0, microsecond=0),
+                                 freq='H', tz=timezone('US/Pacific'))
+    hourly_counts = pd.Series(0, index=hourly_index)
+    for dt in hourly_index:
+        try:
+            hourly_counts[dt] = hourly_agg.ix[
+                dt.year, dt.month, dt.day, dt.hour]
+        except:
+            hourly_counts[dt] = 0
+    return hourly_counts
+
+
+def legacy_aggregate_daily(df):
+    '''
+    The row by row aggregate_daily implementation, kept as the benchmark
+    baseline.
+    '''
+    daily_agg = df[['year', 'month', 'day', 'msg_id']
+                   ].groupby(['year', 'month', 'day']).count()
+    daily_index = pd.date_range(df['date'].min(), df['date'].max(
+    ), freq='D', normalize=True, tz=timezone('US/Pacific'))
+    daily_counts = pd.Series(0, index=daily_index)
+    for dt in daily_index:
+        try:
+            daily_counts[dt] = daily_agg.ix[dt.year, dt.month, dt.day]
+        except:
+            daily_counts[dt] = 0
+    return daily_counts
+
+
+def bench_holtwinters_batch(series=1000, n=4400, sample=200):
+    '''
+    Compares fitting additive models to many series (e.g. one per label or per
+    mailbox) one at a time with fitting them together in the batched engine.
+    The one at a time rate is measured on a sample of the series.
+    '''
+    X = np.array([synthetic_hourly_counts(n, seed) for seed in range(series)],
+                 dtype=float)
+    print 'holtwinters batch fit, {} series of n={} (numba: {})'.format(
+        series, n, hw.njit is not None)
+    # Warm up (compiles the kernels when numba is installed)
+    hw.additive_batch(X[:2], HOURLY_PERIOD, 24)
+    hw.additive(X[0], HOURLY_PERIOD, 24)
+
+    start = time.time()
+    single = [hw.additive(x, HOURLY_PERIOD, 24) for x in X[:sample]]
+    single_rate = len(single) / (time.time() - start)
+
+    start = time.time()
+    out, alpha, beta, gamma, rmse = hw.additive_batch(X, HOURLY_PERIOD, 24)
+    batch_rate = series / (time.time() - start)
+
+    single_rmse = np.array([r[4] for r in single])
+    params = np.array([r[1:4] for r in single])
+    batch_params = np.column_stack([alpha, beta, gamma])[:len(single)]
+    print '  one at a time: {:>7.1f} series/s'.format(single_rate)
+    print '  batched      : {:>7.1f} series/s  speedup {:.1f}x'.format(
+        batch_rate, batch_rate / single_rate)
+    # Parameters can differ where the RMSE is flat in them (e.g. beta when alpha
+    # is near 0), so the RMSE is what is compared
+    param_diff = np.abs(batch_params - params).max(axis=1)
+    print '  rmse vs one at a time: max {:+.2e}  mean {:+.2e}'.format(
+        (rmse[:len(single)] - single_rmse).max(),
+        (rmse[:len(single)] - single_rmse).mean())
+    print '  params vs one at a time: median diff {:.1e}, {} of {} differ by > 0.01'.format(
+        np.median(param_diff), (param_diff > 0.01).sum(), len(single))
+
+
+def bench_aggregate(sizes=(10000, 100000, 1000000)):
+    '''
+    Compares the vectorized hourly and daily aggregation against the row by
+    row implementations over two years of messages, and checks that both
+    produce the same series.
+    '''
+    print 'aggregate_hourly / aggregate_daily over two years'
+    for n in sizes:
+        df = synthetic_messages_frame(n)
+        for name, legacy, current in [
+                ('hourly', legacy_aggregate_hourly, gdp.aggregate_hourly),
+                ('daily', legacy_aggregate_daily, gdp.aggregate_daily)]:
+            same = legacy(df).equals(current(df))
+            legacy_time = time_call(legacy, df, repeat=1)
+            current_time = time_call(current, df)
+            print '  n={:>8} {:<6}: legacy {:.3f}s  vectorized {:.4f}s  speedup {:.0f}x  same output: {}'.format(
+                n, name, legacy_time, current_time, legacy_time / current_time, same)
+
+
+def bench_collection(n=5000):
+    '''
+    Fetches every message of a stub mailbox with request_messages, comparing the
+    full message format with the minimal format and fields mask that
+    collect_messages uses, by bytes received, time and messages per second.
+    '''
+    server = StubGmailServer(StubMailbox(messages=n)).start()
+    service = server.create_service()
+    ids = gdc.request_message_ids(service)
+    print 'request_messages for {} stub messages'.format(len(ids))
+
+    for name, format, fields in [('full', 'full', None),
+                                 ('minimal+fields', gdc.MESSAGE_FORMAT,
+                                  gdc.MESSAGE_FIELDS)]:
+        server.reset_counters()
+        start = time.time()
+        messages = gdc.request_messages(service, ids, gdp.project_message, format, fields,
+                                        http_factory=Http, limiter=gdc.TokenBucket(1e9))
+        elapsed = time.time() - start
+        received = len([m for m in messages if type(m) == tuple])
+        print '  {:<14}: {:>6.1f} MB  {:.2f}s  {:>6.0f} messages/s  ({} messages)'.format(
+            name, server.bytes_sent / 1e6, elapsed, received / elapsed, received)
+    server.stop()
+
+
+def bench_batch_concurrency(n=3000, error_rate=0.05, latency=0.1):
+    '''
+    Fetches every message of a stub mailbox that answers each batch request
+    after a delay and fails a fraction of the calls with 429 errors, running
+    the batch requests on an increasing number of threads.
+    '''
+    server = StubGmailServer(StubMailbox(messages=n), error_rate=error_rate,
+                             latency=latency).start()
+    service = server.create_service()
+    ids = gdc.request_message_ids(service)
+    backoff_base, gdc.BACKOFF_BASE = gdc.BACKOFF_BASE, 0.05
+    print 'request_messages for {} stub messages, {:.0%} errors, {:.0f}ms latency'.format(
+        len(ids), error_rate, latency * 1000)
+
+    for workers in (1, 2, 4, 8):
+        stats = {}
+        gdc.request_messages(service, ids, gdp.project_message, gdc.MESSAGE_FORMAT,
+                             gdc.MESSAGE_FIELDS, http_factory=Http, workers=workers,
+                             limiter=gdc.TokenBucket(1e9), stats=stats)
+        print '  {} threads: {:.2f}s  {:>6.0f} messages/s  {} retries  {} failed'.format(
+            workers, stats['seconds'], stats['received'] / stats['seconds'],
+            stats['retries'], stats['failed'])
+    gdc.BACKOFF_BASE = backoff_base
+    server.stop()
+
+
+def legacy_request_message_ids(service, date_range):
+    '''
+    The page by page request_message_ids implementation, kept as the benchmark
+    baseline.
+    '''
+    query = 'before:{} and after:{}'.format(date_range[0].strftime('%Y/%m/%d'),
+                                            date_range[1].strftime('%Y/%m/%d'))
+    response = service.users().messages().list(userId='me', q=query).execute()
+    messages = response.get('messages', [])
+    while 'nextPageToken' in response:
+        response = service.users().messages().list(
+            userId='me', q=query, pageToken=response['nextPageToken']).execute()
+        messages.extend(response['messages'])
+    return messages
+
+
+def bench_listing(n=50000, latency=0.05):
+    '''
+    Lists the ids of two years of messages in a stub mailbox that answers each
+    request after a delay, page by page and in concurrently listed shards.
+    '''
+    server = StubGmailServer(StubMailbox(messages=n, start=datetime(2015, 1, 1),
+                                         end=datetime(2017, 1, 1)), latency=latency).start()
+    service = server.create_service()
+    tz = timezone('US/Pacific')
+    date_range = (tz.localize(datetime(2017, 1, 2)), tz.localize(datetime(2014, 12, 31)))
+    print 'request_message_ids for two years, {} messages, {:.0f}ms latency'.format(
+        n, latency * 1000)
+
+    start = time.time()
+    legacy = legacy_request_message_ids(service, date_range)
+    legacy_time = time.time() - start
+    print '  page by page: {:.2f}s  {} ids'.format(legacy_time, len(legacy))
+
+    for workers in (1, 4, 8):
+        server.reset_counters()
+        start = time.time()
+        sharded = gdc.request_message_ids(service, date_range, http_factory=Http,
+                                          workers=workers)
+        elapsed = time.time() - start
+        print '  sharded, {} threads: {:.2f}s  {} requests  speedup {:.1f}x  same ids: {}'.format(
+            workers, elapsed, server.responses, legacy_time / elapsed,
+            [m['id'] for m in sharded] == [m['id'] for m in legacy])
+    server.stop()
+
+
+def bench_timeseries_store(years=(2, 5, 10)):
+    '''
+    Compares a nightly load and save of the hourly training data kept as one
+    pickled series against the month partitioned time series store, for growing
+    lengths of history.
+    '''
+    data_dir = tempfile.mkdtemp()
+    print 'nightly hourly training data load and save (format: {})'.format(
+        tss.TimeSeriesStore('hourly_ts', data_dir).extension)
+
+    for n in years:
+        end = pd.Timestamp('2016-11-01', tz='US/Pacific')
+        index = pd.date_range(end - pd.DateOffset(years=n), end, freq='H')
+        ts = pd.Series(synthetic_hourly_counts(len(index)), index=index)
+        filepath = os.path.join(data_dir, 'hourly_ts.pkl')
+        ts.to_pickle(filepath)
+        store = tss.TimeSeriesStore('hourly_ts_{}'.format(n), data_dir)
+        store.save(ts)
+        since = end - pd.DateOffset(days=1)
+        start = end - pd.DateOffset(months=6)
+
+        def legacy():
+            loaded = pd.read_pickle(filepath)
+            loaded = loaded[loaded.index > start]
+            ts.to_pickle(filepath)
+
+        def partitioned():
+            store.load(start=start)
+            store.save(ts, since)
+
+        legacy_bytes = os.path.getsize(filepath)
+        store_bytes = sum(os.path.getsize(f) for m, f in store.months().items()
+                          if m >= since.strftime('%Y-%m'))
+        print '  {:>2} years: pickle {:.4f}s  {:>8} bytes written   store {:.4f}s  {:>6} bytes written'.format(
+            n, time_call(legacy), legacy_bytes, time_call(partitioned), store_bytes)
+    shutil.rmtree(data_dir)
+
+
+def bench_grid_search(n=730):
+    '''
+    Times a small weekly SARIMA grid search on two years of synthetic daily
+    counts, run serially as before and on pools of worker processes.
+    '''
+    rng = np.random.RandomState(0)
+    days = np.arange(n)
+    counts = 40 + 10 * np.sin(2 * np.pi * days / gdm.WEEKLY_PERIOD) + rng.poisson(5, n)
+    ts = pd.Series(counts, index=pd.date_range('2014-11-01', periods=n, freq='D'))
+    params = {'p': [0, 1, 2], 'd': [1], 'q': [0, 1, 2], 'P': [0, 1], 'D': [1], 'Q': [0, 1]}
+    candidates = gdm.grid_search_candidates(params)
+    print 'SARIMA grid search, {} candidates, {} cores'.format(len(candidates), cpu_count())
+
+    start = time.time()
+    serial = min((gdm.fit_grid_candidate(ts, pm, gdm.WEEKLY_PERIOD) for pm in candidates),
+                 key=lambda r: r['aic'])
+    serial_time = time.time() - start
+    print '  serial     : {:.2f}s  best {}'.format(serial_time, serial['params'])
+
+    for processes in sorted(set([1, 2, cpu_count()])):
+        start = time.time()
+        best = min(gdm.iter_grid_search_arima(ts, params, gdm.WEEKLY_PERIOD, processes),
+                   key=lambda r: r['aic'])
+        elapsed = time.time() - start
+        print '  {} processes: {:.2f}s  speedup {:.1f}x  same best: {}'.format(
+            processes, elapsed, serial_time / elapsed, best['params'] == serial['params'])
+
+
+def bench_model_selection(n=730):
+    '''
+    Compares the exhaustive weekly SARIMA grid search with successive halving on
+    two years of synthetic daily counts, both run on one process.
+    '''
+    rng = np.random.RandomState(0)
+    days = np.arange(n)
+    counts = 40 + 10 * np.sin(2 * np.pi * days / gdm.WEEKLY_PERIOD) + rng.poisson(5, n)
+    ts = pd.Series(counts, index=pd.date_range('2014-11-01', periods=n, freq='D'))
+    params = {'p': [0, 1, 2], 'd': [1], 'q': [0, 1, 2], 'P': [0, 1], 'D': [1], 'Q': [0, 1]}
+    print 'SARIMA model selection, {} candidates'.format(
+        len(gdm.grid_search_candidates(params)))
+
+    start = time.time()
+    exhaustive = min(gdm.iter_grid_search_arima(ts, params, gdm.WEEKLY_PERIOD, 1),
+                     key=lambda r: r['aic'])
+    exhaustive_time = time.time() - start
+    print '  exhaustive        : {:.2f}s  aic {:.2f}  best {}'.format(
+        exhaustive_time, exhaustive['aic'], exhaustive['params'])
+
+    start = time.time()
+    halving = gdm.successive_halving_arima(ts, params, gdm.WEEKLY_PERIOD, processes=1)
+    halving_time = time.time() - start
+    print '  successive halving: {:.2f}s  aic {:.2f}  best {}'.format(
+        halving_time, halving['aic'], halving['params'])
+    print '  speedup {:.1f}x, aic gap {:.2f}'.format(
+        exhaustive_time / halving_time, halving['aic'] - exhaustive['aic'])
+
+
+def bench_weekly_refit(n=730):
+    '''
+    Compares the nightly weekly model refit from scratch with one warm started from
+    the previous night's parameters and with keeping those parameters, on two years
+    of synthetic daily counts.
+    '''
+    rng = np.random.RandomState(0)
+    days = np.arange(n)
+    counts = 40 + 10 * np.sin(2 * np.pi * days / gdm.WEEKLY_PERIOD) + rng.poisson(5, n)
+    ts = pd.Series(counts, index=pd.date_range('2014-11-01', periods=n, freq='D'))
+    previous = gdm.build_weekly_arima_model(ts[:-1])
+    print 'Weekly SARIMA refit after one new day of {}'.format(n)
+
+    start = time.time()
+    cold = gdm.build_weekly_arima_model(ts)
+    gdm.report_arima_fit('  cold', cold, time.time() - start)
+    print '  cold aic {:.2f}'.format(cold.aic)
+
+    warm = gdm.update_weekly_arima_model(previous, ts)
+    print '  warm aic {:.2f}'.format(warm.aic)
+
+    kept = gdm.update_weekly_arima_model(previous, ts, refit=False)
+    print '  kept aic {:.2f}'.format(kept.aic)
+
+
+BENCHMARKS = {
+    'batch_concurrency': bench_batch_concurrency,
+    'grid_search': bench_grid_search,
+    'model_selection': bench_model_selection,
+    'listing': bench_listing,
+    'timeseries_store': bench_timeseries_store,
+    'weekly_refit': bench_weekly_refit,
+    'collection': bench_collection,
+    'aggregate': bench_aggregate,
+    'holtwinters': bench_holtwinters,
+    'holtwinters_fit': bench_holtwinters_fit,
+    'holtwinters_batch': bench_holtwinters_batch,
+}
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or sorted(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
@@ -3,6 +3,11 @@ import numpy as np
 import gmail_data_collection as gdc
 import gmail_data_processing as gdp
 import gmail_data_modeling as gdm
+import gmail_traffic_forecaster as gtf
+import model_generations as mg
+from accounts import Account
+from message_store import MessageStore
+from timeseries_store import TimeSeriesStore
 from datetime import datetime, timedelta
 from statsmodels.tsa.statespace.sarimax import SARIMAX
 from dateutil.relativedelta import relativedelta
@@ -11,66 +16,89 @@ from pytz import timezone
 import sys
 
 
-def create_timeseries_data(messages, today):
+# The number of messages counted at a time while they are collected
+CHUNK_SIZE = 10000
+
+
+def create_timeseries_data(chunks, today):
     '''
     Create daily and hourly time series data using the email messages returned from the GMAIL API
 
     Arguments:
-        messages - a list of messages (implemented as dicts)
+        chunks - an iterable of lists of messages (implemented as dicts) or of tuples
+                 returned by gdp.project_message
+        today - the local midnight of today. Only the whole days before it are counted.
     Returns:
         A tuple containing the daily and hourly time series data
     '''
-    df = gdp.messages_to_dataframe(messages)
-    daily_counts = None
-    hourly_counts = None
+    # Counts all messages except google hangout chat messages and messages that
+    # were sent by the user. Today's messages are counted by the first update
+    # run once the day is over.
+    daily_counts, hourly_counts = gdp.aggregate_message_chunks(
+        chunks, exclude_labels=['SENT', 'CHAT'], before=today)
 
-    if df is None:
-        daily_counts = None
-        hourly_counts = None
-    else:
-        # Remove all google hangout chat messages and messages that were sent
-        # by the user
-        if 'is_sent' in df:
-            df = df[~df['is_sent']]
-        if 'is_chat' in df:
-            df = df[~df['is_chat']]
+    if daily_counts is None or hourly_counts is None:
+        return (None, None)
 
-        hourly_counts = gdp.aggregate_mail_counts(df[df['date'] > (today - relativedelta(months=+6))], by='hour')
-        daily_counts = gdp.aggregate_mail_counts(df, by='day')
-
-        hourly_counts = gdp.fill_dates_between(hourly_counts, today, by='hour')
-        daily_counts = gdp.fill_dates_between(daily_counts, today, by='day')
+    # Every day and hour up to today; midnight is never at a daylight saving change
+    last = today - pd.Timedelta(hours=1)
+    first = daily_counts.index.min()
+    hourly_counts = hourly_counts.reindex(gdp.hourly_index(first, last), fill_value=0)
+    daily_counts = daily_counts.reindex(gdp.daily_index(first, last), fill_value=0)
 
     return (daily_counts, hourly_counts)
 
 
-def save_training_data(daily_ts, hourly_ts):
-    # Save new data to files.
-    daily_ts.to_pickle('../data/daily_ts.pkl')
-    hourly_ts.to_pickle('../data/hourly_ts.pkl')
+def save_training_data(daily_ts, hourly_ts, data_dir='../data'):
+    # Save new data to the time series stores.
+    TimeSeriesStore('daily_ts', data_dir).save(daily_ts)
+    TimeSeriesStore('hourly_ts', data_dir).save(hourly_ts)
 
 
 if __name__ == "__main__":
-    weekly_model_file = '../models/weekly_model.pkl'
-    hourly_model_file = '../models/hourly_model.pkl'
-
-    before = datetime.now(timezone('US/Pacific')
-                          ).replace(hour=0, minute=0, second=0, microsecond=0)
-    after = before - relativedelta(years=+2)
-
-    messages = gdc.collect_messages((before, after))
+    # With --account=<address> the models of that mailbox are created under the
+    # accounts directory; otherwise those of the default account are.
+    name = None
+    for arg in sys.argv[1:]:
+        if arg.startswith('--account='):
+            name = arg.split('=', 1)[1]
+    account = Account(name)
+    account.create()
+
+    # Local midnight today; the models are trained on whole days only
+    before = pd.Timestamp.now(tz='US/Pacific').normalize()
+    after = (before - relativedelta(years=+2)).to_pydatetime()
+
+    store = MessageStore(account.message_store)
+
+    if '--offline' in sys.argv:
+        # Rebuilds the models from the messages already in the message store
+        chunks = store.between(after, before, chunk_size=CHUNK_SIZE)
+        history_id = None
+    else:
+        # Collects everything up to the present and returns the sync cursor that the
+        # nightly updates continue from. The messages are counted chunk by chunk as
+        # they arrive rather than held in memory. Messages in the message store are
+        # not downloaded again.
+        chunks, history_id, incremental = gdc.sync_messages(
+            after, None, gdp.project_message, stream=True, chunk_size=CHUNK_SIZE,
+            store=store, credentials=account.credentials)
 
-    daily_ts, hourly_ts = create_timeseries_data(messages, before)
+    daily_ts, hourly_ts = create_timeseries_data(chunks, before)
 
     if daily_ts is None or hourly_ts is None:
         print "No data to train models!"
     else:
         weekly_model = gdm.build_weekly_arima_model(daily_ts)
-        hourly_model = gdm.build_hourly_holt_winters_model(hourly_ts)
-
-        weekly_model.save(weekly_model_file)
-
-        with open(hourly_model_file, 'w') as f:
-            pickle.dump(hourly_model, f)
-
-        save_training_data(daily_ts, hourly_ts)
+        # The hourly model is trained on the last 6 months only; the time series
+        # store keeps the full hourly history.
+        hourly_model = gdm.build_hourly_holt_winters_model(
+            hourly_ts[hourly_ts.index > (before - relativedelta(months=+6))])
+
+        generation = mg.new_generation(account.models_dir)
+        gtf.save_models(weekly_model, hourly_model, generation)
+        mg.publish_generation(generation, account.models_dir)
+
+        save_training_data(daily_ts, hourly_ts, account.data_dir)
+        if history_id is not None:
+            gdc.save_sync_cursor(history_id, account.sync_cursor)
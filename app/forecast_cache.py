@@ -0,0 +1,91 @@
+'''
+Forecast Cache Module
+
+This module defines a thread safe cache for forecasts produced by the
+forecasting models. Forecasts only change when the models are reloaded, so
+the dashboard computes each one once per model version.
+
+Author: Daryle J. Serrant
+'''
+
+from threading import Lock, Event
+
+
+class _Entry(object):
+    '''
+    A cached value that may still be computing
+    '''
+
+    def __init__(self):
+        self.ready = Event()
+        self.value = None
+        self.error = None
+
+
+class ForecastCache(object):
+    '''
+    Caches forecasts keyed by (model version, model kind, forecast steps).
+    Concurrent requests for a key that is being computed wait for that
+    computation instead of starting their own.
+    '''
+
+    def __init__(self, version=None):
+        '''
+        Instantiate a new instance of the ForecastCache class
+
+        Arguments:
+          version - The version of the models the cache serves
+        '''
+        self._lock = Lock()
+        self._entries = {}
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, compute):
+        '''
+        Returns the cached value for key, calling compute() to produce it on
+        a miss. Failed computations are not cached.
+
+        Arguments:
+          key - A hashable cache key
+          compute - A function with no arguments that produces the value
+
+        Returns:
+          The cached value
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+            owner = entry is None
+            if owner:
+                entry = _Entry()
+                self._entries[key] = entry
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        if owner:
+            try:
+                entry.value = compute()
+            except Exception as e:
+                entry.error = e
+                with self._lock:
+                    if self._entries.get(key) is entry:
+                        del self._entries[key]
+            finally:
+                entry.ready.set()
+        else:
+            entry.ready.wait()
+
+        if entry.error is not None:
+            raise entry.error
+
+        return entry.value
+
+    def stats(self):
+        '''
+        Returns a dictionary with the cache version, size, hits and misses
+        '''
+        with self._lock:
+            return {'version': self.version, 'entries': len(self._entries),
+                    'hits': self.hits, 'misses': self.misses}
@@ -8,53 +8,133 @@ Author: Daryle J. Serrant
 
 from apiclient.discovery import build
 from apiclient.http import BatchHttpRequest
+from apiclient.errors import HttpError
 from httplib2 import Http
 from oauth2client import file, client, tools
+from multiprocessing.pool import ThreadPool
+from Queue import Queue, Empty, Full
 import sys
+import os
+import json
+import random
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
 import cPickle as pickle
+from message_store import MessageStore
 
 # The Google API limits us to 1000 calls in a single batch request!
 MAX_CALLS_PER_REQUEST = 1000
 # This variable should never exceed 1000.
 
-emails = []
-
-
-def add_email_message(request_id, response, exception):
+# The largest page of results the GMAIL API list methods return
+MAX_PAGE_SIZE = 500
+
+# Date ranges are listed in shards of this many days at first. Once some shards
+# have been listed, the shards are sized to hold about SHARD_SIZE message ids,
+# but no fewer than one and no more than MAX_SHARD_DAYS days.
+INITIAL_SHARD_DAYS = 30
+SHARD_SIZE = 2000
+MAX_SHARD_DAYS = 365
+
+# Messages are requested in batches of this many calls. The GMAIL API recommends
+# batches of no more than 100 calls, larger ones trip its rate limits.
+BATCH_SIZE = 100
+# The number of batch requests in flight at once
+MAX_WORKERS = 4
+
+# The GMAIL API allows each user 250 quota units per second; a messages.get call
+# costs 5 units.
+QUOTA_UNITS_PER_SECOND = 250
+MESSAGE_GET_QUOTA_UNITS = 5
+
+# Calls failing with these statuses (or a 403 with one of these reasons) are
+# retried, waiting BACKOFF_BASE, 2 * BACKOFF_BASE, 4 * BACKOFF_BASE... seconds
+# (at most MAX_BACKOFF) between attempts.
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+MAX_RETRIES = 5
+BACKOFF_BASE = 1.0
+MAX_BACKOFF = 32.0
+
+# The forecasting models only need each message's arrival time and labels, so
+# collect_messages asks for the minimal format and masks the response down to
+# these fields (the ones the message store keeps) instead of downloading every
+# body, header and MIME part.
+MESSAGE_FORMAT = 'minimal'
+MESSAGE_FIELDS = 'id,threadId,internalDate,labelIds,historyId,sizeEstimate'
+
+# Stores the mailbox historyId as of the last collection, so the next one only
+# needs to fetch the messages added since.
+SYNC_CURSOR_FILE = '../data/sync_cursor.txt'
+
+# The stored user credentials of the mailbox collected from
+CREDENTIALS_FILE = 'storage.json'
+
+def authorize_http(credentials=CREDENTIALS_FILE):
     '''
-    Callback function for message batch requests performed in request_message
-    function below. Store the request response in a list
+    Creates an Http object authorized with the stored user credentials. If nothing has been
+    stored or the stored credentials are invalid, obtain new credentials from the user.
 
     Arguments:
-       request_id - The id of the request
-       response - The result obtained from the API call request
-       exception - The exception thrown from the API, if any occurred
-    '''
-    emails.append(response)
-
-
-def create_service():
-    '''
-    Creates a GMAIL API service object using stored user credentials. If nothing has been
-    stored or the stored credentials are invalid, obtain new credentials from the user.
+        credentials - Path to the file the user credentials are stored in
 
     Returns:
-        The GMAIL API service object
+        The authorized Http object
     '''
     SCOPES = 'https://www.googleapis.com/auth/gmail.readonly'
     CLIENT_SECRET = 'client_secret.json'
 
-    store = file.Storage('storage.json')
+    store = file.Storage(credentials)
     creds = store.get()
 
     if creds is None or creds.invalid:
         flow = client.flow_from_clientsecrets(CLIENT_SECRET, SCOPES)
         creds = tools.run(flow, store)
 
-    GMAIL = build('gmail', 'v1', http=creds.authorize(Http()))
+    return creds.authorize(Http())
+
+
+def create_service(credentials=CREDENTIALS_FILE):
+    '''
+    Creates a GMAIL API service object using stored user credentials.
+
+    Arguments:
+        credentials - Path to the file the user credentials are stored in
+
+    Returns:
+        The GMAIL API service object
+    '''
+    GMAIL = build('gmail', 'v1', http=authorize_http(credentials))
     return GMAIL
 
 
+def _list_pages(method, key, http=None, **kwargs):
+    '''
+    Follows the nextPageToken of a GMAIL API list method, requesting the largest
+    pages the API allows
+
+    Arguments:
+        method - The list method (i.e. service.users().messages().list)
+        key - The key of the listed items in each response
+        http - If specified, the Http object to execute the requests with
+        kwargs - The arguments of the list method
+    Returns:
+        A list of the listed items (defined as dictionaries)
+    '''
+    items = []
+    page_token = None
+
+    while True:
+        response = method(userId='me', maxResults=MAX_PAGE_SIZE, pageToken=page_token,
+                          **kwargs).execute(http=http)
+        items.extend(response.get(key, []))
+        page_token = response.get('nextPageToken')
+        if not page_token:
+            return items
+
+
 def request_threads(service):
     '''
     Retrieves all message threads from the user's GMAIL account.
@@ -64,129 +144,622 @@ def request_threads(service):
     Returns:
         A list of message threads (defined as dictionaries)
     '''
-    response = service.users().threads().list(userId='me').execute()
-    threads = []
-
     print "Requesting message threads..."
 
-    if 'threads' in response:
-        threads.extend(response['threads'])
+    return _list_pages(service.users().threads().list, 'threads')
 
-    while 'nextPageToken' in response:
-        page_token = response['nextPageToken']
-        response = service.users().threads().list(
-            userId='me', pageToken=page_token).execute()
-        threads.extend(response['threads'])
 
-    return threads
+def _date_query(before, after):
+    '''
+    Returns the search query for the messages that arrived within a date range
+    '''
+    return 'before:{} and after:{}'.format(before.strftime('%Y/%m/%d'),
+                                           after.strftime('%Y/%m/%d'))
 
 
-def request_message_ids(service, date_range=None):
+def request_message_ids(service, date_range=None, http_factory=None, workers=MAX_WORKERS):
     '''
-    Retrieves all message ids from the user's GMAIL account.
+    Retrieves all message ids from the user's GMAIL account. A date range is split
+    into shards of a few days that are listed concurrently on a pool of threads,
+    each with its own Http object. The first shards are INITIAL_SHARD_DAYS long;
+    later ones are sized from the number of messages per day found so far so that
+    each holds about SHARD_SIZE messages.
 
     Arguments:
         service - A GMAIL API Service object
         date_range - If specified, returns emails that arrived within a date range
+        http_factory - A function with no arguments returning an authorized Http object
+                       for a worker thread. authorize_http if None.
+        workers - The number of shards to list at once
     Returns:
-        A list of dictionaries that contain the id of a single message
+        A list of dictionaries that contain the id of a single message, newest first
     '''
-    query = None
-
-    if date_range:
-        before = date_range[0].strftime('%Y/%m/%d')
-        after = date_range[1].strftime('%Y/%m/%d')
-        query = 'before:{} and after:{}'.format(before, after)
+    print "Requesting message ids..."
 
-    response = service.users().messages().list(userId='me', q=query).execute()
+    if not date_range:
+        return _list_pages(service.users().messages().list, 'messages')
+
+    before, after = date_range[0].date(), date_range[1].date()
+    lock = threading.Lock()
+    # The shards still to list run from next_before back to after
+    state = {'next_before': before, 'days': 0, 'count': 0}
+    shards = {}
+
+    def next_shard():
+        with lock:
+            if state['next_before'] <= after:
+                return None
+            if state['days']:
+                rate = max(state['count'], 1) / float(state['days'])
+                days = int(round(SHARD_SIZE / rate))
+            else:
+                days = INITIAL_SHARD_DAYS
+            days = min(max(days, 1), MAX_SHARD_DAYS)
+            shard = (state['next_before'],
+                     max(state['next_before'] - timedelta(days=days), after))
+            state['next_before'] = shard[1]
+            return shard
+
+    def list_shards(worker):
+        shard = next_shard()
+        while shard:
+            messages = _list_pages(service.users().messages().list, 'messages',
+                                   http=_worker.http, q=_date_query(*shard))
+            with lock:
+                shards[shard] = messages
+                state['days'] += (shard[0] - shard[1]).days
+                state['count'] += len(messages)
+            shard = next_shard()
+
+    pool = ThreadPool(workers, initializer=_init_worker,
+                      initargs=(http_factory or authorize_http,))
+    try:
+        pool.map(list_shards, range(workers))
+    finally:
+        pool.close()
+        pool.join()
+
+    # Shards can overlap by a day at their edges, depending on how the GMAIL API
+    # reads the dates of the query
+    seen = set()
     messages = []
+    for shard in sorted(shards, reverse=True):
+        for msg in shards[shard]:
+            if msg['id'] not in seen:
+                seen.add(msg['id'])
+                messages.append(msg)
 
-    print "Requesting message ids..."
+    print "Listed {} message ids in {} shards".format(len(messages), len(shards))
+    return messages
 
-    if 'messages' in response:
-        messages.extend(response['messages'])
 
-    while 'nextPageToken' in response:
-        page_token = response['nextPageToken']
-        response = service.users().messages().list(
-            userId='me', q=query, pageToken=page_token).execute()
-        messages.extend(response['messages'])
+def _is_retryable(exception):
+    '''
+    Returns a tuple of two booleans: whether a failed call is worth retrying, and
+    whether it failed because a rate limit was exceeded
+    '''
+    if isinstance(exception, socket.error):
+        return True, False
+    if not isinstance(exception, HttpError):
+        return False, False
 
-    return messages
+    status = exception.resp.status
+    reason = ''
+    try:
+        reason = json.loads(exception.content)['error']['errors'][0]['reason']
+    except (ValueError, KeyError, IndexError, TypeError):
+        pass
+
+    rate_limited = status == 429 or (status == 403 and reason in RATE_LIMIT_REASONS)
+    return rate_limited or status in RETRY_STATUSES, rate_limited
+
+
+def backoff_delay(attempt):
+    '''
+    Returns the time to wait (in seconds) before retry number attempt: an
+    exponential backoff with random jitter, capped at MAX_BACKOFF seconds.
+    '''
+    return min(MAX_BACKOFF, BACKOFF_BASE * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+
+
+class TokenBucket(object):
+    '''
+    A thread safe token bucket rate limiter. Callers take as many tokens as the
+    quota units their request costs and wait until the bucket has refilled enough
+    to cover them. The refill rate halves whenever the API reports that a rate
+    limit was exceeded and climbs back towards its maximum while calls succeed.
+    '''
+
+    def __init__(self, rate=QUOTA_UNITS_PER_SECOND, capacity=None, min_rate=None):
+        '''
+        Instantiate a new instance of the TokenBucket class
+
+        Arguments:
+          rate - The maximum refill rate, in tokens per second
+          capacity - The most tokens the bucket holds (the allowed burst). The
+                     maximum rate if None.
+          min_rate - The lowest refill rate throttle() goes down to. A tenth of
+                     the maximum rate if None.
+        '''
+        self.max_rate = float(rate)
+        self.min_rate = float(min_rate or rate / 10.0)
+        self.rate = self.max_rate
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens):
+        '''
+        Takes tokens from the bucket, waiting until they have been refilled. A
+        request costing more than the capacity is let through once the bucket
+        has refilled what it borrowed.
+
+        Returns:
+          The time spent waiting, in seconds
+        '''
+        with self._lock:
+            now = time.time()
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= tokens
+            wait = max(0.0, -self.tokens / self.rate)
+
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def throttle(self):
+        '''
+        Halves the refill rate after a rate limit error
+        '''
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def recover(self):
+        '''
+        Raises the refill rate by a tenth of its maximum after a successful batch
+        '''
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+
+_worker = threading.local()
+
+
+def _init_worker(http_factory):
+    '''
+    Gives each collection thread its own Http object. httplib2 connections
+    must not be shared between threads.
+    '''
+    _worker.http = http_factory()
+
+
+def _fetch_batch(service, message_ids, callback, format, fields, limiter, stats):
+    '''
+    Executes a batch request getting a list of messages, retrying the calls that
+    fail with a transient error (rate limits and server errors) with exponential
+    backoff. Calls that fail for good are counted in stats and skipped.
+    '''
+    pending = list(message_ids)
+    attempt = 0
+
+    while pending:
+        failed = []
+        rate_limited = [False]
+
+        def on_response(request_id, response, exception):
+            if exception is None:
+                callback(request_id, response, None)
+                return
+            retryable, limited = _is_retryable(exception)
+            rate_limited[0] |= limited
+            if retryable:
+                failed.append(pending[int(request_id)])
+            else:
+                stats.add('failed')
+
+        limiter.acquire(len(pending) * MESSAGE_GET_QUOTA_UNITS)
+        batch = service.new_batch_http_request(callback=on_response)
+        for i, msg_id in enumerate(pending):
+            batch.add(service.users().messages().get(userId='me', id=msg_id,
+                                                     format=format, fields=fields),
+                      request_id=str(i))
+        try:
+            batch.execute(http=_worker.http)
+        except (HttpError, socket.error) as e:
+            retryable, rate_limited[0] = _is_retryable(e)
+            if not retryable:
+                raise
+            failed = pending
+
+        if rate_limited[0]:
+            limiter.throttle()
+        else:
+            limiter.recover()
+
+        if failed and attempt == MAX_RETRIES:
+            print "Giving up on {} messages after {} retries".format(len(failed), attempt)
+            stats.add('failed', len(failed))
+            break
+
+        if failed:
+            attempt += 1
+            stats.add('retries', len(failed))
+            time.sleep(backoff_delay(attempt))
+        pending = failed
+
+
+class _Counters(object):
+    '''
+    Thread safe counters for the collection statistics
+    '''
+
+    def __init__(self, *names):
+        self._lock = threading.Lock()
+        self.counts = dict((name, 0) for name in names)
+
+    def add(self, name, count=1):
+        with self._lock:
+            self.counts[name] += count
 
 
-def request_messages(service, messages):
+def stream_messages(service, messages, projection=None, format='full', fields=None,
+                    http_factory=None, workers=MAX_WORKERS, batch_size=BATCH_SIZE,
+                    limiter=None, chunk_size=None, stats=None, store=None):
     '''
-    Executes one or more batch requests in order to retrieve every message in the 
-    user's GMAIL account.
+    Executes batch requests in order to retrieve messages from the user's GMAIL
+    account, yielding the messages as the batch requests complete. The batch
+    requests run concurrently on a pool of threads, each with its own Http object,
+    and are rate limited to the user's GMAIL API quota. Calls that fail with a
+    transient error are retried with exponential backoff. At most a few batches
+    of messages are held at a time: the threads wait while the caller is busy
+    with the messages already received. If a message store is given, the
+    messages already in it are read from disk and only the rest are requested
+    (and then stored).
 
     Arguments:
         service  - A GMAIL API Service object
         messages - A list of dictionaries that contain the id of a single message 
+        projection - If specified, a function applied to each message as soon as it
+                     arrives. Only its result is kept, so the raw response can be released.
+        format - The GMAIL API message format: 'full', 'metadata', 'minimal' or 'raw'
+        fields - If specified, a partial response mask selecting the message fields to return
+        http_factory - A function with no arguments returning an authorized Http object
+                       for a worker thread. authorize_http if None.
+        workers - The number of batch requests to run at once
+        batch_size - The number of calls in each batch request
+        limiter - The TokenBucket rate limiting the calls. One allowing the GMAIL API
+                  per user quota if None.
+        chunk_size - If specified, the messages are yielded in lists of this many
+                     (the last one may be shorter)
+        stats - If specified, a dictionary that receives the number of messages
+                received, the number of retried and failed calls and the elapsed
+                time in seconds once every message has been received
+        store - If specified, the MessageStore to read known messages from and add
+                the requested ones to. It only keeps the minimal message fields.
+    Yields:
+        Messages (defined as dictionaries), in the order their batch requests complete
+    '''
+    http_factory = http_factory or authorize_http
+    limiter = limiter or TokenBucket(QUOTA_UNITS_PER_SECOND,
+                                     capacity=batch_size * MESSAGE_GET_QUOTA_UNITS)
+    batch_size = min(batch_size, MAX_CALLS_PER_REQUEST)
+    ids = [msg['id'] for msg in messages]
+    cached = []
+    if store is not None:
+        missing = store.missing(ids)
+        cached = list(set(ids) - set(missing))
+        ids = missing
+    chunks = [ids[i:i + batch_size] for i in range(0, len(ids), batch_size)]
+    counters = _Counters('received', 'retries', 'failed')
+
+    # Completed batches waiting for the caller, and the threads' error if any
+    results = Queue(2 * workers)
+    stopped = threading.Event()
+    failure = []
+    done = object()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return
+            except Full:
+                pass
+
+    def fetch(chunk):
+        if failure or stopped.is_set():
+            return
+        received = []
+
+        def callback(request_id, response, exception):
+            received.append(response)
+
+        _fetch_batch(service, chunk, callback, format, fields, limiter, counters)
+        counters.add('received', len(received))
+        if store is not None:
+            store.add(received)
+        put(map(projection, received) if projection else received)
+
+    def produce():
+        pool = ThreadPool(workers, initializer=_init_worker, initargs=(http_factory,))
+        try:
+            # imap (rather than map) re-raises errors as they happen and reports progress
+            for i, _ in enumerate(pool.imap_unordered(fetch, chunks)):
+                if (i + 1) % 10 == 0 or i + 1 == len(chunks):
+                    print "Completed batch request {} of {}...".format(i + 1, len(chunks))
+        except Exception:
+            failure.append(sys.exc_info())
+        finally:
+            pool.close()
+            pool.join()
+
+        result = dict(counters.counts, cached=len(cached), seconds=time.time() - start)
+        print "Received {} messages in {:.1f}s ({:.0f} messages/s, {} retries, {} failed)".format(
+            result['received'], result['seconds'],
+            result['received'] / max(result['seconds'], 1e-9), result['retries'], result['failed'])
+        if stats is not None:
+            stats.update(result)
+
+        put(done)
+
+    def batches():
+        # Stored messages are read while the missing ones are requested
+        for i in range(0, len(cached), batch_size):
+            stored = store.get(cached[i:i + batch_size])
+            yield map(projection, stored) if projection else stored
+
+        while True:
+            try:
+                # A timeout keeps the wait interruptible with Ctrl-C
+                batch = results.get(timeout=1)
+            except Empty:
+                continue
+            if batch is done:
+                return
+            yield batch
+
+    if cached:
+        print "Reading {} stored messages...".format(len(cached))
+    print "Executing {} message batch requests on {} threads...".format(len(chunks), workers)
+    start = time.time()
+    producer = threading.Thread(target=produce)
+    producer.daemon = True
+    producer.start()
+
+    pending = []
+    try:
+        for batch in batches():
+            if chunk_size is None:
+                for message in batch:
+                    yield message
+            else:
+                pending.extend(batch)
+                while len(pending) >= chunk_size:
+                    yield pending[:chunk_size]
+                    pending = pending[chunk_size:]
+
+        if failure:
+            raise failure[0][0], failure[0][1], failure[0][2]
+        if pending:
+            yield pending
+    finally:
+        # Releases the threads if the caller stops early
+        stopped.set()
+
+
+def request_messages(service, messages, projection=None, format='full', fields=None,
+                     http_factory=None, workers=MAX_WORKERS, batch_size=BATCH_SIZE,
+                     limiter=None, stats=None, store=None):
+    '''
+    Executes batch requests in order to retrieve every message in the user's GMAIL
+    account. See stream_messages for the arguments.
+
     Returns:
         A list of messages (defined as dictionaries)
     '''
-    curr = -1
-    batch_requests = []
-    global emails
-    emails.append(1)
-
-    print "Creating message batch requests..."
-    for i, msg in enumerate(messages):
-        if i % MAX_CALLS_PER_REQUEST == 0:
-            batch_requests.append(service.new_batch_http_request())
-            curr += 1
-        else:
-            batch_requests[curr].add(service.users().messages().get(userId='me', id=msg['id']),
-                                     callback=add_email_message)
-
-    batch_size = len(batch_requests)
-    for i, batch in enumerate(batch_requests):
-        print "Executing batch request {} of {}...".format(i + 1, batch_size)
-        batch.execute()
+    return list(stream_messages(service, messages, projection, format, fields,
+                                http_factory, workers, batch_size, limiter, stats=stats,
+                                store=store))
 
 
-def collect_messages(date_range):
+def collect_messages(date_range, projection=None, format=MESSAGE_FORMAT, fields=MESSAGE_FIELDS,
+                     stream=False, chunk_size=None, store=None, credentials=CREDENTIALS_FILE):
     '''
     Collects all the messages in the user's inbox
 
     Arguments:
         date_range - only pulls messages that arrive within a date range. Specified as a tuple:
                      (before_date, after_date)
+        projection - If specified, a function applied to each message as it arrives. The
+                     results are returned instead of the messages.
+        format - The GMAIL API message format
+        fields - A partial response mask selecting the message fields to return. All
+                 fields of the format if None.
+        stream - If True, returns a generator yielding the messages as they arrive
+                 instead of a list
+        chunk_size - If specified, the messages are returned in lists of this many
+        store - If specified, the MessageStore that known messages are read from and
+                new ones are added to
+        credentials - Path to the file the user credentials are stored in
 
     Returns:
-        A list of messages (as dicts) from the user's mailbox.
+        A list (or generator) of messages (as dicts) from the user's mailbox.
     '''
-    service = create_service()
+    service = create_service(credentials)
+    http_factory = lambda: authorize_http(credentials)
+
+    message_ids = request_message_ids(service, date_range, http_factory)
 
-    message_ids = request_message_ids(service, date_range)
+    messages = stream_messages(service, message_ids, projection, format, fields,
+                               http_factory, chunk_size=chunk_size, store=store)
+    return messages if stream else list(messages)
 
-    # Empty list
-    global emails
-    emails = []
 
-    request_messages(service, message_ids)
+def load_sync_cursor(filepath=SYNC_CURSOR_FILE):
+    '''
+    Loads the sync cursor saved by save_sync_cursor
 
-    return emails[:]
+    Arguments:
+        filepath - Path to the sync cursor file
+    Returns:
+        The historyId of the last collection, None if no cursor has been saved
+    '''
+    if not os.path.exists(filepath):
+        return None
+
+    with open(filepath, 'r') as f:
+        return f.read().strip() or None
+
+
+def save_sync_cursor(history_id, filepath=SYNC_CURSOR_FILE):
+    '''
+    Saves the sync cursor. Call this only once the collected messages have been
+    stored, so that a failed run collects them again.
+
+    Arguments:
+        history_id - The historyId returned by sync_messages
+        filepath - Path to the sync cursor file
+    '''
+    with open(filepath, 'w') as f:
+        f.write(str(history_id))
+
+
+def request_history_id(service):
+    '''
+    Retrieves the current historyId of the user's GMAIL account.
+
+    Arguments:
+        service - A GMAIL API Service object
+    Returns:
+        The historyId
+    '''
+    return service.users().getProfile(userId='me').execute()['historyId']
+
+
+def request_added_message_ids(service, start_history_id):
+    '''
+    Retrieves the ids of all messages added to the user's GMAIL account after a
+    history id. The GMAIL API only keeps about a week of history; an HttpError
+    with status 404 is raised if start_history_id is too old.
+
+    Arguments:
+        service - A GMAIL API Service object
+        start_history_id - The historyId to list the changes after
+    Returns:
+        A tuple containing a list of dictionaries that contain the id of a single
+        message and the latest historyId
+    '''
+    response = service.users().history().list(
+        userId='me', startHistoryId=start_history_id, historyTypes='messageAdded').execute()
+    records = []
+
+    print "Requesting message history..."
+
+    records.extend(response.get('history', []))
+    history_id = response['historyId']
+
+    while 'nextPageToken' in response:
+        page_token = response['nextPageToken']
+        response = service.users().history().list(
+            userId='me', startHistoryId=start_history_id, historyTypes='messageAdded',
+            pageToken=page_token).execute()
+        records.extend(response.get('history', []))
+        history_id = response['historyId']
+
+    seen = set()
+    messages = []
+    for record in records:
+        for added in record.get('messagesAdded', []):
+            msg_id = added['message']['id']
+            if msg_id not in seen:
+                seen.add(msg_id)
+                messages.append({'id': msg_id})
+
+    return messages, history_id
+
+
+def sync_messages(after, cursor=None, projection=None, format=MESSAGE_FORMAT,
+                  fields=MESSAGE_FIELDS, stream=False, chunk_size=None, store=None,
+                  credentials=CREDENTIALS_FILE):
+    '''
+    Collects the messages added to the user's mailbox since the last sync. If there
+    is no sync cursor, or it has expired, collects every message that arrived after
+    a date instead. That resync runs up to the present, since the new cursor marks
+    the present. Either way the messages of the current day are included; callers
+    that count messages should only count whole days and leave the rest in the
+    message store for the next run.
+
+    Arguments:
+        after - the date to collect messages after when a full resync is needed
+        cursor - The historyId returned by the last sync, None to resync fully
+        projection - If specified, a function applied to each message as it arrives
+        format - The GMAIL API message format
+        fields - A partial response mask selecting the message fields to return
+        stream - If True, returns a generator yielding the messages as they arrive
+                 instead of a list
+        chunk_size - If specified, the messages are returned in lists of this many
+        store - If specified, the MessageStore that known messages are read from and
+                new ones are added to
+        credentials - Path to the file the user credentials are stored in
+
+    Returns:
+        A tuple containing the list (or generator) of messages, the historyId to use as the next
+        sync cursor and True if only messages added since the cursor were collected
+        (False after a full resync)
+    '''
+    service = create_service(credentials)
+    http_factory = lambda: authorize_http(credentials)
+    message_ids = None
+
+    if cursor is not None:
+        try:
+            message_ids, history_id = request_added_message_ids(service, cursor)
+        except HttpError as e:
+            if e.resp.status != 404:
+                raise
+            print "Sync cursor {} has expired. Resyncing the date range...".format(cursor)
+
+    incremental = message_ids is not None
+
+    if not incremental:
+        # Read the history id first so nothing that arrives while listing is missed
+        history_id = request_history_id(service)
+        before = datetime.now(after.tzinfo) + timedelta(days=1)
+        message_ids = request_message_ids(service, (before, after), http_factory)
+
+    messages = stream_messages(service, message_ids, projection, format, fields,
+                               http_factory, chunk_size=chunk_size, store=store)
+    return (messages if stream else list(messages)), history_id, incremental
 
 
 if __name__ == '__main__':
     service = create_service()
 
-    threads = request_threads(service)
+    # Adds every message in the mailbox that is not stored yet to the message store
+    store = MessageStore()
+    message_ids = request_message_ids(service)
+    for chunk in stream_messages(service, message_ids, format=MESSAGE_FORMAT,
+                                 fields=MESSAGE_FIELDS, chunk_size=10000, store=store):
+        pass
+    print "The message store holds {} messages".format(len(store))
 
-    print "Saving threads.pkl"
-    with open('threads.pkl' 'w') as f:
-        pickle.dump(threads, f)
+    # The full threads and messages are only needed for exploratory analysis
+    if '--pickle' in sys.argv:
+        threads = request_threads(service)
 
-    message_ids = request_message_ids(service)
+        print "Saving threads.pkl"
+        with open('threads.pkl', 'w') as f:
+            pickle.dump(threads, f)
 
-    print "Saving message_ids.pkl"
-    with open('message_ids.pkl' 'w') as f:
-        pickle.dump(threads, f)
+        print "Saving message_ids.pkl"
+        with open('message_ids.pkl', 'w') as f:
+            pickle.dump(message_ids, f)
 
-    request_messages(service, message_ids)
+        emails = request_messages(service, message_ids)
 
-    print "Saving emails.pkl"
-    with open('emails.pkl', 'w') as f:
-        pickle.dump(emails, f)
+        print "Saving emails.pkl"
+        with open('emails.pkl', 'w') as f:
+            pickle.dump(emails, f)
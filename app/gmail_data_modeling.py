@@ -11,9 +11,9 @@ import pandas as pd
 import numpy as np
 import gmail_data_collection as gdc
 import gmail_data_processing as gdp
-from operator import itemgetter
-from multiprocessing import Pool
-from functools import partial
+from multiprocessing import Pool, cpu_count
+import time
+import warnings
 from statsmodels.tsa.statespace.sarimax import SARIMAX
 import holtwinters as hw
 
@@ -55,49 +55,80 @@ def test_stationarity(timeseries):
     print dfoutput
 
 
-def run_grid_search(data, params):
+def fit_grid_candidate(data, pm, period=HOURLY_PERIOD, maxiter=None):
+    '''
+    Fits one seasonal arima model of a grid search
+
+    Arguments:
+        data - the time series data
+        pm - the SARIMAX parameters as a list: [p, d, q, P, D, Q]
+        period - the seasonal period
+        maxiter - If specified, caps the optimizer iterations
+
+    Returns:
+        A dictionary with the aic and parameters of the model and the time taken to
+        fit it in seconds. The aic is infinite if the model could not be fit.
+    '''
+    p, d, q, P, D, Q = tuple(pm)
+    fit_args = {'disp': False}
+    if maxiter is not None:
+        fit_args['maxiter'] = maxiter
+
+    start = time.time()
+    try:
+        with warnings.catch_warnings():
+            # Capped fits are expected not to converge
+            warnings.simplefilter('ignore')
+            aic = SARIMAX(data, order=(p, d, q), seasonal_order=(P, D, Q, period), simple_differencing=True,
+                          enforce_stationarity=False, enforce_invertibility=False).fit(**fit_args).aic
+    except (ValueError, np.linalg.LinAlgError):
+        aic = np.inf
+    return {'params': {'p': p, 'd': d, 'q': q, 'P': P, 'D': D, 'Q': Q}, 'aic': aic,
+            'seconds': time.time() - start}
+
+
+def _grid_params(result):
+    '''
+    Returns the parameters of a grid search result as a list: [p, d, q, P, D, Q]
+    '''
+    return [result['params'][k] for k in ['p', 'd', 'q', 'P', 'D', 'Q']]
+
+
+def run_grid_search(data, params, period=HOURLY_PERIOD):
     '''
     Perform grid search on seasonal arima model
 
     Arguments:
         data - the time series data
         params - a list of SARIMAX parameters. (A list of lists)
+        period - the seasonal period
 
     Returns:
         A dictionary with the optimal aic and parameters
     '''
-    best_aic = np.inf
-    best_params = None
+    best = {'params': None, 'aic': np.inf}
 
     for pm in params:
-        p, d, q, P, D, Q = tuple(pm)
-        model = SARIMAX(data, order=(p, d, q), seasonal_order=(P, D, Q, HOURLY_PERIOD), simple_differencing=True, enforce_stationarity=False,
-                        enforce_invertibility=False).fit()
-        print 'p:{},d:{},q:{},P:{},D:{},Q:{}, AIC:{}'.format(p, d, q, P, D, Q, model.aic)
-        if model.aic < best_aic:
-            best_aic = model.aic
-            best_params = {'p': p, 'd': d, 'q': q, 'P': P, 'D': D, 'Q': Q}
+        result = fit_grid_candidate(data, pm, period)
+        print 'p:{p},d:{d},q:{q},P:{P},D:{D},Q:{Q}, AIC:{aic}'.format(aic=result['aic'], **result['params'])
+        if result['aic'] < best['aic']:
+            best = result
 
-    return {'params': best_params, 'aic': best_aic}
+    return best
 
 
-def parallel_grid_search_arima(ts, params):
+def grid_search_candidates(params):
     '''
-    Perform parallel grid searches on arima model
+    Lists the SARIMAX parameter combinations of a grid search. Combinations without
+    a seasonal AR or MA term are skipped.
 
     Arguments:
-        ts - the time series
-        params - a dictionary of SARIMAX parameters
+        params - a dictionary mapping each SARIMAX parameter to a list of values
 
     Returns:
-        The parameters that produces most optimal aic 
+        A list of SARIMAX parameters: [p, d, q, P, D, Q]
     '''
-    pool = Pool(processes=4)
     p_list = []
-    best_aic = np.inf
-    best_params = None
-
-    partial_srch = partial(run_grid_search, ts)
 
     for lp in params['p']:
         for lq in params['q']:
@@ -108,11 +139,165 @@ def parallel_grid_search_arima(ts, params):
                             if bp == 0 and bq == 0:
                                 continue
                             p_list.append([lp, ld, lq, bp, bd, bq])
-    results = pool.map(partial_srch, [p_list])
+    return p_list
+
+
+# The time series and seasonal period a grid search worker process fits its models on
+_grid_data = None
+_grid_period = None
+
+
+def _init_grid_worker(ts, period):
+    '''
+    Hands the time series to a grid search worker process once, rather than with
+    every candidate
+    '''
+    global _grid_data, _grid_period
+    _grid_data = ts
+    _grid_period = period
+
+
+def _fit_grid_worker(task):
+    pm, window, maxiter = task
+    data = _grid_data if window is None else _grid_data[-window:]
+    return fit_grid_candidate(data, pm, _grid_period, maxiter)
+
 
-    sorted_results = sorted(results, key=itemgetter('aic'))
+def _grid_pool(ts, period, processes):
+    return Pool(processes=processes, initializer=_init_grid_worker, initargs=(ts, period))
 
-    return sorted_results[0]
+
+def _close_pool(pool, failed):
+    '''
+    Closes a pool when its work is done, or stops it if the work failed
+    '''
+    if failed:
+        pool.terminate()
+    else:
+        pool.close()
+    pool.join()
+
+
+def iter_grid_search_arima(ts, params, period=HOURLY_PERIOD, processes=None, chunksize=None):
+    '''
+    Fits the seasonal arima models of a grid search on a pool of worker processes,
+    yielding the results as they finish
+
+    Arguments:
+        ts - the time series
+        params - a dictionary of SARIMAX parameters
+        period - the seasonal period
+        processes - the number of worker processes. One per core if None.
+        chunksize - the number of candidates handed to a worker at a time. About four
+                    chunks per worker if None.
+
+    Yields:
+        A dictionary with the aic and parameters of each model
+    '''
+    tasks = [(pm, None, None) for pm in grid_search_candidates(params)]
+    processes = processes or cpu_count()
+    chunksize = chunksize or max(1, len(tasks) // (4 * processes))
+
+    pool = _grid_pool(ts, period, processes)
+    failed = True
+    try:
+        for result in pool.imap_unordered(_fit_grid_worker, tasks, chunksize):
+            yield result
+        failed = False
+    finally:
+        _close_pool(pool, failed)
+
+
+def parallel_grid_search_arima(ts, params, period=HOURLY_PERIOD, processes=None):
+    '''
+    Perform parallel grid searches on arima model
+
+    Arguments:
+        ts - the time series
+        params - a dictionary of SARIMAX parameters
+        period - the seasonal period
+        processes - the number of worker processes. One per core if None.
+
+    Returns:
+        The parameters that produces most optimal aic 
+    '''
+    best = {'params': None, 'aic': np.inf}
+
+    for result in iter_grid_search_arima(ts, params, period, processes):
+        print 'p:{p},d:{d},q:{q},P:{P},D:{D},Q:{Q}, AIC:{aic}'.format(aic=result['aic'], **result['params'])
+        if result['aic'] < best['aic']:
+            best = result
+
+    return best
+
+
+def successive_halving_arima(ts, params, period=HOURLY_PERIOD, eta=2, min_fraction=0.25,
+                             maxiter=25, processes=None):
+    '''
+    Selects a seasonal arima model by successive halving. Every candidate is first fit
+    on the most recent min_fraction of the data with capped optimizer iterations.
+    Only the best 1/eta of them (by aic) are fit again on eta times as much data,
+    and so on until the survivors are fit fully on all the data.
+
+    Arguments:
+        ts - the time series
+        params - a dictionary of SARIMAX parameters
+        period - the seasonal period
+        eta - the factor by which the candidates are cut and the data grown each round
+        min_fraction - the fraction of the data used in the first round
+        maxiter - the optimizer iterations allowed in the rounds before the last
+        processes - the number of worker processes. One per core if None.
+
+    Returns:
+        A dictionary with the optimal aic and parameters, the number of fits, the time
+        spent fitting in seconds, and the observations fitted compared with those an
+        exhaustive search fits
+    '''
+    candidates = grid_search_candidates(params)
+    total = len(candidates)
+    processes = processes or cpu_count()
+
+    # Each window is eta times longer than the last, up to the final fit on all the
+    # data. Windows shorter than a few seasons are not worth fitting.
+    windows = []
+    window = max(int(len(ts) * min_fraction), 4 * period)
+    while window * eta <= len(ts):
+        windows.append(window)
+        window *= eta
+
+    fits = 0
+    spent = 0.0
+    observations = 0
+    pool = _grid_pool(ts, period, processes)
+    failed = True
+    try:
+        for window in windows + [None]:
+            if window is None:
+                tasks = [(pm, None, None) for pm in candidates]
+            else:
+                tasks = [(pm, window, maxiter) for pm in candidates]
+            results = sorted(pool.imap_unordered(_fit_grid_worker, tasks,
+                                                 max(1, len(tasks) // (4 * processes))),
+                             key=lambda r: r['aic'])
+            fits += len(results)
+            spent += sum(r['seconds'] for r in results)
+            observations += len(results) * (window or len(ts))
+            if window is not None:
+                candidates = [_grid_params(r) for r in results[:max(1, -(-len(results) // eta))]]
+                print 'Fit {} candidates on the last {} observations, kept {}'.format(
+                    len(results), window, len(candidates))
+        failed = False
+    finally:
+        _close_pool(pool, failed)
+
+    # The exhaustive search fits every candidate on all the data
+    exhaustive = total * len(ts)
+    print 'Successive halving: {} fits in {:.1f}s over {} observations, {} for the exhaustive search of {} candidates ({:.0%} saved)'.format(
+        fits, spent, observations, exhaustive, total, 1 - float(observations) / exhaustive)
+
+    return {'params': results[0]['params'], 'aic': results[0]['aic'], 'fits': fits,
+            'seconds': spent, 'observations': observations,
+            'exhaustive_observations': exhaustive}
 
 
 def build_hourly_arima_model(ts, params=None):
@@ -147,12 +332,64 @@ def build_hourly_holt_winters_model(ts):
         ts - a time series
 
     Returns:
-        A tuple containing the alpha, beta, and gamma parameters returned from the algorithm along with the
-        data used for tuning.
+        A tuple containing the alpha, beta, and gamma parameters returned from the algorithm,
+        the seasonal period, the terminal level, trend and seasonal state of the model and
+        the last hour of the data used for tuning.
     '''
     additive_hw = hw.additive(ts.tolist(), HOURLY_PERIOD, 24)
+    level, trend, season = hw.additive_state(ts.tolist(), HOURLY_PERIOD, additive_hw[1],
+                                             additive_hw[2], additive_hw[3])
+
+    return (additive_hw[1], additive_hw[2], additive_hw[3], HOURLY_PERIOD, level, trend,
+            season, ts.index.max())
 
-    return (additive_hw[1], additive_hw[2], additive_hw[3], HOURLY_PERIOD, ts)
+
+def build_hourly_holt_winters_models(df):
+    '''
+    Builds an hourly additive holt winters model for each of many series at once,
+    e.g. the hourly counts of each label or of each mailbox. The series are fitted
+    together by the batched engine, which is much faster than fitting them one by
+    one with build_hourly_holt_winters_model.
+
+    Arguments:
+        df - a data frame of hourly counts with one column per series, all sharing
+             the same hourly index
+
+    Returns:
+        A dictionary mapping each column to a tuple in the same format as
+        build_hourly_holt_winters_model
+    '''
+    X = df.fillna(0).values.T
+    forecasts, alpha, beta, gamma, rmse = hw.additive_batch(X, HOURLY_PERIOD, 0)
+    states = hw.additive_batch_state(X, HOURLY_PERIOD, alpha, beta, gamma)
+    end = df.index.max()
+
+    return dict((column, (alpha[j], beta[j], gamma[j], HOURLY_PERIOD) + states[j] +
+                 (end,))
+                for j, column in enumerate(df.columns))
+
+
+def update_hourly_holt_winters_model(model, ts):
+    '''
+    Folds new hourly observations into an existing hourly holt winters model without
+    refitting the parameters or re-smoothing the history.
+
+    Arguments:
+        model - A tuple returned by build_hourly_holt_winters_model
+        ts - a time series. Only the hours after the last hour seen by the model are used.
+
+    Returns:
+        A tuple in the same format as build_hourly_holt_winters_model
+    '''
+    alpha, beta, gamma, period, level, trend, season, end = model
+    new = ts[ts.index > end]
+
+    if len(new) > 0:
+        level, trend, season = hw.additive_update((level, trend, season), new.tolist(),
+                                                  alpha, beta, gamma)
+        end = new.index.max()
+
+    return (alpha, beta, gamma, period, level, trend, season, end)
 
 
 def build_weekly_arima_model(ts, params=None):
@@ -178,3 +415,64 @@ def build_weekly_arima_model(ts, params=None):
     Q = params['Q']
 
     return SARIMAX(ts, order=(p, d, q), seasonal_order=(P, D, Q, WEEKLY_PERIOD)).fit()
+
+
+def report_arima_fit(label, results, seconds):
+    '''
+    Prints the optimizer iterations and time taken by a SARIMAX fit
+
+    Arguments:
+        label - a name for the fit
+        results - the SARIMAXResults of the fit
+        seconds - the time the fit took
+    '''
+    retvals = results.mle_retvals or {}
+    print '{} fit: {} iterations in {:.2f}s, converged: {}'.format(
+        label, retvals.get('iterations'), seconds, retvals.get('converged'))
+
+
+def _extends_fit(results, ts):
+    # True if the series only grew since the fit: the dates the previous model
+    # was fit on are the first dates of the series. Values at those dates may
+    # have been recounted.
+    fitted = results.fittedvalues.index
+    return len(ts) >= len(fitted) and ts.index[:len(fitted)].equals(fitted)
+
+
+def update_weekly_arima_model(results, ts, refit=True):
+    '''
+    Updates a weekly arima model with new data. The model is refit starting from its
+    previous parameters, which takes far fewer iterations than fitting it from
+    scratch. If the warm started fit does not converge, the model is fit from
+    scratch instead.
+
+    Arguments:
+        results - the SARIMAXResults of the previous model
+        ts - a time series
+        refit - If False and the data has only grown since the previous fit, the
+                previous parameters are kept and only applied to the new data
+
+    Returns:
+        an arima model
+    '''
+    model = SARIMAX(ts, order=results.model.order,
+                    seasonal_order=results.model.seasonal_order)
+
+    # statsmodels versions without results.append() extend a model this way
+    if not refit and _extends_fit(results, ts):
+        start = time.time()
+        updated = model.filter(results.params)
+        print 'Weekly model kept its parameters, filtered in {:.2f}s'.format(
+            time.time() - start)
+        return updated
+
+    start = time.time()
+    updated = model.fit(start_params=results.params, disp=False)
+    report_arima_fit('Warm started weekly', updated, time.time() - start)
+    if updated.mle_retvals.get('converged'):
+        return updated
+
+    start = time.time()
+    updated = model.fit(disp=False)
+    report_arima_fit('Cold weekly', updated, time.time() - start)
+    return updated
@@ -15,46 +15,72 @@ import time
 import pytz
 from pytz import timezone
 from dateutil.relativedelta import relativedelta
+from scipy.sparse import csr_matrix
 
+# The time zone message dates are converted to by default
+TIMEZONE = 'US/Pacific'
 
-def get_unique_labels(data):
+# The labels given is_<label> columns by default: those the model scripts filter
+# on. Columns for every label would cost messages times labels booleans; the
+# full membership is kept sparse by label_indicator_matrix.
+LABEL_COLUMNS = ('SENT', 'CHAT')
+
+
+def label_indicator_matrix(data):
     '''
-    Gets the unique message labels
+    Builds a sparse message by label indicator matrix in a single pass over the
+    message labels. Its size grows with the number of label assignments rather than
+    with messages times labels.
 
     Arguments:
-        messages - a list of lists of message labels
+        data - a list of lists of message labels
 
     Returns:
-        the unique list of message labels
+        A tuple containing a boolean scipy CSR matrix with one row per list and one
+        column per label, and the list of labels in column order
     '''
-    msg_labels = set()
+    columns = {}
+    indices = []
+    indptr = [0]
+
     for lst in data:
         if type(lst) == list:
             for l in lst:
-                msg_labels.add(l)
-    return list(msg_labels)
+                indices.append(columns.setdefault(l, len(columns)))
+        indptr.append(len(indices))
 
+    matrix = csr_matrix((np.ones(len(indices), dtype=bool), indices, indptr),
+                        shape=(len(indptr) - 1, len(columns)))
+    labels = sorted(columns, key=columns.get)
+    return matrix, labels
 
-def has_label(data, label):
+
+def add_label_columns(df, matrix, labels, label_columns=LABEL_COLUMNS):
     '''
-    Checks if a message label is contained in each list of lists
+    Adds an is_<label> boolean column to the data frame for each selected label.
+    Selected labels no message has get a column of False.
 
     Arguments:
-        messages - a list of lists of message labels
-
-    Returns:
-        a list of booleans
+        df - Pandas dataframe with one row per row of the matrix
+        matrix - a label indicator matrix returned by label_indicator_matrix
+        labels - the labels of the matrix columns
+        label_columns - the labels to add columns for (case insensitive). All labels if
+                        None, which costs a dense column per label.
     '''
-    results = []
-    for lst in data:
-        if lst:
-            if label in lst:
-                results.append(True)
-            else:
-                results.append(False)
-        else:
-            results.append(False)
-    return results
+    if label_columns is None:
+        label_columns = labels
+
+    positions = dict((lbl.lower(), j) for j, lbl in enumerate(labels))
+    selected = sorted(set(l.lower() for l in label_columns))
+    # Only the selected columns of the matrix are expanded
+    csc = matrix.tocsc()
+
+    for lbl in selected:
+        column = np.zeros(matrix.shape[0], dtype=bool)
+        if lbl in positions:
+            j = positions[lbl]
+            column[csc.indices[csc.indptr[j]:csc.indptr[j + 1]]] = True
+        df['is_' + lbl] = column
 
 
 def threads_to_dataframe(threads):
@@ -82,12 +108,15 @@ def threads_to_dataframe(threads):
     return df_threads
 
 
-def messages_to_dataframe(messages):
+def messages_to_dataframe(messages, tz=TIMEZONE, label_columns=LABEL_COLUMNS):
     '''
     Converts the list of messages obtained from the GMAIL API into a pandas dataframe.
 
     Arguments:
         threads - a list of messages retrieved from the GMAIL API
+        tz - the time zone of the date column and its components
+        label_columns - the label ids to add is_<label> columns for. All labels if None.
+                        Defaults to LABEL_COLUMNS.
 
     Returns:
         a pandas data frame, None if the message list provided is empty
@@ -171,31 +200,100 @@ def messages_to_dataframe(messages):
             'thread_id': thread_id
         })
 
-    msg_labels = get_unique_labels(df['label_ids'])
-
-    for lbl in msg_labels:
-        df['is_' + lbl.lower()] = has_label(df['label_ids'], lbl)
-
-    df['year'] = df['internal_date'].apply(lambda x: datetime.fromtimestamp(
-        int(x) / 1000, tz=timezone('US/Pacific')).year)
-    df['month'] = df['internal_date'].apply(lambda x: datetime.fromtimestamp(
-        int(x) / 1000, tz=timezone('US/Pacific')).month)
-    df['day'] = df['internal_date'].apply(lambda x: datetime.fromtimestamp(
-        int(x) / 1000, tz=timezone('US/Pacific')).day)
-    df['hour'] = df['internal_date'].apply(lambda x: datetime.fromtimestamp(
-        int(x) / 1000, tz=timezone('US/Pacific')).hour)
-    df['min'] = df['internal_date'].apply(lambda x: datetime.fromtimestamp(
-        int(x) / 1000, tz=timezone('US/Pacific')).minute)
-    df['sec'] = df['internal_date'].apply(lambda x: datetime.fromtimestamp(
-        int(x) / 1000, tz=timezone('US/Pacific')).second)
-    df['wday'] = df['internal_date'].apply(lambda x: datetime.fromtimestamp(
-        int(x) / 1000, tz=timezone('US/Pacific')).weekday())
-    df['date'] = df['internal_date'].apply(
-        lambda x: datetime.fromtimestamp(int(x) / 1000, tz=timezone('US/Pacific')))
+    matrix, msg_labels = label_indicator_matrix(df['label_ids'])
+    add_label_columns(df, matrix, msg_labels, label_columns)
+
+    add_date_columns(df, df['internal_date'].astype(np.int64), tz)
 
     return df.drop('label_ids', axis=1)
 
 
+def add_date_columns(df, ms, tz=TIMEZONE):
+    '''
+    Adds the date column and its year, month, day, hour, min, sec and wday
+    components to the data frame. Timestamps are truncated to whole seconds and
+    converted in one pass.
+
+    Arguments:
+        df - Pandas dataframe
+        ms - epoch milliseconds of each row (int64)
+        tz - the time zone to convert the dates to
+    '''
+    dates = pd.Series(pd.to_datetime(ms // 1000 * 1000, unit='ms', utc=True),
+                      index=df.index).dt.tz_convert(tz)
+
+    df['year'] = dates.dt.year
+    df['month'] = dates.dt.month
+    df['day'] = dates.dt.day
+    df['hour'] = dates.dt.hour
+    df['min'] = dates.dt.minute
+    df['sec'] = dates.dt.second
+    df['wday'] = dates.dt.weekday
+    df['date'] = dates
+
+
+def project_message(message):
+    '''
+    Extracts the only fields the forecasting models use from a message obtained
+    from the GMAIL API, so the rest of the response can be released right away.
+
+    Arguments:
+        message - a message retrieved from the GMAIL API
+
+    Returns:
+        a tuple of the message id, its internal date in epoch milliseconds and its
+        list of label ids, None if the message is not a dict
+    '''
+    if type(message) != dict:
+        return None
+    return (message['id'], int(message['internalDate']), message.get('labelIds'))
+
+
+def messages_to_counts_dataframe(messages, tz=TIMEZONE, label_columns=LABEL_COLUMNS):
+    '''
+    Converts messages into a lean pandas dataframe holding only what is needed to
+    count them: the msg_id, int64 internal_date, date component and is_<label>
+    columns. Unlike messages_to_dataframe, no payload, header or snippet columns
+    are kept.
+
+    Arguments:
+        messages - a list of messages retrieved from the GMAIL API, or of tuples
+                   returned by project_message
+        tz - the time zone of the date column and its components
+        label_columns - the label ids to add is_<label> columns for. All labels if None.
+                        Defaults to LABEL_COLUMNS.
+
+    Returns:
+        a pandas data frame, None if there are no messages
+    '''
+    msg_id = []
+    internal_date = []
+    label_ids = []
+
+    for m in messages:
+        if type(m) == dict:
+            m = project_message(m)
+        # Skip messages the GMAIL API could not find
+        if type(m) == tuple:
+            msg_id.append(m[0])
+            internal_date.append(m[1])
+            label_ids.append(m[2])
+
+    if not msg_id:
+        return None
+
+    df = pd.DataFrame({'msg_id': msg_id,
+                       'internal_date': np.array(internal_date, dtype=np.int64)})
+    del msg_id, internal_date
+
+    matrix, msg_labels = label_indicator_matrix(label_ids)
+    del label_ids
+    add_label_columns(df, matrix, msg_labels, label_columns)
+    add_date_columns(df, df['internal_date'], tz)
+
+    return df
+
+
 def aggregate_mail_counts(df, by='hour'):
     '''
     Aggregates mail counts hourly or daily.
@@ -215,6 +313,73 @@ def aggregate_mail_counts(df, by='hour'):
         return None
 
 
+def local_time_counts(dates, freq):
+    '''
+    Counts dates by the local wall clock period they fall in
+
+    Arguments:
+        dates - time zone aware dates
+        freq - The length of each period (i.e. 'H' or 'D')
+
+    Returns:
+        a series of counts indexed by the (time zone naive) start of each period
+    '''
+    return pd.DatetimeIndex(dates).tz_localize(None).floor(freq).value_counts()
+
+
+def reindex_local_counts(counts, index):
+    '''
+    Spreads counts returned by local_time_counts over a time zone aware index. During
+    the repeated hour at the end of daylight saving time both index entries receive
+    the combined count of that local hour.
+
+    Arguments:
+        counts - a series of counts returned by local_time_counts
+        index - The time zone aware DatetimeIndex to count messages for
+
+    Returns:
+        a timeseries object containing the counts, zero for empty periods
+    '''
+    filled = counts.reindex(index.tz_localize(None), fill_value=0)
+    return pd.Series(filled.values.astype(np.int64), index=index)
+
+
+def count_by_local_time(df, index, freq):
+    '''
+    Counts the messages that arrived in each period of a time zone aware index.
+    Periods are matched on their local wall clock time.
+
+    Arguments:
+        df - Pandas dataframe
+        index - The time zone aware DatetimeIndex to count messages for
+        freq - The length of each period (i.e. 'H' or 'D')
+
+    Returns:
+        a timeseries object containing the counts, zero for empty periods
+    '''
+    dates = df.loc[df['msg_id'].notnull(), 'date']
+    return reindex_local_counts(local_time_counts(dates, freq), index)
+
+
+def hourly_index(first, last):
+    '''
+    Returns the hourly index running from the hour of the first date to the last
+    hour of the day of the last date, in the time zone of the dates
+    '''
+    return pd.date_range(first.floor('H'), last.replace(hour=23, minute=0, second=0, microsecond=0),
+                         freq='H', tz=first.tz)
+
+
+def daily_index(first, last):
+    '''
+    Returns the daily index running from the day of the first date to the day of
+    the last date, in the time zone of the dates
+    '''
+    # Normalized before date_range, which fails on the day daylight saving time
+    # ends when it normalizes a time after the repeated hour itself
+    return pd.date_range(first.normalize(), last.normalize(), freq='D', tz=first.tz)
+
+
 def aggregate_hourly(df):
     '''
     Aggregates mail counts hourly.
@@ -225,20 +390,7 @@ def aggregate_hourly(df):
     Returns:
         a timeseries object containing the aggregated counts
     '''
-    hourly_agg = df[['year', 'month', 'day', 'hour', 'msg_id']
-                    ].groupby(['year', 'month', 'day', 'hour']).count()
-
-    hourly_index = pd.date_range(df['date'].min().floor('H'), df['date'].max().replace(hour=23, minute=0, second=0, microsecond=0),
-                                 freq='H', tz=timezone('US/Pacific'))
-    hourly_counts = pd.Series(0, index=hourly_index)
-
-    for dt in hourly_index:
-        try:
-            hourly_counts[dt] = hourly_agg.ix[
-                dt.year, dt.month, dt.day, dt.hour]
-        except:
-            hourly_counts[dt] = 0
-    return hourly_counts
+    return count_by_local_time(df, hourly_index(df['date'].min(), df['date'].max()), 'H')
 
 
 def aggregate_daily(df):
@@ -251,19 +403,67 @@ def aggregate_daily(df):
     Returns:
         a timeseries object containing the aggregated counts
     '''
-    daily_agg = df[['year', 'month', 'day', 'msg_id']
-                   ].groupby(['year', 'month', 'day']).count()
+    return count_by_local_time(df, daily_index(df['date'].min(), df['date'].max()), 'D')
 
-    daily_index = pd.date_range(df['date'].min(), df['date'].max(
-    ), freq='D', normalize=True, tz=timezone('US/Pacific'))
-    daily_counts = pd.Series(0, index=daily_index)
 
-    for dt in daily_index:
-        try:
-            daily_counts[dt] = daily_agg.ix[dt.year, dt.month, dt.day]
-        except:
-            daily_counts[dt] = 0
-    return daily_counts
+def aggregate_message_chunks(chunks, tz=TIMEZONE, exclude_labels=('SENT', 'CHAT'),
+                             before=None):
+    '''
+    Folds chunks of messages into running daily and hourly mail counts, so that a
+    mailbox can be counted as it is collected without holding all of its messages
+    in memory. The result is the same as aggregate_daily and aggregate_hourly of
+    all the messages at once.
+
+    Arguments:
+        chunks - an iterable of lists of messages retrieved from the GMAIL API, or of
+                 tuples returned by project_message
+        tz - the time zone to count the messages in
+        exclude_labels - messages with any of these labels are not counted
+        before - If specified, only messages that arrived before this date are
+                 counted, so that the period it falls in is not counted partly
+
+    Returns:
+        A tuple containing the daily and hourly counts, None for both if there was
+        nothing to count
+    '''
+    exclude_labels = list(exclude_labels)
+    daily = pd.Series([], dtype=np.int64)
+    hourly = pd.Series([], dtype=np.int64)
+    date_range = None
+
+    for chunk in chunks:
+        df = messages_to_counts_dataframe(chunk, tz, exclude_labels)
+        if df is None:
+            continue
+        for label in exclude_labels:
+            if 'is_' + label.lower() in df:
+                df = df[~df['is_' + label.lower()]]
+        if before is not None:
+            df = df[df['date'] < before]
+        if not len(df):
+            continue
+
+        daily = daily.add(local_time_counts(df['date'], 'D'), fill_value=0)
+        hourly = hourly.add(local_time_counts(df['date'], 'H'), fill_value=0)
+        date_range = _extend_range(date_range, df['date'])
+
+    daily_counts = None
+    hourly_counts = None
+    if date_range:
+        daily_counts = reindex_local_counts(daily, daily_index(*date_range))
+        hourly_counts = reindex_local_counts(hourly, hourly_index(*date_range))
+
+    return (daily_counts, hourly_counts)
+
+
+def _extend_range(date_range, dates):
+    '''
+    Returns the (first, last) date range extended to cover dates
+    '''
+    first, last = dates.min(), dates.max()
+    if date_range is not None:
+        first, last = min(first, date_range[0]), max(last, date_range[1])
+    return (first, last)
 
 
 def fill_dates_between(ts, dt, by='hour'):
@@ -304,5 +504,5 @@ if __name__ == '__main__':
     with open('emails.pkl', 'r') as f:
         messages = pickle.load(f)
 
-    df = messages_to_dataframe(messages)
+    df = messages_to_dataframe(messages, label_columns=None)
     df.to_csv('gmail_messages.csv', encoding='utf-8')
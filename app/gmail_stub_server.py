@@ -0,0 +1,467 @@
+'''
+Gmail Stub Server Module
+
+This module defines a local stand-in for the parts of the GMAIL API used by
+gmail_data_collection: listing message ids, getting messages (individually or
+in batch requests) with the format and fields parameters, the user profile
+and the messageAdded history. It serves a synthetic mailbox so that
+collection can be exercised and benchmarked offline, and can slow down
+requests or fail some of the calls in batch requests to exercise retries.
+
+Author: Daryle J. Serrant
+'''
+
+import json
+import re
+import threading
+import time
+import urlparse
+import numpy as np
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from datetime import datetime
+from email.parser import Parser
+from httplib2 import Http
+from apiclient.discovery import build_from_document
+
+LABELS = ['INBOX', 'UNREAD', 'IMPORTANT', 'SENT', 'CHAT', 'CATEGORY_PERSONAL',
+          'CATEGORY_SOCIAL', 'CATEGORY_PROMOTIONS', 'CATEGORY_UPDATES']
+
+DEFAULT_PAGE_SIZE = 100
+FIRST_HISTORY_ID = 1000
+MAX_PAGE_SIZE = 500
+
+
+def _method(method_id, path, query=(), path_params=()):
+    '''
+    Builds a discovery document description of a GET method
+    '''
+    parameters = {'userId': {'type': 'string', 'required': True,
+                             'location': 'path'}}
+    for name in path_params:
+        parameters[name] = {'type': 'string', 'required': True,
+                            'location': 'path'}
+    for name in query:
+        parameters[name] = {'type': 'string', 'location': 'query'}
+    return {'id': method_id, 'path': path, 'httpMethod': 'GET',
+            'parameters': parameters, 'response': {'$ref': 'Response'},
+            'parameterOrder': ['userId'] + list(path_params)}
+
+
+def discovery_document(root_url):
+    '''
+    Returns a minimal GMAIL API discovery document pointing at root_url
+    '''
+    listing = ('q', 'pageToken', 'maxResults')
+    return {
+        'kind': 'discovery#restDescription',
+        'discoveryVersion': 'v1',
+        'id': 'gmail:v1',
+        'name': 'gmail',
+        'version': 'v1',
+        'protocol': 'rest',
+        'rootUrl': root_url,
+        'servicePath': 'gmail/v1/users/',
+        'batchPath': 'batch/gmail/v1',
+        'parameters': {
+            'alt': {'type': 'string', 'default': 'json', 'location': 'query'},
+            'fields': {'type': 'string', 'location': 'query'},
+        },
+        'schemas': {'Response': {'id': 'Response', 'type': 'object'}},
+        'resources': {'users': {'resources': {
+            'messages': {'methods': {
+                'list': _method('gmail.users.messages.list',
+                                '{userId}/messages', listing),
+                'get': _method('gmail.users.messages.get',
+                               '{userId}/messages/{id}', ('format',), ('id',)),
+            }},
+            'threads': {'methods': {
+                'list': _method('gmail.users.threads.list',
+                                '{userId}/threads', listing),
+            }},
+            'history': {'methods': {
+                'list': _method('gmail.users.history.list', '{userId}/history',
+                                ('startHistoryId', 'historyTypes',
+                                 'pageToken', 'maxResults')),
+            }},
+        }, 'methods': {
+            'getProfile': _method('gmail.users.getProfile', '{userId}/profile'),
+        }}},
+    }
+
+
+def _split_fields(fields):
+    '''
+    Splits a fields mask on the commas that are not inside parentheses
+    '''
+    parts = []
+    depth = start = 0
+    for i, c in enumerate(fields):
+        depth += {'(': 1, ')': -1}.get(c, 0)
+        if c == ',' and depth == 0:
+            parts.append(fields[start:i])
+            start = i + 1
+    parts.append(fields[start:])
+    return [p.strip() for p in parts if p.strip()]
+
+
+def parse_fields(fields):
+    '''
+    Parses a partial response fields mask such as "id,payload/headers,a(b,c)"
+    into a nested dictionary. A value of None selects the whole field.
+    '''
+    mask = {}
+    for part in _split_fields(fields):
+        sub = None
+        if '(' in part:
+            part, sub = part[:part.index('(')], parse_fields(
+                part[part.index('(') + 1:part.rindex(')')])
+        keys = part.split('/')
+        node = mask
+        for key in keys[:-1]:
+            if key in node and node[key] is None:
+                break
+            node = node.setdefault(key, {})
+        else:
+            last = keys[-1]
+            if sub is None or (last in node and node[last] is None):
+                node[last] = None
+            else:
+                node.setdefault(last, {}).update(sub)
+    return mask
+
+
+def apply_fields(obj, mask):
+    '''
+    Keeps only the parts of a response selected by a parsed fields mask
+    '''
+    if mask is None:
+        return obj
+    if isinstance(obj, list):
+        return [apply_fields(o, mask) for o in obj]
+    if not isinstance(obj, dict):
+        return obj
+    return dict((k, apply_fields(obj[k], m)) for k, m in mask.items()
+                if k in obj)
+
+
+class StubMailbox(object):
+    '''
+    A synthetic mailbox. Message k has the id "%016x" % k, arrives at a random
+    time between start and end and carries a few random labels.
+    '''
+
+    def __init__(self, messages=1000, start=datetime(2015, 1, 1),
+                 end=datetime(2017, 1, 1), seed=0):
+        '''
+        Instantiate a new instance of the StubMailbox class
+
+        Arguments:
+          messages - The number of messages in the mailbox
+          start - The earliest arrival time (naive UTC datetime)
+          end - The latest arrival time (naive UTC datetime)
+          seed - Random seed
+        '''
+        self.rng = np.random.RandomState(seed)
+        self.dates = np.zeros(0, dtype=np.int64)
+        self.labels = []
+        # History ids older than this have expired
+        self.history_floor = FIRST_HISTORY_ID
+        self.add_messages(messages, start, end)
+
+    def add_messages(self, count, start, end):
+        '''
+        Adds messages arriving at random times between start and end, which
+        should not be earlier than the newest message in the mailbox
+        '''
+        epoch = datetime(1970, 1, 1)
+        lo = int((start - epoch).total_seconds() * 1000)
+        hi = int((end - epoch).total_seconds() * 1000)
+        # Oldest first, so message ids and history ids grow with arrival time
+        dates = np.sort(self.rng.randint(lo, hi, count).astype(np.int64))
+        self.dates = np.concatenate([self.dates, dates])
+        self.labels.extend(
+            [LABELS[j] for j in sorted(self.rng.choice(len(LABELS), 3, replace=False))]
+            for _ in range(count))
+
+    def message_id(self, k):
+        return '%016x' % k
+
+    def history_id(self, k):
+        return FIRST_HISTORY_ID + k
+
+    def find(self, msg_id):
+        '''
+        Returns the index of a message id, None if there is no such message
+        '''
+        try:
+            k = int(msg_id, 16)
+        except ValueError:
+            return None
+        return k if 0 <= k < len(self.dates) else None
+
+    def profile(self):
+        return {'emailAddress': 'stub@example.com',
+                'messagesTotal': len(self.dates),
+                'threadsTotal': len(self.dates),
+                'historyId': str(self.history_id(len(self.dates) - 1))}
+
+    def query(self, q):
+        '''
+        Returns the indexes of the messages matching a "before:Y/m/d" and/or
+        "after:Y/m/d" search query, newest first like the GMAIL API lists them
+        '''
+        keep = np.ones(len(self.dates), dtype=bool)
+        epoch = datetime(1970, 1, 1)
+        for op, value in re.findall(r'(before|after):(\d{4}/\d{1,2}/\d{1,2})', q or ''):
+            ms = (datetime.strptime(value, '%Y/%m/%d') -
+                  epoch).total_seconds() * 1000
+            keep &= (self.dates < ms) if op == 'before' else (self.dates >= ms)
+        return np.nonzero(keep)[0][::-1]
+
+    def message(self, k, format='full'):
+        '''
+        Returns message k as the GMAIL API would for the given format
+        '''
+        msg = {'id': self.message_id(k), 'threadId': self.message_id(k),
+               'labelIds': self.labels[k], 'snippet': 'Synthetic message %d' % k,
+               'historyId': str(self.history_id(k)),
+               'internalDate': str(self.dates[k]),
+               'sizeEstimate': 4096 + (k % 7) * 512}
+        if format in ('full', 'metadata'):
+            headers = [{'name': name, 'value': '%s of message %d' % (name, k)}
+                       for name in ['Delivered-To', 'Received', 'Return-Path',
+                                    'Received-SPF', 'Authentication-Results',
+                                    'DKIM-Signature', 'From', 'To', 'Subject',
+                                    'Date', 'Message-ID', 'MIME-Version',
+                                    'Content-Type', 'List-Unsubscribe']]
+            msg['payload'] = {'partId': '', 'mimeType': 'multipart/alternative',
+                              'filename': '', 'headers': headers,
+                              'body': {'size': 0}}
+            if format == 'full':
+                body = 'PGh0bWw-' + 'U3ludGhldGljIG1lc3NhZ2U' * (40 + k % 40)
+                msg['payload']['parts'] = [
+                    {'partId': str(i), 'mimeType': mime, 'filename': '',
+                     'headers': [{'name': 'Content-Type', 'value': mime}],
+                     'body': {'size': len(body), 'data': body}}
+                    for i, mime in enumerate(['text/plain', 'text/html'])]
+        elif format == 'raw':
+            msg['raw'] = 'U3ludGhldGljIG1lc3NhZ2U' * 100
+        return msg
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    '''
+    Request handler serving a StubMailbox
+    '''
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def dispatch(self, path):
+        '''
+        Returns the (status, body dict) of a GMAIL API call
+        '''
+        url = urlparse.urlparse(path)
+        args = dict((k, v[-1]) for k, v in urlparse.parse_qs(url.query).items())
+        mailbox = self.server.mailbox
+        parts = url.path.strip('/').split('/')
+
+        if parts[:3] != ['gmail', 'v1', 'users'] or len(parts) < 5:
+            return 404, {'error': {'code': 404, 'message': 'Not Found'}}
+
+        resource = parts[4]
+        if resource in ('messages', 'threads') and len(parts) == 5:
+            body = self.list_page(resource, mailbox.query(args.get('q')), args)
+        elif resource == 'messages' and len(parts) == 6:
+            k = mailbox.find(parts[5])
+            if k is None:
+                return 404, {'error': {'code': 404, 'message': 'Not Found'}}
+            body = mailbox.message(k, args.get('format', 'full'))
+        elif resource == 'profile':
+            body = mailbox.profile()
+        elif resource == 'history':
+            start = int(args['startHistoryId'])
+            if start < mailbox.history_floor:
+                return 404, {'error': {'code': 404, 'message': 'Not Found'}}
+            body = self.history_page(start, args)
+        else:
+            return 404, {'error': {'code': 404, 'message': 'Not Found'}}
+
+        if 'fields' in args:
+            body = apply_fields(body, parse_fields(args['fields']))
+        return 200, body
+
+    def list_page(self, resource, matches, args):
+        '''
+        Returns one page of a messages or threads list
+        '''
+        mailbox = self.server.mailbox
+        size = min(int(args.get('maxResults', DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE)
+        offset = int(args.get('pageToken', 0))
+        page = matches[offset:offset + size]
+        items = [{'id': mailbox.message_id(k), 'threadId': mailbox.message_id(k)}
+                 for k in page]
+        if resource == 'threads':
+            for item, k in zip(items, page):
+                del item['threadId']
+                item['snippet'] = 'Synthetic message %d' % k
+                item['historyId'] = str(mailbox.history_id(k))
+        body = {'resultSizeEstimate': len(page)}
+        if items:
+            body[resource] = items
+        if offset + size < len(matches):
+            body['nextPageToken'] = str(offset + size)
+        return body
+
+    def history_page(self, start, args):
+        '''
+        Returns one page of the messageAdded history records after start
+        '''
+        mailbox = self.server.mailbox
+        size = min(int(args.get('maxResults', DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE)
+        first = max(start - FIRST_HISTORY_ID + 1, 0)
+        offset = int(args.get('pageToken', first))
+        page = range(offset, min(offset + size, len(mailbox.dates)))
+        body = {'historyId': mailbox.profile()['historyId']}
+        if page:
+            body['history'] = [
+                {'id': str(mailbox.history_id(k)),
+                 'messages': [{'id': mailbox.message_id(k),
+                               'threadId': mailbox.message_id(k)}],
+                 'messagesAdded': [{'message': {
+                     'id': mailbox.message_id(k),
+                     'threadId': mailbox.message_id(k),
+                     'labelIds': mailbox.labels[k]}}]}
+                for k in page]
+        if offset + size < len(mailbox.dates):
+            body['nextPageToken'] = str(offset + size)
+        return body
+
+    def send(self, status, content, content_type='application/json'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+        self.server.count(len(content))
+
+    def do_GET(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        status, body = self.dispatch(self.path)
+        self.send(status, json.dumps(body))
+
+    def do_POST(self):
+        content = self.rfile.read(int(self.headers.getheader('Content-Length')))
+        if not self.path.startswith('/batch/'):
+            return self.send(404, json.dumps({'error': {'code': 404}}))
+
+        request = Parser().parsestr('Content-Type: %s\r\n\r\n%s' % (
+            self.headers.getheader('Content-Type'), content))
+        boundary = 'stub_batch_boundary'
+        out = []
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        for part in request.get_payload():
+            line = part.get_payload().lstrip().split('\n', 1)[0].split()
+            if self.server.inject_error():
+                status = self.server.error_status
+                body = {'error': {'code': status, 'message': 'Injected error',
+                                  'errors': [{'reason': 'rateLimitExceeded'
+                                              if status == 429 else 'backendError'}]}}
+            else:
+                status, body = self.dispatch(line[1])
+            out.append('--%s\r\nContent-Type: application/http\r\n'
+                       'Content-ID: <response-%s\r\n\r\n'
+                       'HTTP/1.1 %d %s\r\nContent-Type: application/json\r\n\r\n'
+                       '%s\r\n' % (boundary, part['Content-ID'].lstrip('<'),
+                                   status, self.responses.get(status, ('Error',))[0],
+                                   json.dumps(body)))
+        out.append('--%s--' % boundary)
+        self.send(200, ''.join(out),
+                  'multipart/mixed; boundary=%s' % boundary)
+
+
+class StubGmailServer(ThreadingMixIn, HTTPServer):
+    '''
+    A threaded HTTP server standing in for the GMAIL API. It counts the number
+    of responses and response bytes it sends, and can fail a fraction of the
+    calls in batch requests to exercise retries.
+    '''
+    daemon_threads = True
+
+    def __init__(self, mailbox=None, port=0, error_rate=0.0, error_status=429,
+                 latency=0.0, seed=0):
+        '''
+        Instantiate a new instance of the StubGmailServer class
+
+        Arguments:
+          mailbox - The StubMailbox to serve. A 1000 message mailbox if None.
+          port - The port to listen on. Any free port if 0.
+          error_rate - The fraction of calls in batch requests that fail
+          error_status - The HTTP status of the failed calls
+          latency - Seconds to wait before answering each request
+          seed - Random seed for the injected errors
+        '''
+        HTTPServer.__init__(self, ('127.0.0.1', port), StubHandler)
+        self.mailbox = mailbox or StubMailbox()
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.latency = latency
+        self.rng = np.random.RandomState(seed)
+        self.lock = threading.Lock()
+        self.responses = 0
+        self.bytes_sent = 0
+        self.errors = 0
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/' % self.server_address[1]
+
+    def count(self, size):
+        with self.lock:
+            self.responses += 1
+            self.bytes_sent += size
+
+    def reset_counters(self):
+        with self.lock:
+            self.responses = 0
+            self.bytes_sent = 0
+            self.errors = 0
+
+    def inject_error(self):
+        '''
+        Returns True if the next call in a batch request should fail
+        '''
+        with self.lock:
+            failed = self.rng.rand() < self.error_rate
+            self.errors += failed
+        return failed
+
+    def start(self):
+        '''
+        Serves requests on a background thread
+        '''
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def create_service(self, http=None):
+        '''
+        Creates a GMAIL API service object that talks to this server
+        '''
+        return build_from_document(discovery_document(self.url),
+                                   http=http or Http())
+
+
+if __name__ == '__main__':
+    server = StubGmailServer(StubMailbox(messages=10000), port=8080)
+    print 'Serving a 10000 message stub mailbox at {}'.format(server.url)
+    server.serve_forever()
@@ -10,11 +10,12 @@ Author: Daryle J. Serrant
 import pandas as pd
 import numpy as np
 import cPickle as pickle
-from statsmodels.tsa.statespace.sarimax import SARIMAX, SARIMAXResults
 import holtwinters as hw
+import model_artifact
 from datetime import datetime, timedelta
 import dateutil.relativedelta as relativedelta
 import math
+import os
 
 
 class Forecaster(object):
@@ -50,18 +51,57 @@ class Forecaster(object):
         '''
         pass
 
+    def save_artifact(self, filepath):
+        '''
+        Saves the parameters and state the model forecasts from as a compact
+        model artifact
+
+        Arguments:
+          filepath - Path to the artifact file
+        '''
+        pass
+
 
 class DailyForecaster(Forecaster):
     '''
-    A Forecaster subclass that forecasts the daily email traffic using the SARIMAXResults
-    class from statsmodels
+    A Forecaster subclass that forecasts the daily email traffic using a seasonal
+    arima model fit by the SARIMAXResults class from statsmodels. Forecasts are
+    produced from the state space matrices of the model and its terminal state,
+    so statsmodels is only imported to load a full model pickle.
     '''
 
     def __init__(self, model=None):
         '''
         Instantiate a new instance of DailyForecaster class
+
+        Arguments:
+          model - A SARIMAXResults object
+        '''
+        self.model = model
+        self.state_space = None
+        self.end = None
+        self.freq = None
+
+        if model is not None:
+            self.update(model)
+
+    def update(self, model):
+        '''
+        Takes the state space matrices, the predicted state after the last
+        observation and the last date of the data from a fit model
+
+        Arguments:
+          model - A SARIMAXResults object
         '''
+        fr = model.filter_results
         self.model = model
+        self.state_space = {'design': np.array(fr.design[:, :, -1]),
+                            'obs_intercept': np.array(fr.obs_intercept[:, -1]),
+                            'transition': np.array(fr.transition[:, :, -1]),
+                            'state_intercept': np.array(fr.state_intercept[:, -1]),
+                            'state': np.array(fr.predicted_state[:, -1])}
+        self.end = model.fittedvalues.index[-1]
+        self.freq = model.fittedvalues.index.freqstr
 
     def forecast(self, fc_steps):
         '''
@@ -74,24 +114,54 @@ class DailyForecaster(Forecaster):
         Returns:
           A pandas series containing the forecasts
         '''
-        fc = self.model.forecast(steps=fc_steps).apply(
-            math.ceil).astype(np.int32)
+        ss = self.state_space
+        state = ss['state']
+        results = np.empty(fc_steps)
+        for i in range(fc_steps):
+            results[i] = (ss['obs_intercept'] + ss['design'].dot(state))[0]
+            state = ss['state_intercept'] + ss['transition'].dot(state)
+
+        date_index = pd.date_range(self.end, periods=fc_steps + 1, freq=self.freq)
+        fc = pd.Series(np.ceil(results), index=date_index[1:]).astype(np.int32)
         return fc.apply(lambda x: 0 if x < 0 else x)
 
     def load(self, filepath):
         '''
-        Loads a model from a pickle file
+        Loads a model from a model artifact or a pickle file
 
         Arguments:
-          filepath - Path to the pickle file containing the model
+          filepath - Path to the file containing the model
+        '''
+        if model_artifact.is_artifact(filepath):
+            artifact = model_artifact.load_artifact(filepath)
+            self.model = None
+            self.state_space = artifact['state_space']
+            self.end = artifact['end']
+            self.freq = artifact['freq']
+        else:
+            from statsmodels.tsa.statespace.sarimax import SARIMAXResults
+            self.update(SARIMAXResults.load(filepath))
+
+    def save_artifact(self, filepath):
+        '''
+        Saves the state space matrices, terminal state and last date of the model
+        as a compact model artifact
+
+        Arguments:
+          filepath - Path to the artifact file
         '''
-        self.model = SARIMAXResults.load(filepath)
+        model_artifact.save_artifact(filepath, {'kind': 'sarima',
+                                                'state_space': self.state_space,
+                                                'end': self.end,
+                                                'freq': self.freq})
 
 
 class HourlyForecaster(Forecaster):
     '''
     A Forecaster subclass that forecasts the hourly email traffic using the holtwinters
-    additive exponential smoothing algorithm.
+    additive exponential smoothing algorithm. Rather than the training data, the
+    forecaster keeps the terminal level, trend and seasonal state of the model, so
+    forecasting and folding in new observations never replay the history.
     '''
 
     def __init__(self, alpha=None, beta=None, gamma=None, period=None, ts=None):
@@ -109,11 +179,16 @@ class HourlyForecaster(Forecaster):
         self.beta = beta
         self.gamma = gamma
         self.m = period
-        self.ts = ts
+        self.state = None
+        self.end = None
+
+        if ts is not None:
+            self.update(alpha, beta, gamma, ts)
 
     def update(self, alpha, beta, gamma, ts):
         '''
-        Updates the DailyForecaster model
+        Updates the HourlyForecaster model, smoothing the time series once to
+        obtain the terminal state
 
         Arguments:
           alpha - The new alpha parameter
@@ -124,22 +199,65 @@ class HourlyForecaster(Forecaster):
         self.alpha = alpha
         self.beta = beta
         self.gamma = gamma
-        self.ts = ts
+        self.state = hw.additive_state(ts.tolist(), self.m, alpha, beta, gamma)
+        self.end = ts.index.max()
 
     def load(self, filepath):
         '''
-        Loads a model from a pickle file
+        Loads a model from a model artifact or a pickle file. Pickles written
+        before the model state was stored hold (alpha, beta, gamma, period, ts);
+        the state is computed from the time series for those.
 
         Arguments:
-          filepath - Path to the pickle file containing the model
+          filepath - Path to the file containing the model
         '''
+        if model_artifact.is_artifact(filepath):
+            artifact = model_artifact.load_artifact(filepath)
+            self.alpha = artifact['alpha']
+            self.beta = artifact['beta']
+            self.gamma = artifact['gamma']
+            self.m = artifact['period']
+            self.state = artifact['state']
+            self.end = artifact['end']
+            return
+
         with open(filepath, 'r') as f:
-            data = pickle.load(f)
+            self.set_model(pickle.load(f))
+
+    def set_model(self, data):
+        '''
+        Takes the parameters and state of a model tuple returned by
+        gmail_data_modeling.build_hourly_holt_winters_model
+
+        Arguments:
+          data - The model tuple
+        '''
+        self.m = data[3]
+
+        if len(data) == 5:
+            self.update(data[0], data[1], data[2], data[4])
+        else:
             self.alpha = data[0]
             self.beta = data[1]
             self.gamma = data[2]
-            self.m = data[3]
-            self.ts = data[4]
+            self.state = (data[4], data[5], data[6])
+            self.end = data[7]
+
+    def save_artifact(self, filepath):
+        '''
+        Saves the smoothing parameters, terminal state and last date of the model
+        as a compact model artifact
+
+        Arguments:
+          filepath - Path to the artifact file
+        '''
+        model_artifact.save_artifact(filepath, {'kind': 'holtwinters',
+                                                'alpha': self.alpha,
+                                                'beta': self.beta,
+                                                'gamma': self.gamma,
+                                                'period': self.m,
+                                                'state': self.state,
+                                                'end': self.end})
 
     def forecast(self, fc_steps):
         '''
@@ -152,11 +270,32 @@ class HourlyForecaster(Forecaster):
         Returns:
           A pandas series containing the forecasts
         '''
-        results = hw.additive(self.ts.tolist(), self.m,
-                              fc_steps, self.alpha, self.beta, self.gamma)
+        results = hw.additive_forecast(self.state, fc_steps, self.alpha,
+                                       self.beta, self.gamma)
         fc = map((lambda x: 0 if math.ceil(x) <
-                  0 else math.ceil(x)), results[0])
-        start = self.ts.index.max()
+                  0 else math.ceil(x)), results)
+        start = self.end
         end = start + relativedelta.relativedelta(hours=fc_steps)
         date_index = pd.date_range(start, end, freq='H')
         return pd.Series(fc, index=date_index[1:])
+
+
+def save_models(weekly_model, hourly_model, directory):
+    '''
+    Saves the full model pickles, which the models are refit from, and the
+    compact model artifacts that the dashboard forecasts from
+
+    Arguments:
+      weekly_model - The SARIMAXResults of the weekly model
+      hourly_model - The model tuple of the hourly model
+      directory - The directory to save the models to
+    '''
+    weekly_model.save(os.path.join(directory, 'weekly_model.pkl'))
+    with open(os.path.join(directory, 'hourly_model.pkl'), 'w') as f:
+        pickle.dump(hourly_model, f)
+
+    DailyForecaster(weekly_model).save_artifact(
+        os.path.join(directory, 'weekly_model.art'))
+    hourly_forecaster = HourlyForecaster()
+    hourly_forecaster.set_model(hourly_model)
+    hourly_forecaster.save_artifact(os.path.join(directory, 'hourly_model.art'))
@@ -32,72 +32,354 @@
 from __future__ import division
 from sys import exit
 from math import sqrt
-from numpy import array
+from numpy import (arange, array, ascontiguousarray, clip, einsum, empty,
+                   errstate, exp, eye, float64, int64, isfinite, log, maximum,
+                   newaxis, ones, sqrt as vsqrt, tile, where, zeros)
 from scipy.optimize import fmin_l_bfgs_b
 
+# The smoothing recursions below are compiled with numba when it is installed.
+# Without numba they run as plain Python over the same float64 buffers, which
+# are handed to the kernels as lists of floats (indexing numpy scalars from
+# Python is slower than indexing a list).
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+def _kernel(func):
+
+    if njit is None:
+        return func
+
+    return njit(cache=True, nogil=True, error_model='numpy')(func)
+
+
+def _buffer(values):
+
+    values = array(values, dtype=float64)
+
+    if njit is None:
+        return values.tolist()
+
+    return values
+
+
+def _forecast_buffer(fc):
+
+    if njit is None:
+        return [0.0] * fc
+
+    return empty(fc, dtype=float64)
+
+
+def _seasonal_start(Y, m, type):
+
+    a = sum(Y[0:m]) / float(m)
+    b = (sum(Y[m:2 * m]) - sum(Y[0:m])) / m ** 2
+
+    if type == 'additive':
+        s = [Y[i] - a for i in range(m)]
+    else:
+        s = [Y[i] / a for i in range(m)]
+
+    return a, b, _buffer(s)
+
+
+@_kernel
+def _linear_kernel(Y, a, b, alpha, beta, out):
+
+    n = len(Y)
+    fc = len(out)
+    sse = 0.0
+
+    for i in range(n + fc):
+
+        if i < n:
+            y = Y[i]
+            e = y - (a + b)
+            sse += e * e
+        else:
+            y = a + b
+            out[i - n] = y
+
+        a_next = alpha * y + (1 - alpha) * (a + b)
+        b = beta * (a_next - a) + (1 - beta) * b
+        a = a_next
+
+    return sse, a, b
+
+
+@_kernel
+def _additive_kernel(Y, s, a, b, alpha, beta, gamma, out):
+
+    n = len(Y)
+    m = len(s)
+    fc = len(out)
+    sse = 0.0
+
+    for i in range(n + fc):
+
+        k = i % m
+        s_i = s[k]
+
+        if i < n:
+            y = Y[i]
+            e = y - (a + b + s_i)
+            sse += e * e
+        else:
+            y = a + b + s_i
+            out[i - n] = y
+
+        a_next = alpha * (y - s_i) + (1 - alpha) * (a + b)
+        b_next = beta * (a_next - a) + (1 - beta) * b
+        s[k] = gamma * (y - a - b) + (1 - gamma) * s_i
+        a = a_next
+        b = b_next
+
+    return sse, a, b
+
+
+@_kernel
+def _multiplicative_kernel(Y, s, a, b, alpha, beta, gamma, out):
+
+    n = len(Y)
+    m = len(s)
+    fc = len(out)
+    sse = 0.0
+
+    for i in range(n + fc):
+
+        k = i % m
+        s_i = s[k]
+
+        if i < n:
+            y = Y[i]
+            e = y - (a + b) * s_i
+            sse += e * e
+        else:
+            y = (a + b) * s_i
+            out[i - n] = y
+
+        a_next = alpha * (y / s_i) + (1 - alpha) * (a + b)
+        b_next = beta * (a_next - a) + (1 - beta) * b
+        s[k] = gamma * (y / (a + b)) + (1 - gamma) * s_i
+        a = a_next
+        b = b_next
+
+    return sse, a, b
+
+
+# The gradient kernels below carry the derivatives of the level, trend and
+# seasonal states with respect to each smoothing parameter alongside the states
+# themselves (forward mode sensitivities), so the SSE and its exact gradient
+# come out of a single pass over the series. ds_a, ds_b and ds_g are zeroed
+# ring buffers for the derivatives of the seasonal terms.
+
+@_kernel
+def _linear_gradient_kernel(Y, a, b, alpha, beta):
+
+    sse = 0.0
+    g_alpha = g_beta = 0.0
+    # d(level) and d(trend) with respect to alpha and beta
+    da_a = da_b = db_a = db_b = 0.0
+
+    for i in range(len(Y)):
+
+        y = Y[i]
+        e = y - (a + b)
+        sse += e * e
+        g_alpha -= 2 * e * (da_a + db_a)
+        g_beta -= 2 * e * (da_b + db_b)
+
+        a_next = alpha * y + (1 - alpha) * (a + b)
+        da_a_next = (1 - alpha) * (da_a + db_a) + y - (a + b)
+        da_b_next = (1 - alpha) * (da_b + db_b)
+
+        b_next = beta * (a_next - a) + (1 - beta) * b
+        db_a = beta * (da_a_next - da_a) + (1 - beta) * db_a
+        db_b = beta * (da_b_next - da_b) + (1 - beta) * db_b + \
+            (a_next - a) - b
+
+        a = a_next
+        b = b_next
+        da_a = da_a_next
+        da_b = da_b_next
+
+    return sse, g_alpha, g_beta
+
+
+@_kernel
+def _additive_gradient_kernel(Y, s, ds_a, ds_b, ds_g, a, b, alpha, beta, gamma):
+
+    m = len(s)
+    sse = 0.0
+    g_alpha = g_beta = g_gamma = 0.0
+    da_a = da_b = da_g = db_a = db_b = db_g = 0.0
+
+    for i in range(len(Y)):
+
+        k = i % m
+        y = Y[i]
+        s_i = s[k]
+        e = y - (a + b + s_i)
+        sse += e * e
+        g_alpha -= 2 * e * (da_a + db_a + ds_a[k])
+        g_beta -= 2 * e * (da_b + db_b + ds_b[k])
+        g_gamma -= 2 * e * (da_g + db_g + ds_g[k])
+
+        a_next = alpha * (y - s_i) + (1 - alpha) * (a + b)
+        da_a_next = -alpha * ds_a[k] + (1 - alpha) * (da_a + db_a) + \
+            (y - s_i) - (a + b)
+        da_b_next = -alpha * ds_b[k] + (1 - alpha) * (da_b + db_b)
+        da_g_next = -alpha * ds_g[k] + (1 - alpha) * (da_g + db_g)
+
+        b_next = beta * (a_next - a) + (1 - beta) * b
+        db_a_next = beta * (da_a_next - da_a) + (1 - beta) * db_a
+        db_b_next = beta * (da_b_next - da_b) + (1 - beta) * db_b + \
+            (a_next - a) - b
+        db_g_next = beta * (da_g_next - da_g) + (1 - beta) * db_g
+
+        s[k] = gamma * (y - a - b) + (1 - gamma) * s_i
+        ds_a[k] = -gamma * (da_a + db_a) + (1 - gamma) * ds_a[k]
+        ds_b[k] = -gamma * (da_b + db_b) + (1 - gamma) * ds_b[k]
+        ds_g[k] = -gamma * (da_g + db_g) + (1 - gamma) * ds_g[k] + \
+            (y - a - b) - s_i
+
+        a = a_next
+        b = b_next
+        da_a, da_b, da_g = da_a_next, da_b_next, da_g_next
+        db_a, db_b, db_g = db_a_next, db_b_next, db_g_next
+
+    return sse, g_alpha, g_beta, g_gamma
+
+
+@_kernel
+def _multiplicative_gradient_kernel(Y, s, ds_a, ds_b, ds_g, a, b, alpha,
+                                    beta, gamma):
+
+    m = len(s)
+    sse = 0.0
+    g_alpha = g_beta = g_gamma = 0.0
+    da_a = da_b = da_g = db_a = db_b = db_g = 0.0
+
+    for i in range(len(Y)):
+
+        k = i % m
+        y = Y[i]
+        s_i = s[k]
+        e = y - (a + b) * s_i
+        sse += e * e
+        g_alpha -= 2 * e * ((da_a + db_a) * s_i + (a + b) * ds_a[k])
+        g_beta -= 2 * e * ((da_b + db_b) * s_i + (a + b) * ds_b[k])
+        g_gamma -= 2 * e * ((da_g + db_g) * s_i + (a + b) * ds_g[k])
+
+        # d(y / s) = -(y / s ** 2) * ds
+        c = -alpha * y / (s_i * s_i)
+        a_next = alpha * (y / s_i) + (1 - alpha) * (a + b)
+        da_a_next = c * ds_a[k] + (1 - alpha) * (da_a + db_a) + \
+            y / s_i - (a + b)
+        da_b_next = c * ds_b[k] + (1 - alpha) * (da_b + db_b)
+        da_g_next = c * ds_g[k] + (1 - alpha) * (da_g + db_g)
+
+        b_next = beta * (a_next - a) + (1 - beta) * b
+        db_a_next = beta * (da_a_next - da_a) + (1 - beta) * db_a
+        db_b_next = beta * (da_b_next - da_b) + (1 - beta) * db_b + \
+            (a_next - a) - b
+        db_g_next = beta * (da_g_next - da_g) + (1 - beta) * db_g
+
+        # d(y / (a + b)) = -(y / (a + b) ** 2) * (da + db)
+        c = -gamma * y / ((a + b) * (a + b))
+        s[k] = gamma * (y / (a + b)) + (1 - gamma) * s_i
+        ds_a[k] = c * (da_a + db_a) + (1 - gamma) * ds_a[k]
+        ds_b[k] = c * (da_b + db_b) + (1 - gamma) * ds_b[k]
+        ds_g[k] = c * (da_g + db_g) + (1 - gamma) * ds_g[k] + \
+            y / (a + b) - s_i
+
+        a = a_next
+        b = b_next
+        da_a, da_b, da_g = da_a_next, da_b_next, da_g_next
+        db_a, db_b, db_g = db_a_next, db_b_next, db_g_next
+
+    return sse, g_alpha, g_beta, g_gamma
+
 
 def RMSE(params, *args):
 
     Y = args[0]
     type = args[1]
-    rmse = 0
+    out = _forecast_buffer(0)
 
     if type == 'linear':
 
         alpha, beta = params
-        a = [Y[0]]
-        b = [Y[1] - Y[0]]
-        y = [a[0] + b[0]]
+        sse = _linear_kernel(Y, Y[0], Y[1] - Y[0], alpha, beta, out)[0]
+
+    elif type == 'additive' or type == 'multiplicative':
 
-        for i in range(len(Y)):
+        alpha, beta, gamma = params
+        a, b, s = _seasonal_start(Y, args[2], type)
 
-            a.append(alpha * Y[i] + (1 - alpha) * (a[i] + b[i]))
-            b.append(beta * (a[i + 1] - a[i]) + (1 - beta) * b[i])
-            y.append(a[i + 1] + b[i + 1])
+        if type == 'additive':
+            sse = _additive_kernel(Y, s, a, b, alpha, beta, gamma, out)[0]
+        else:
+            sse = _multiplicative_kernel(
+                Y, s, a, b, alpha, beta, gamma, out)[0]
 
     else:
 
-        alpha, beta, gamma = params
-        m = args[2]
-        a = [sum(Y[0:m]) / float(m)]
-        b = [(sum(Y[m:2 * m]) - sum(Y[0:m])) / m ** 2]
+        exit('Type must be either linear, additive or multiplicative')
 
-        if type == 'additive':
+    rmse = sqrt(sse / len(Y))
 
-            s = [Y[i] - a[0] for i in range(m)]
-            y = [a[0] + b[0] + s[0]]
+    return rmse
 
-            for i in range(len(Y)):
 
-                a.append(alpha * (Y[i] - s[i]) + (1 - alpha) * (a[i] + b[i]))
-                b.append(beta * (a[i + 1] - a[i]) + (1 - beta) * b[i])
-                s.append(gamma * (Y[i] - a[i] - b[i]) + (1 - gamma) * s[i])
-                y.append(a[i + 1] + b[i + 1] + s[i + 1])
+def RMSE_gradient(params, *args):
 
-        elif type == 'multiplicative':
+    Y = args[0]
+    type = args[1]
 
-            s = [Y[i] / a[0] for i in range(m)]
-            y = [(a[0] + b[0]) * s[0]]
+    if type == 'linear':
 
-            for i in range(len(Y)):
+        alpha, beta = [float(p) for p in params]
+        result = _linear_gradient_kernel(Y, Y[0], Y[1] - Y[0], alpha, beta)
 
-                a.append(alpha * (Y[i] / s[i]) + (1 - alpha) * (a[i] + b[i]))
-                b.append(beta * (a[i + 1] - a[i]) + (1 - beta) * b[i])
-                s.append(gamma * (Y[i] / (a[i] + b[i])) + (1 - gamma) * s[i])
-                y.append((a[i + 1] + b[i + 1]) * s[i + 1])
+    elif type == 'additive' or type == 'multiplicative':
+
+        alpha, beta, gamma = params
+        m = args[2]
+        a, b, s = _seasonal_start(Y, m, type)
+        ds_a, ds_b, ds_g = [_buffer([0.0] * m) for i in range(3)]
 
+        if type == 'additive':
+            # No divisions in the additive recursion, so plain floats are safe
+            # (and much faster than numpy scalars without numba).
+            alpha, beta, gamma = float(alpha), float(beta), float(gamma)
+            kernel = _additive_gradient_kernel
         else:
+            kernel = _multiplicative_gradient_kernel
+
+        result = kernel(Y, s, ds_a, ds_b, ds_g, a, b, alpha, beta, gamma)
 
-            exit('Type must be either linear, additive or multiplicative')
+    else:
 
-    rmse = sqrt(sum([(m - n) ** 2 for m, n in zip(Y, y[:-1])]) / len(Y))
+        exit('Type must be either linear, additive or multiplicative')
 
-    return rmse
+    rmse = sqrt(result[0] / len(Y))
+
+    # d(rmse) = d(sse) / (2 * n * rmse)
+    if rmse == 0:
+        gradient = array(result[1:]) * 0.0
+    else:
+        gradient = array(result[1:]) / (2 * len(Y) * rmse)
+
+    return rmse, gradient
 
 
 def linear(x, fc, alpha=None, beta=None):
 
-    Y = x[:]
+    Y = _buffer(x)
 
     if (alpha == None or beta == None):
 
@@ -105,97 +387,336 @@ def linear(x, fc, alpha=None, beta=None):
         boundaries = [(0, 1), (0, 1)]
         type = 'linear'
 
-        parameters = fmin_l_bfgs_b(RMSE, x0=initial_values, args=(
-            Y, type), bounds=boundaries, approx_grad=True)
+        parameters = fmin_l_bfgs_b(RMSE_gradient, x0=initial_values, args=(
+            Y, type), bounds=boundaries)
         alpha, beta = parameters[0]
 
-    a = [Y[0]]
-    b = [Y[1] - Y[0]]
-    y = [a[0] + b[0]]
-    rmse = 0
+    out = _forecast_buffer(fc)
+    sse = _linear_kernel(Y, Y[0], Y[1] - Y[0], alpha, beta, out)[0]
+    rmse = sqrt(sse / len(Y))
 
-    for i in range(len(Y) + fc):
+    return list(out), alpha, beta, rmse
 
-        if i == len(Y):
-            Y.append(a[-1] + b[-1])
 
-        a.append(alpha * Y[i] + (1 - alpha) * (a[i] + b[i]))
-        b.append(beta * (a[i + 1] - a[i]) + (1 - beta) * b[i])
-        y.append(a[i + 1] + b[i + 1])
+def additive(x, m, fc, alpha=None, beta=None, gamma=None):
+
+    Y = _buffer(x)
 
-    rmse = sqrt(
-        sum([(m - n) ** 2 for m, n in zip(Y[:-fc], y[:-fc - 1])]) / len(Y[:-fc]))
+    if (alpha == None or beta == None or gamma == None):
 
-    return Y[-fc:], alpha, beta, rmse
+        initial_values = array([0.3, 0.1, 0.1])
+        boundaries = [(0, 1), (0, 1), (0, 1)]
+        type = 'additive'
 
+        parameters = fmin_l_bfgs_b(RMSE_gradient, x0=initial_values, args=(
+            Y, type, m), bounds=boundaries)
+        alpha, beta, gamma = parameters[0]
 
-def additive(x, m, fc, alpha=None, beta=None, gamma=None):
+    a, b, s = _seasonal_start(Y, m, 'additive')
+    out = _forecast_buffer(fc)
+    sse = _additive_kernel(Y, s, a, b, alpha, beta, gamma, out)[0]
+    rmse = sqrt(sse / len(Y))
 
-    Y = x[:]
+    return list(out), alpha, beta, gamma, rmse
+
+
+def multiplicative(x, m, fc, alpha=None, beta=None, gamma=None):
+
+    Y = _buffer(x)
 
     if (alpha == None or beta == None or gamma == None):
 
+        # The multiplicative recursion diverges where the level can drift
+        # through zero (alpha and beta near 0), and the corner start (0, 1, 0)
+        # leaves the optimizer stuck there. Start inside the box instead. The
+        # exact gradient is astronomically large next to that region and
+        # derails the line search, so finite differences are kept here.
         initial_values = array([0.3, 0.1, 0.1])
         boundaries = [(0, 1), (0, 1), (0, 1)]
-        type = 'additive'
+        type = 'multiplicative'
 
         parameters = fmin_l_bfgs_b(RMSE, x0=initial_values, args=(
             Y, type, m), bounds=boundaries, approx_grad=True)
         alpha, beta, gamma = parameters[0]
 
-    a = [sum(Y[0:m]) / float(m)]
-    b = [(sum(Y[m:2 * m]) - sum(Y[0:m])) / m ** 2]
-    s = [Y[i] - a[0] for i in range(m)]
-    y = [a[0] + b[0] + s[0]]
-    rmse = 0
+    a, b, s = _seasonal_start(Y, m, 'multiplicative')
+    out = _forecast_buffer(fc)
+    sse = _multiplicative_kernel(Y, s, a, b, alpha, beta, gamma, out)[0]
+    rmse = sqrt(sse / len(Y))
 
-    for i in range(len(Y) + fc):
+    return list(out), alpha, beta, gamma, rmse
 
-        if i == len(Y):
-            Y.append(a[-1] + b[-1] + s[-m])
 
-        a.append(alpha * (Y[i] - s[i]) + (1 - alpha) * (a[i] + b[i]))
-        b.append(beta * (a[i + 1] - a[i]) + (1 - beta) * b[i])
-        s.append(gamma * (Y[i] - a[i] - b[i]) + (1 - gamma) * s[i])
-        y.append(a[i + 1] + b[i + 1] + s[i + 1])
+# The functions below work on the terminal state of an additive model, a tuple
+# of (level, trend, season) where season holds the m seasonal components in
+# the order they will next be used. Smoothing the history once gives the state;
+# after that each new observation or forecast step costs O(1).
 
-    rmse = sqrt(
-        sum([(m - n) ** 2 for m, n in zip(Y[:-fc], y[:-fc - 1])]) / len(Y[:-fc]))
+def additive_state(x, m, alpha, beta, gamma):
 
-    return Y[-fc:], alpha, beta, gamma, rmse
+    Y = _buffer(x)
+    a, b, s = _seasonal_start(Y, m, 'additive')
+    sse, a, b = _additive_kernel(
+        Y, s, a, b, alpha, beta, gamma, _forecast_buffer(0))
+    k = len(Y) % m
+    s = [float(v) for v in s]
 
+    return float(a), float(b), s[k:] + s[:k]
 
-def multiplicative(x, m, fc, alpha=None, beta=None, gamma=None):
 
-    Y = x[:]
+def additive_update(state, x, alpha, beta, gamma):
 
-    if (alpha == None or beta == None or gamma == None):
+    Y = _buffer(x)
+    a, b, s = state
+    s = _buffer(s)
+    sse, a, b = _additive_kernel(
+        Y, s, a, b, alpha, beta, gamma, _forecast_buffer(0))
+    k = len(Y) % len(s)
+    s = [float(v) for v in s]
 
-        initial_values = array([0.0, 1.0, 0.0])
-        boundaries = [(0, 1), (0, 1), (0, 1)]
-        type = 'multiplicative'
+    return float(a), float(b), s[k:] + s[:k]
 
-        parameters = fmin_l_bfgs_b(RMSE, x0=initial_values, args=(
-            Y, type, m), bounds=boundaries, approx_grad=True)
-        alpha, beta, gamma = parameters[0]
 
-    a = [sum(Y[0:m]) / float(m)]
-    b = [(sum(Y[m:2 * m]) - sum(Y[0:m])) / m ** 2]
-    s = [Y[i] / a[0] for i in range(m)]
-    y = [(a[0] + b[0]) * s[0]]
-    rmse = 0
+def additive_forecast(state, fc, alpha, beta, gamma):
+
+    a, b, s = state
+    out = _forecast_buffer(fc)
+    _additive_kernel(_buffer([]), _buffer(s), a, b, alpha, beta, gamma, out)
+
+    return list(out)
+
+
+# The functions below fit the additive model to many series at once, e.g. one
+# model per mailbox or per label. X is a 2-D array with one series per row, all
+# of the same length. Each series keeps its own smoothing parameters; they are
+# optimized together by a BFGS method that is vectorized across series, so
+# every step of the optimizer is a single kernel call over the series that
+# have not converged yet. (One joint L-BFGS-B over all the
+# parameters would keep evaluating every series until the slowest converged.)
+#
+# With numba the batch kernels run the single series kernels over the rows of
+# X. Without numba the single series kernels are called once with a vector of
+# series in every state variable, so the recursion runs as numpy operations
+# across series (the seasonal buffers are then lists of vectors).
+
+@_kernel
+def _additive_batch_kernel(X, a, b, s, alpha, beta, gamma, out, result):
+
+    for j in range(X.shape[0]):
+
+        result[j, 0], result[j, 1], result[j, 2] = _additive_kernel(
+            X[j], s[j], a[j], b[j], alpha[j], beta[j], gamma[j], out[j])
+
+
+@_kernel
+def _additive_batch_gradient_kernel(X, rows, a, b, s, alpha, beta, gamma,
+                                    result):
+
+    m = s.shape[1]
+
+    for r in range(len(rows)):
+
+        j = rows[r]
+        sse, g_alpha, g_beta, g_gamma = _additive_gradient_kernel(
+            X[j], s[j].copy(), zeros(m), zeros(m), zeros(m), a[j], b[j],
+            alpha[r], beta[r], gamma[r])
+        result[r, 0] = sse
+        result[r, 1] = g_alpha
+        result[r, 2] = g_beta
+        result[r, 3] = g_gamma
+
+
+def _batch_start(X, m):
+
+    a = X[:, 0:m].sum(axis=1) / float(m)
+    b = (X[:, m:2 * m].sum(axis=1) - X[:, 0:m].sum(axis=1)) / m ** 2
+    s = X[:, 0:m] - a[:, newaxis]
+
+    return a, b, s
+
+
+def _batch_sse(X, start, alpha, beta, gamma, fc):
+
+    a, b, s = start
+    s = s.copy()
+    S = len(X)
+
+    if njit is None:
+        out = [None] * fc
+        season = list(s.T)
+        sse, a, b = _additive_kernel(
+            ascontiguousarray(X.T), season, a, b, alpha, beta, gamma, out)
+        s = array(season).T
+        out = array(out).reshape(fc, S).T
+        return sse, a, b, s, out
+
+    out = empty((S, fc), dtype=float64)
+    result = empty((S, 3), dtype=float64)
+    _additive_batch_kernel(X, a, b, s, alpha, beta, gamma, out, result)
+
+    return result[:, 0], result[:, 1], result[:, 2], s, out
+
+
+def _batch_rmse_gradient(X, start, rows, params):
+
+    a, b, s = start
+    alpha, beta, gamma = [ascontiguousarray(params[:, i]) for i in range(3)]
+
+    if njit is None:
+        k = len(rows)
+        ds_a, ds_b, ds_g = [[zeros(k) for i in range(s.shape[1])]
+                            for j in range(3)]
+        result = _additive_gradient_kernel(
+            ascontiguousarray(X[rows].T), list(s[rows].T), ds_a, ds_b, ds_g,
+            a[rows], b[rows], alpha, beta, gamma)
+        result = array(result).T
+    else:
+        result = empty((len(rows), 4), dtype=float64)
+        _additive_batch_gradient_kernel(
+            X, rows, a, b, s, alpha, beta, gamma, result)
+
+    n = X.shape[1]
+    rmse = vsqrt(result[:, 0] / n)
+
+    # d(rmse) = d(sse) / (2 * n * rmse)
+    gradient = result[:, 1:] / (2 * n * maximum(rmse, 1e-300))[:, newaxis]
+
+    return rmse, gradient
+
+
+def _fit_additive_batch(X, start, maxiter=200, pgtol=1e-5, factr=1e7):
+
+    # The parameters are optimized through the logistic function,
+    # x = 1 / (1 + exp(-z)), so the bounds (0, 1) need no active set and every
+    # series takes plain BFGS steps in z. The stopping rules are those of
+    # fmin_l_bfgs_b. A parameter going to 0 drives z far below 0, where
+    # exp(-z) overflows to inf and x is then exactly 0.
+    def evaluate(rows, z):
+        with errstate(over='ignore'):
+            x = 1 / (1 + exp(-z))
+        rmse, gradient = _batch_rmse_gradient(X, start, rows, x)
+        return x, rmse, gradient * x * (1 - x)
+
+    S = len(X)
+    rows = arange(S, dtype=int64)
+    x0 = array([0.3, 0.1, 0.1])
+    z = tile(log(x0 / (1 - x0)), (S, 1))
+    x, f, g = evaluate(rows, z)
+    evaluations = S
+    # Inverse Hessian approximation of each series, scaled by the curvature
+    # measured over its first step
+    H = tile(eye(3), (S, 1, 1))
+    scaled = zeros(S, dtype=bool)
+    ftol = factr * 2.2e-16
+
+    for iteration in range(maxiter):
+
+        rows = rows[abs(g[rows]).max(axis=1) > pgtol]
+
+        if len(rows) == 0:
+            break
+
+        zr, fr, gr, Hr = z[rows], f[rows], g[rows], H[rows]
+        d = -einsum('sij,sj->si', Hr, gr)
+        first = ~scaled[rows]
+        d[first] /= vsqrt((d[first] ** 2).sum(axis=1))[:, newaxis]
+        slope = (d * gr).sum(axis=1)
+
+        # Backtracking line search, evaluating only the series whose step has
+        # not been accepted yet. Each retry moves to the minimum of a quadratic
+        # through the failed trial.
+        step = ones(len(rows))
+        z_new, f_new, g_new, x_new = zr.copy(), fr.copy(), gr.copy(), x[rows]
+        moved = zeros(len(rows), dtype=bool)
+        pending = arange(len(rows))
+
+        for trial in range(30):
+
+            t = step[pending]
+            zt = zr[pending] + t[:, newaxis] * d[pending]
+            xt, ft, gt = evaluate(rows[pending], zt)
+            evaluations += len(pending)
+            accepted = ft <= fr[pending] + 1e-4 * t * slope[pending]
+
+            done = pending[accepted]
+            z_new[done], f_new[done], g_new[done], x_new[done] = \
+                zt[accepted], ft[accepted], gt[accepted], xt[accepted]
+            moved[done] = True
+
+            retry = ~accepted
+            pending, t, ft = pending[retry], t[retry], ft[retry]
+            s0 = slope[pending]
+            with errstate(divide='ignore', invalid='ignore'):
+                shrink = -s0 * t / (2 * (ft - fr[pending] - s0 * t))
+            step[pending] = t * clip(where(isfinite(shrink), shrink, 0.5),
+                                     0.1, 0.5)
+
+            if len(pending) == 0:
+                break
+
+        # BFGS update where the curvature is positive
+        sk = z_new - zr
+        yk = g_new - gr
+        sy = (sk * yk).sum(axis=1)
+        update = sy > 1e-10
+        first &= update
+        Hr[first] = eye(3) * (sy[first] /
+                              (yk[first] ** 2).sum(axis=1))[:, newaxis, newaxis]
+        scaled[rows[first]] = True
+
+        if update.any():
+            rho = (1 / sy[update])[:, newaxis, newaxis]
+            V = eye(3) - rho * einsum('si,sj->sij', sk[update], yk[update])
+            Hr[update] = einsum('sij,sjk,slk->sil', V, Hr[update], V) + \
+                rho * einsum('si,sj->sij', sk[update], sk[update])
+
+        z[rows], f[rows], g[rows], x[rows], H[rows] = \
+            z_new, f_new, g_new, x_new, Hr
+
+        # Series whose step failed or barely changed the RMSE are done
+        stalled = ~moved | ((fr - f_new) <=
+                            ftol * maximum(maximum(abs(fr), abs(f_new)), 1))
+        rows = rows[~stalled]
+
+        if len(rows) == 0:
+            break
+
+    return x, f, evaluations
+
+
+def additive_batch(X, m, fc, alpha=None, beta=None, gamma=None,
+                   chunk_size=1024):
+
+    X = ascontiguousarray(X, dtype=float64)
+    start = _batch_start(X, m)
+
+    if (alpha is None or beta is None or gamma is None):
+
+        # Fitted a chunk of series at a time to bound the optimizer's memory
+        parameters = empty((len(X), 3), dtype=float64)
+        for i in range(0, len(X), chunk_size):
+            chunk = slice(i, i + chunk_size)
+            parameters[chunk] = _fit_additive_batch(
+                X[chunk], [v[chunk] for v in start])[0]
+        alpha, beta, gamma = [parameters[:, i].copy() for i in range(3)]
+
+    else:
+
+        alpha, beta, gamma = [ones(len(X)) * p for p in (alpha, beta, gamma)]
+
+    sse, a, b, s, out = _batch_sse(X, start, alpha, beta, gamma, fc)
+    rmse = vsqrt(sse / X.shape[1])
 
-    for i in range(len(Y) + fc):
+    return out, alpha, beta, gamma, rmse
 
-        if i == len(Y):
-            Y.append((a[-1] + b[-1]) * s[-m])
 
-        a.append(alpha * (Y[i] / s[i]) + (1 - alpha) * (a[i] + b[i]))
-        b.append(beta * (a[i + 1] - a[i]) + (1 - beta) * b[i])
-        s.append(gamma * (Y[i] / (a[i] + b[i])) + (1 - gamma) * s[i])
-        y.append((a[i + 1] + b[i + 1]) * s[i + 1])
+def additive_batch_state(X, m, alpha, beta, gamma):
 
-    rmse = sqrt(
-        sum([(m - n) ** 2 for m, n in zip(Y[:-fc], y[:-fc - 1])]) / len(Y[:-fc]))
+    X = ascontiguousarray(X, dtype=float64)
+    alpha, beta, gamma = [ones(len(X)) * p for p in (alpha, beta, gamma)]
+    sse, a, b, s, out = _batch_sse(X, _batch_start(X, m), alpha, beta, gamma, 0)
+    k = X.shape[1] % m
+    s = s.tolist()
 
-    return Y[-fc:], alpha, beta, gamma, rmse
+    return [(float(a[j]), float(b[j]), s[j][k:] + s[j][:k])
+            for j in range(len(X))]
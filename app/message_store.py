@@ -0,0 +1,184 @@
+'''
+Message Store Module
+
+This module defines a local SQLite store for the messages collected from the
+GMAIL API. It keeps the few fields of each message that the forecasting models
+use, keyed by message id, so that messages are only ever downloaded once and
+the training data can be rebuilt offline.
+
+Author: Daryle J. Serrant
+'''
+
+import calendar
+import sqlite3
+from datetime import datetime
+from threading import Lock
+
+MESSAGE_STORE_FILE = '../data/messages.db'
+
+# SQLite allows at most 999 parameters in a statement
+MAX_PARAMETERS = 900
+
+COLUMNS = [('id', 'id'), ('threadId', 'thread_id'), ('internalDate', 'internal_date'),
+           ('labelIds', 'label_ids'), ('historyId', 'history_id'),
+           ('sizeEstimate', 'size_estimate')]
+
+
+def epoch_ms(date):
+    '''
+    Converts a time zone aware datetime to epoch milliseconds, the unit of the
+    internalDate of a message. Numbers are returned unchanged.
+    '''
+    if isinstance(date, datetime):
+        return calendar.timegm(date.utctimetuple()) * 1000 + date.microsecond // 1000
+    return date
+
+
+def _to_row(message):
+    '''
+    Converts a message retrieved from the GMAIL API into a table row
+    '''
+    labels = message.get('labelIds')
+    return (message['id'], message.get('threadId'), int(message['internalDate']),
+            ','.join(labels) if labels is not None else None,
+            message.get('historyId'), message.get('sizeEstimate'))
+
+
+def _to_message(row):
+    '''
+    Converts a table row back into a message as the GMAIL API returns it with the
+    minimal format
+    '''
+    message = {}
+    for (field, _), value in zip(COLUMNS, row):
+        if value is not None:
+            message[field] = value
+    message['internalDate'] = str(row[2])
+    if row[3] is not None:
+        message['labelIds'] = row[3].split(',') if row[3] else []
+    return message
+
+
+class MessageStore(object):
+    '''
+    A thread safe SQLite table of messages keyed by id and indexed by internal
+    date. Only the id, threadId, internalDate, labelIds, historyId and
+    sizeEstimate of each message are kept.
+    '''
+
+    def __init__(self, filepath=MESSAGE_STORE_FILE):
+        '''
+        Instantiate a new instance of the MessageStore class, creating the store if
+        it does not exist
+
+        Arguments:
+          filepath - Path to the SQLite database file
+        '''
+        self._lock = Lock()
+        self._db = sqlite3.connect(filepath, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS messages ('
+                         'id TEXT PRIMARY KEY, thread_id TEXT, '
+                         'internal_date INTEGER NOT NULL, label_ids TEXT, '
+                         'history_id TEXT, size_estimate INTEGER)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS messages_internal_date '
+                         'ON messages (internal_date)')
+        self._db.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+
+    def _select(self, ids, columns):
+        '''
+        Returns the rows of the stored messages among ids
+        '''
+        rows = []
+        with self._lock:
+            for i in range(0, len(ids), MAX_PARAMETERS):
+                chunk = ids[i:i + MAX_PARAMETERS]
+                rows.extend(self._db.execute(
+                    'SELECT {} FROM messages WHERE id IN ({})'.format(
+                        columns, ','.join('?' * len(chunk))), chunk))
+        return rows
+
+    def missing(self, ids):
+        '''
+        Returns the message ids that are not in the store
+
+        Arguments:
+          ids - A list of message ids
+
+        Returns:
+          The list of ids not stored, in the order given
+        '''
+        stored = set(row[0] for row in self._select(ids, 'id'))
+        return [msg_id for msg_id in ids if msg_id not in stored]
+
+    def get(self, ids):
+        '''
+        Returns the stored messages among ids
+
+        Arguments:
+          ids - A list of message ids
+
+        Returns:
+          A list of messages (defined as dictionaries), as the GMAIL API returns them
+          with the minimal format
+        '''
+        return [_to_message(row) for row in
+                self._select(ids, ', '.join(column for _, column in COLUMNS))]
+
+    def add(self, messages):
+        '''
+        Stores messages, replacing any stored message with the same id. Responses
+        that are not messages (such as those of failed calls) are skipped.
+
+        Arguments:
+          messages - A list of messages retrieved from the GMAIL API. Each needs at
+                     least an id and internalDate.
+        '''
+        rows = [_to_row(m) for m in messages
+                if type(m) == dict and 'id' in m and 'internalDate' in m]
+        with self._lock:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?)', rows)
+            self._db.commit()
+
+    def between(self, after=None, before=None, chunk_size=10000):
+        '''
+        Reads the messages that arrived within a time range, oldest first
+
+        Arguments:
+          after - If specified, only messages that arrived at or after this time
+                  (a time zone aware datetime or epoch milliseconds) are read
+          before - If specified, only messages that arrived before this time are
+                   read
+          chunk_size - The number of messages in each list yielded
+
+        Yields:
+          Lists of messages (defined as dictionaries)
+        '''
+        after = epoch_ms(after) if after is not None else -2 ** 63
+        before = epoch_ms(before) if before is not None else 2 ** 63 - 1
+        columns = ', '.join(column for _, column in COLUMNS)
+        # Pages through the internal_date index, resuming after the (date, id) of
+        # the last message read
+        last = (after, '')
+
+        while True:
+            with self._lock:
+                rows = self._db.execute(
+                    'SELECT {} FROM messages WHERE internal_date < ? AND '
+                    '(internal_date > ? OR (internal_date = ? AND id > ?)) '
+                    'ORDER BY internal_date, id LIMIT ?'.format(columns),
+                    (before, last[0], last[0], last[1], chunk_size)).fetchall()
+            if not rows:
+                return
+            yield [_to_message(row) for row in rows]
+            last = (rows[-1][2], rows[-1][0])
+
+    def close(self):
+        with self._lock:
+            self._db.close()
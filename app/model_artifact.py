@@ -0,0 +1,87 @@
+'''
+Model Artifact Module
+
+This module defines the compact file format the dashboard loads the forecast
+models from. An artifact holds only what forecasting needs (the model
+parameters, the terminal state of the model and the last timestamp it was
+trained on) rather than the training data and filter output that the full
+model pickles carry. Each file starts with a header holding a format version
+and a checksum of its contents, so that a truncated or corrupted artifact is
+rejected instead of being served.
+
+Author: Daryle J. Serrant
+'''
+
+import cPickle as pickle
+import hashlib
+import os
+import struct
+
+MAGIC = 'ETPM'
+
+# Incremented whenever the contents of an artifact change incompatibly
+FORMAT_VERSION = 1
+
+# Magic bytes, format version and the SHA-256 digest of the payload
+HEADER = struct.Struct('<4sH32s')
+
+
+class ArtifactError(ValueError):
+    '''
+    Raised when a file is not a model artifact this module can read
+    '''
+    pass
+
+
+def save_artifact(filepath, artifact):
+    '''
+    Writes a model artifact, replacing the previous file only once the new one
+    is complete
+
+    Arguments:
+      filepath - Path to the artifact file
+      artifact - A dictionary of the model parameters and state. Its values must
+                 be picklable.
+    '''
+    payload = pickle.dumps(artifact, pickle.HIGHEST_PROTOCOL)
+    tmp_filepath = filepath + '.tmp'
+    with open(tmp_filepath, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, hashlib.sha256(payload).digest()))
+        f.write(payload)
+    os.rename(tmp_filepath, filepath)
+
+
+def load_artifact(filepath):
+    '''
+    Reads a model artifact, verifying its format version and checksum
+
+    Arguments:
+      filepath - Path to the artifact file
+
+    Returns:
+      The dictionary saved in the artifact
+    '''
+    with open(filepath, 'rb') as f:
+        data = f.read()
+
+    if len(data) < HEADER.size:
+        raise ArtifactError('{} is truncated'.format(filepath))
+    magic, version, checksum = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ArtifactError('{} is not a model artifact'.format(filepath))
+    if version != FORMAT_VERSION:
+        raise ArtifactError('{} has format version {}, expected {}'.format(
+            filepath, version, FORMAT_VERSION))
+
+    payload = data[HEADER.size:]
+    if hashlib.sha256(payload).digest() != checksum:
+        raise ArtifactError('{} failed its checksum'.format(filepath))
+    return pickle.loads(payload)
+
+
+def is_artifact(filepath):
+    '''
+    Returns True if a file starts with the model artifact magic bytes
+    '''
+    with open(filepath, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
@@ -0,0 +1,138 @@
+'''
+Model Generations Module
+
+This module publishes the files of the forecast models as generations. The
+model scripts write every file of a generation to a temporary directory,
+flush it to disk and then atomically point the 'current' symlink of the models
+directory at it. Readers resolve the symlink once and load every model from
+the directory it points to, so they only ever see complete generations whose
+weekly and hourly models were built together.
+
+Author: Daryle J. Serrant
+'''
+
+import os
+import shutil
+import time
+from datetime import datetime
+
+MODELS_DIR = '../models'
+
+CURRENT = 'current'
+GENERATIONS_DIR = 'generations'
+
+# The number of published generations kept, the current one included
+KEEP_GENERATIONS = 3
+
+TMP_PREFIX = '.tmp-'
+
+# How long after its last change the temporary directory of a generation that
+# was never published is removed. Another model script may still be writing a
+# younger one.
+STALE_SECONDS = 6 * 60 * 60
+
+
+def _fsync(path):
+    '''
+    Flushes a file or directory to disk
+    '''
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def new_generation(models_dir=MODELS_DIR):
+    '''
+    Creates the temporary directory a new generation is written to
+
+    Arguments:
+      models_dir - The models directory
+
+    Returns:
+      The path to the temporary directory
+    '''
+    generations = os.path.join(models_dir, GENERATIONS_DIR)
+    if not os.path.isdir(generations):
+        os.makedirs(generations)
+    name = datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')
+    path = os.path.join(generations, TMP_PREFIX + name)
+    os.mkdir(path)
+    return path
+
+
+def publish_generation(path, models_dir=MODELS_DIR, keep=KEEP_GENERATIONS):
+    '''
+    Publishes a generation written to a directory returned by new_generation.
+    Its files are flushed to disk, it is moved into place and the current
+    symlink is switched to it in one step. Older generations beyond the most
+    recent keep are removed, as are temporary directories left unchanged for
+    STALE_SECONDS by runs that did not finish.
+
+    Arguments:
+      path - The temporary directory of the generation
+      models_dir - The models directory
+      keep - The number of generations to keep
+
+    Returns:
+      The path to the published generation
+    '''
+    for filename in os.listdir(path):
+        _fsync(os.path.join(path, filename))
+    _fsync(path)
+
+    generations = os.path.join(models_dir, GENERATIONS_DIR)
+    name = os.path.basename(path)[len(TMP_PREFIX):]
+    published = os.path.join(generations, name)
+    os.rename(path, published)
+    _fsync(generations)
+
+    # rename() replaces the symlink atomically; readers see the old or new one
+    link = os.path.join(models_dir, CURRENT)
+    os.symlink(os.path.join(GENERATIONS_DIR, name), link + '.tmp')
+    os.rename(link + '.tmp', link)
+    _fsync(models_dir)
+
+    # Generation names sort by the time they were created
+    names = sorted(n for n in os.listdir(generations) if not n.startswith(TMP_PREFIX))
+    for old in names[:-keep]:
+        shutil.rmtree(os.path.join(generations, old), ignore_errors=True)
+    # Temporary directories of runs that did not finish
+    now = time.time()
+    for name in os.listdir(generations):
+        if not name.startswith(TMP_PREFIX):
+            continue
+        stale = os.path.join(generations, name)
+        try:
+            if now - os.path.getmtime(stale) < STALE_SECONDS:
+                continue
+        except OSError:
+            # Published or removed meanwhile
+            continue
+        shutil.rmtree(stale, ignore_errors=True)
+
+    return published
+
+
+def current_generation(models_dir=MODELS_DIR):
+    '''
+    Returns the path to the current generation, or None if no generation has
+    been published
+    '''
+    link = os.path.join(models_dir, CURRENT)
+    if not os.path.islink(link):
+        return None
+    return os.path.join(models_dir, os.readlink(link))
+
+
+def current_file(filename, models_dir=MODELS_DIR):
+    '''
+    Returns the path to a model file of the current generation. Models saved
+    before generations were published are read from the models directory.
+
+    Arguments:
+      filename - The name of the model file, i.e. 'weekly_model.pkl'
+      models_dir - The models directory
+    '''
+    return os.path.join(current_generation(models_dir) or models_dir, filename)
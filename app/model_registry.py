@@ -0,0 +1,138 @@
+'''
+Model Registry Module
+
+This module defines a registry of the forecast models of many accounts. The
+models of an account are loaded the first time they are asked for and only the
+most recently used accounts are kept in memory, so an idle account costs
+nothing until it is used again. Concurrent requests for an account that is
+being loaded wait for that load instead of starting their own.
+
+Author: Daryle J. Serrant
+'''
+
+from collections import OrderedDict
+from threading import Lock, Event
+import time
+
+# The number of accounts whose models are kept in memory
+MAX_LOADED_ACCOUNTS = 64
+
+# How often the model files of a loaded account are checked for a newer version
+CHECK_SECONDS = 10
+
+
+class _Load(object):
+    '''
+    A load of the models of an account that may still be running
+    '''
+
+    def __init__(self):
+        self.ready = Event()
+        self.value = None
+        self.error = None
+
+
+class ModelRegistry(object):
+    '''
+    A thread safe, least recently used cache of the models of each account
+    '''
+
+    def __init__(self, version, load, capacity=MAX_LOADED_ACCOUNTS,
+                 check_seconds=CHECK_SECONDS):
+        '''
+        Instantiate a new instance of the ModelRegistry class
+
+        Arguments:
+          version - A function returning the current version of the model files
+                    of an account. It raises OSError if the account has no models.
+          load - A function loading the models of an account, called with the
+                 account and the version to load
+          capacity - The number of accounts whose models are kept in memory
+          check_seconds - How often the version of a loaded account is checked
+        '''
+        self.version = version
+        self.load = load
+        self.capacity = capacity
+        self.check_seconds = check_seconds
+        self._lock = Lock()
+        # account -> [models, time the version was last checked]
+        self._entries = OrderedDict()
+        # account -> _Load of the account being checked or loaded
+        self._loading = {}
+        self.loads = 0
+        self.evictions = 0
+
+    def get(self, account):
+        '''
+        Returns the models of an account, loading them if they are not in memory
+        or have been replaced since they were loaded
+
+        Arguments:
+          account - The account name
+
+        Returns:
+          The value returned by load
+
+        Raises:
+          KeyError if the account has no models
+        '''
+        now = time.time()
+        with self._lock:
+            entry = self._entries.pop(account, None)
+            if entry is not None:
+                self._entries[account] = entry
+                if now - entry[1] < self.check_seconds:
+                    return entry[0]
+            load = self._loading.get(account)
+            owner = load is None
+            if owner:
+                load = _Load()
+                self._loading[account] = load
+
+        if owner:
+            try:
+                load.value = self._load(account, entry, now)
+            except Exception as e:
+                load.error = e
+            finally:
+                with self._lock:
+                    del self._loading[account]
+                load.ready.set()
+        else:
+            load.ready.wait()
+
+        if load.error is not None:
+            raise load.error
+
+        return load.value
+
+    def _load(self, account, entry, now):
+        # Checks the version of an account's models and loads them if they are
+        # not in memory or have been replaced
+        try:
+            version = self.version(account)
+        except (OSError, IOError):
+            raise KeyError(account)
+
+        if entry is not None and entry[0][0] == version:
+            entry[1] = now
+            return entry[0]
+
+        models = self.load(account, version)
+        with self._lock:
+            self.loads += 1
+            self._entries.pop(account, None)
+            self._entries[account] = [models, now]
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return models
+
+    def stats(self):
+        '''
+        Returns a dictionary with the number of accounts loaded, loads and
+        evictions
+        '''
+        with self._lock:
+            return {'loaded': len(self._entries), 'capacity': self.capacity,
+                    'loads': self.loads, 'evictions': self.evictions}
@@ -0,0 +1,171 @@
+'''
+Model Watcher Module
+
+This module defines a watcher that reloads the forecast models when the model
+scripts write new ones. On Linux it is woken by inotify as soon as a model file
+is closed after writing or renamed into place; elsewhere it polls the
+modified dates of the files. Either way it waits for the files written
+together to settle before reloading, so that a reload never pairs a new model
+with an old one.
+
+Author: Daryle J. Serrant
+'''
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+from threading import Event, Thread
+
+# How often the model files are checked when inotify is unavailable, and as a
+# safety net when it is
+POLL_SECONDS = 60
+
+# How long no model file has to be written before the models are reloaded
+SETTLE_SECONDS = 2
+
+# inotify event masks (see inotify(7))
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+
+# wd, mask, cookie and the length of the name that follows
+EVENT_HEADER = struct.Struct('iIII')
+
+
+def _inotify(directory):
+    '''
+    Returns an inotify file descriptor watching the files closed after writing
+    and renamed into a directory, or None if inotify is unavailable
+    '''
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init()
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, os.path.abspath(directory),
+                              IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+def _event_names(data):
+    '''
+    Returns the file names of the events read from an inotify file descriptor
+    '''
+    names = []
+    offset = 0
+    while offset + EVENT_HEADER.size <= len(data):
+        wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+        offset += EVENT_HEADER.size
+        names.append(data[offset:offset + length].rstrip('\0'))
+        offset += length
+    return names
+
+
+class ModelWatcher(object):
+    '''
+    Calls a function with the new version of the model files whenever they
+    change. The function is called from the watcher thread, never from a
+    request.
+    '''
+
+    def __init__(self, directory, names, version, callback,
+                 poll_seconds=POLL_SECONDS, settle_seconds=SETTLE_SECONDS):
+        '''
+        Instantiate a new instance of the ModelWatcher class
+
+        Arguments:
+          directory - The directory holding the model files
+          names - The names of the model files in the directory
+          version - A function with no arguments that returns the current
+                    version of the model files, i.e. their modified dates
+          callback - A function called with the new version when the model
+                     files change. If it raises, the same version is retried on
+                     the next change or poll.
+          poll_seconds - How often the version is checked without an event
+          settle_seconds - How long the files must go unwritten before the
+                           callback is called
+        '''
+        self.directory = directory
+        self.names = set(names)
+        self.version = version
+        self.callback = callback
+        self.poll_seconds = poll_seconds
+        self.settle_seconds = settle_seconds
+        self.last_version = None
+        self.inotify = False
+        self._stopped = Event()
+        self._wakeup = None
+        self._thread = None
+
+    def start(self, version):
+        '''
+        Starts watching the model files in a daemon thread
+
+        Arguments:
+          version - The version of the models already loaded
+        '''
+        self.last_version = version
+        self._wakeup = os.pipe()
+        self._thread = Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        '''
+        Stops watching the model files and waits for the watcher thread to exit
+        '''
+        self._stopped.set()
+        if self._thread is not None:
+            os.write(self._wakeup[1], 'x')
+            self._thread.join()
+            os.close(self._wakeup[0])
+            os.close(self._wakeup[1])
+            self._thread = None
+
+    def check(self):
+        '''
+        Calls the callback if the version of the model files has changed
+        '''
+        try:
+            version = self.version()
+        except OSError:
+            # A model file is missing, e.g. between the model scripts' writes
+            return
+        if version == self.last_version:
+            return
+        try:
+            self.callback(version)
+        except Exception as e:
+            print "Failed to load the models ({}), keeping the current ones".format(e)
+            return
+        self.last_version = version
+
+    def _wait(self, fd, timeout):
+        '''
+        Waits up to timeout seconds for files to be written to the directory.
+        Returns the names of the files written, which is empty without inotify.
+        '''
+        fds = [self._wakeup[0]] if fd is None else [self._wakeup[0], fd]
+        if fd not in select.select(fds, [], [], timeout)[0]:
+            return set()
+        return set(_event_names(os.read(fd, 4096)))
+
+    def _run(self):
+        fd = _inotify(self.directory)
+        self.inotify = fd is not None
+        try:
+            while not self._stopped.is_set():
+                if self.names.intersection(self._wait(fd, self.poll_seconds)):
+                    # Wait for the other files written with this one
+                    while self._wait(fd, self.settle_seconds):
+                        pass
+                if not self._stopped.is_set():
+                    self.check()
+        finally:
+            if fd is not None:
+                os.close(fd)
@@ -3,94 +3,187 @@ Application Module
 
 This file defines the logic for the Flask application. This application
 displays a simple dashboard for presenting the results of the forecast
-and updates the models on a periodic basis.
+and reloads the models whenever the model scripts write new ones. The
+default account is served at the root; every other account under
+/<account>/, with its models loaded on demand.
 
 Author: Daryle J. Serrant
 '''
 
-from flask import Flask
-from flask_apscheduler import APScheduler
-from flask import render_template
+from flask import Flask, Response, request, abort
+from flask import render_template, jsonify
 from gmail_traffic_forecaster import DailyForecaster, HourlyForecaster
+from forecast_cache import ForecastCache
+from model_watcher import ModelWatcher
+from model_registry import ModelRegistry
+from accounts import Account, is_account_name
+import model_generations as mg
 from threading import Lock
 from datetime import datetime
 import pandas as pd
 import matplotlib.pyplot as plt
-import seaborn as sbn
 import numpy as np
 from StringIO import StringIO
 from matplotlib.dates import date2num
 import logging
 import math
+import hashlib
+import json
 
 import os
 
-class Config(object):
-    JOBS = [
-        {
-            'id': 'job_modelupdate',
-            'func': '__main__:check_for_updates',
-            'trigger': 'interval',
-            'seconds': 60
-        }
-    ]
+MODELS_DIR = '../models'
 
-    SCHEDULER_VIEWS_ENABLED = True
+# The models of the default account as (version, weekly model, hourly model,
+# forecast cache). Replaced as a whole on every reload so that a request never
+# pairs a forecast with the wrong model version. Readers take the tuple once and
+# use it throughout, so a reload never waits on them.
+models = (None, DailyForecaster(), HourlyForecaster(), ForecastCache())
 
-last_hr_mtime = 0
-last_wk_mtime = 0
-
-hourly_model_file = "../models/hourly_model.pkl"
-weekly_model_file = "../models/weekly_model.pkl"
-
-weekly_model = DailyForecaster()
-hourly_model = HourlyForecaster()
-
-mutex = Lock()
+chart_mutex = Lock()
 
 app = Flask(__name__)
-app.config.from_object(Config())
 app.debug = True
 
 HOURLY_FORECAST_STEPS = 24
 WEEKLY_FORECAST_STEPS = 7
 
+DEFAULT_STEPS = {'hourly': HOURLY_FORECAST_STEPS,
+                 'daily': WEEKLY_FORECAST_STEPS}
+API_MAX_STEPS = {'hourly': 7 * HOURLY_FORECAST_STEPS,
+                 'daily': 4 * WEEKLY_FORECAST_STEPS}
+
+
+def model_file(directory, name):
+    '''
+    Returns the path to the compact artifact of a model, or to its pickle if no
+    artifact has been written yet. Loading a pickle of the weekly model imports
+    statsmodels; loading an artifact does not.
+
+    Arguments:
+        directory - The directory holding the model files
+        name - 'weekly_model' or 'hourly_model'
+    '''
+    artifact = os.path.join(directory, name + '.art')
+    if os.path.exists(artifact):
+        return artifact
+    return os.path.join(directory, name + '.pkl')
 
-def check_for_updates():
+
+def model_version(models_dir=MODELS_DIR):
     '''
-    Periodically poll the model pickle files for updates by examining the modified
-    date field. Reload the models if the files have been updated.
+    Returns the directory of the current model generation (or the models
+    directory, for models saved before generations were published) and the
+    modified dates of the weekly and hourly model files in it
+
+    Arguments:
+        models_dir - The models directory of the account
     '''
-    global last_hr_mtime, last_wk_mtime
+    directory = mg.current_generation(models_dir) or models_dir
+    return (directory,
+            os.stat(model_file(directory, 'weekly_model')).st_mtime,
+            os.stat(model_file(directory, 'hourly_model')).st_mtime)
+
+
+def read_models(version):
+    '''
+    Loads the forecast models of a version from their files
+
+    Arguments:
+        version - The version of the models returned by model_version
+
+    Returns:
+        A models tuple with an empty forecast cache
+    '''
+    weekly_model = DailyForecaster()
+    weekly_model.load(model_file(version[0], 'weekly_model'))
+    hourly_model = HourlyForecaster()
+    hourly_model.load(model_file(version[0], 'hourly_model'))
+    return (version, weekly_model, hourly_model, ForecastCache(version))
+
+
+def load_models(version):
+    '''
+    Loads the forecast models of the default account from their files,
+    prepares their forecasts and charts, then publishes them. Requests keep
+    being served by the old models until the new ones are ready.
+
+    Arguments:
+        version - The version of the models returned by model_version
+    '''
+    global models
+
+    print "Reloading forecast models..."
+    snapshot = read_models(version)
+    prerender_charts(snapshot)
+    models = snapshot
 
-    hr_mtime = os.stat(hourly_model_file).st_mtime
-    wk_mtime = os.stat(weekly_model_file).st_mtime
 
-    if hr_mtime != last_hr_mtime and wk_mtime != last_wk_mtime:
-        # Wait for the lock to be available
-        mutex.acquire()
-        print "Reloading forecast models..."
-        weekly_model.load(weekly_model_file)
-        hourly_model.load(hourly_model_file)
-        mutex.release()
+# The models of the other accounts are loaded when first asked for; only the most
+# recently used accounts are kept in memory
+registry = ModelRegistry(lambda account: model_version(Account(account).models_dir),
+                         lambda account, version: read_models(version))
 
-        last_hr_mtime = hr_mtime
-        last_wk_mtime = wk_mtime
 
-scheduler = APScheduler()
+def account_models(account):
+    '''
+    Returns the models tuple of an account, aborting with a 404 response if the
+    account does not exist or has no models yet
+
+    Arguments:
+        account - The account name, None for the default account
+    '''
+    if account is None:
+        snapshot = models
+        if snapshot[0] is None:
+            abort(404)
+        return snapshot
+    if not is_account_name(account):
+        abort(404)
+    try:
+        return registry.get(account)
+    except KeyError:
+        abort(404)
+
+# A new generation is published by replacing the current symlink
+watcher = ModelWatcher(MODELS_DIR,
+                       [mg.CURRENT, 'weekly_model.art', 'hourly_model.art',
+                        'weekly_model.pkl', 'hourly_model.pkl'],
+                       model_version, load_models)
+
+
+def get_forecast(kind, steps, snapshot):
+    '''
+    Returns the forecast of the daily or hourly model, computing it only once
+    per model version.
+
+    Arguments:
+        kind - 'daily' or 'hourly'
+        steps - How many steps out to forecast
+        snapshot - The models tuple to forecast with
 
+    Returns:
+        A copy of the cached forecast series
+    '''
+    version, weekly_model, hourly_model, cache = snapshot
+    model = weekly_model if kind == 'daily' else hourly_model
+    fc = cache.get((version, kind, steps),
+                   lambda: model.forecast(steps))
+    return fc.copy()
 
+
+# The default account's dashboard is registered without defaults: a rule with
+# defaults is the canonical url of the others, so '/' would redirect to '/index'
 @app.route('/')
 @app.route('/index')
-def index():
-    if mutex.acquire(False):
-        return render_template('index.html',
-                               today_date=datetime.now().strftime('%A %B %d, %Y'))
-    else:
-        return "We are currently updating the forecast models. Please check back after a few minutes..."
+@app.route('/<account>/')
+def index(account=None):
+    account_models(account)
+    return render_template('index.html',
+                           today_date=datetime.now().strftime('%A %B %d, %Y'))
 
 
-def adjust_forecast(fc, which):
+def adjust_forecast(fc, which, snapshot):
     '''
     Combines the forecasts produced by the hourly model and
     the weekly model in an effort to produce a more
@@ -99,6 +192,7 @@ def adjust_forecast(fc, which):
     Arguments:
        daily_fc - The day forecast produced by the weekly model
        hourly_fc - The 24 hour forecast provided by the hourly model
+       snapshot - The models tuple the forecast was produced with
 
     Returns:
        The adjusted day and 24 hour forecast
@@ -106,11 +200,11 @@ def adjust_forecast(fc, which):
     ret_val = 2
 
     if which == 'hour':
-        daily_fc = weekly_model.forecast(1)[0]
+        daily_fc = get_forecast('daily', 1, snapshot)[0]
         hourly_fc = fc
         ret_val = 0
     elif which == 'day':
-        hourly_fc = hourly_model.forecast(HOURLY_FORECAST_STEPS)
+        hourly_fc = get_forecast('hourly', HOURLY_FORECAST_STEPS, snapshot)
         daily_fc = fc
         ret_val = 1
 
@@ -122,44 +216,227 @@ def adjust_forecast(fc, which):
     return (adj_houry_fc, adj_houry_fc.sum(), None)[ret_val]
 
 
-@app.route('/wkly_plt.png')
-def forecast_weekly_traffic():
+def adjusted_forecast(kind, steps, snapshot):
+    '''
+    Produces the forecast shown on the dashboard: today's hours (or today)
+    are adjusted with adjust_forecast, later steps are the model forecast.
+    '''
+    if kind == 'hourly':
+        fc = get_forecast('hourly', max(steps, HOURLY_FORECAST_STEPS), snapshot)
+        today = fc.index[:HOURLY_FORECAST_STEPS]
+        fc[today] = adjust_forecast(fc[today], 'hour', snapshot)
+    else:
+        fc = get_forecast('daily', max(steps, 1), snapshot)
+        fc[0] = adjust_forecast(fc[0], 'day', snapshot)
+    return fc[:steps]
+
+
+def get_adjusted_forecast(kind, steps, snapshot):
+    '''
+    Returns the adjusted daily or hourly forecast, computing it only once per
+    model version.
+
+    Arguments:
+        kind - 'daily' or 'hourly'
+        steps - How many steps out to forecast
+        snapshot - The models tuple to forecast with
+
+    Returns:
+        A copy of the cached forecast series
+    '''
+    fc = snapshot[3].get((snapshot[0], 'adjusted', kind, steps),
+                         lambda: adjusted_forecast(kind, steps, snapshot))
+    return fc.copy()
+
+
+def plot_weekly_forecast(snapshot):
     '''
     Creates a plot of the daily forecast for the next seven days
+
+    Returns:
+        The matplotlib figure
     '''
-    plt.figure()
-    fc = weekly_model.forecast(WEEKLY_FORECAST_STEPS)
-    adjusted_day = adjust_forecast(fc[0], 'day')
-    fc[0] = adjusted_day
+    fig = plt.figure()
+    fc = get_adjusted_forecast('daily', WEEKLY_FORECAST_STEPS, snapshot)
     x_pos = date2num(fc.index.tolist())
     y_pos = fc.tolist()
     labels = [dt.to_datetime().strftime('%a') for dt in fc.index]
     plt.bar(x_pos, y_pos, alpha=0.5, align='center', color="#ff3333")
     plt.xticks(x_pos, labels)
     plt.tick_params(axis='x', labelsize=10)
-    image = StringIO()
-    plt.savefig(image, transparent=True)
-    return image.getvalue(), 200, {'Content-Type': 'image/png'}
+    return fig
 
 
-@app.route('/hrly_plt.png')
-def forecast_hourly_traffic():
+def plot_hourly_forecast(snapshot):
     '''
     Creates a plot of the hourly forecast for today
+
+    Returns:
+        The matplotlib figure
     '''
-    fc = hourly_model.forecast(HOURLY_FORECAST_STEPS)
-    fc = adjust_forecast(fc, 'hour')
-    mutex.release()
-    plt.figure(figsize=(15, 6))
+    fc = get_adjusted_forecast('hourly', HOURLY_FORECAST_STEPS, snapshot)
+    fig = plt.figure(figsize=(15, 6))
     x_pos = date2num(fc.index.tolist())
     y_pos = fc.tolist()
     labels = [dt.to_datetime().strftime('%I%p') for dt in fc.index]
     plt.plot(x_pos, y_pos, color='#ff3333')
     plt.fill_between(x_pos, y_pos, alpha=0.6, color='#ff3333')
     plt.xticks(x_pos, labels)
+    return fig
+
+
+CHARTS = {'wkly_plt.png': plot_weekly_forecast,
+          'hrly_plt.png': plot_hourly_forecast}
+
+
+def render_chart(name, snapshot):
+    '''
+    Renders a dashboard chart to PNG. pyplot is not thread safe, so charts are
+    rendered one at a time, and every figure is closed once it is saved.
+
+    Arguments:
+        name - The chart file name, a key of CHARTS
+        snapshot - The models tuple to forecast with
+
+    Returns:
+        A tuple of the PNG bytes, their ETag and the time they were rendered
+    '''
     image = StringIO()
-    plt.savefig(image, transparent=True)
-    return image.getvalue(), 200, {'Content-Type': 'image/png'}
+    with chart_mutex:
+        # seaborn only styles the charts but imports statsmodels, so it is loaded
+        # by the first render rather than at startup
+        import seaborn
+        fig = CHARTS[name](snapshot)
+        try:
+            fig.savefig(image, transparent=True)
+        finally:
+            plt.close(fig)
+    data = image.getvalue()
+    return data, hashlib.md5(data).hexdigest(), datetime.utcnow()
+
+
+def get_chart(name, snapshot):
+    '''
+    Returns the rendered chart for a models tuple, rendering it only once per
+    model version.
+    '''
+    return snapshot[3].get((snapshot[0], 'chart', name),
+                           lambda: render_chart(name, snapshot))
+
+
+def prerender_charts(snapshot):
+    '''
+    Renders every chart and computes the default forecasts for a models tuple
+    so that the first requests after a reload do not wait on them.
+    '''
+    for kind in DEFAULT_STEPS:
+        get_adjusted_forecast(kind, DEFAULT_STEPS[kind], snapshot)
+    for name in CHARTS:
+        get_chart(name, snapshot)
+
+
+def chart_response(name, account):
+    '''
+    Serves a cached chart. Conditional requests that match its ETag or
+    modified date receive a 304 response without a body.
+    '''
+    data, etag, rendered = get_chart(name, account_models(account))
+    response = Response(data, mimetype='image/png')
+    response.set_etag(etag)
+    response.last_modified = rendered
+    response.cache_control.public = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+@app.route('/wkly_plt.png', defaults={'account': None})
+@app.route('/<account>/wkly_plt.png')
+def forecast_weekly_traffic(account):
+    '''
+    Serves a plot of the daily forecast for the next seven days
+    '''
+    return chart_response('wkly_plt.png', account)
+
+
+@app.route('/hrly_plt.png', defaults={'account': None})
+@app.route('/<account>/hrly_plt.png')
+def forecast_hourly_traffic(account):
+    '''
+    Serves a plot of the hourly forecast for today
+    '''
+    return chart_response('hrly_plt.png', account)
+
+
+def forecast_json(kind, steps, snapshot):
+    '''
+    Converts an adjusted forecast to a compact JSON serializable dictionary:
+    the first timestamp, the frequency and the list of counts.
+    '''
+    fc = get_adjusted_forecast(kind, steps, snapshot)
+    return {'start': fc.index[0].isoformat(),
+            'freq': 'H' if kind == 'hourly' else 'D',
+            'values': [int(v) for v in fc]}
+
+
+def forecast_steps(kind, arg='steps'):
+    '''
+    Reads the number of forecast steps from the query string, aborting with
+    a 400 response if it is not a whole number between 1 and API_MAX_STEPS.
+    '''
+    steps = request.args.get(arg, str(DEFAULT_STEPS[kind]))
+    if not steps.isdigit() or not 1 <= int(steps) <= API_MAX_STEPS[kind]:
+        abort(400, '{} must be a whole number between 1 and {}'.format(
+            arg, API_MAX_STEPS[kind]))
+    return int(steps)
+
+
+def json_response(data):
+    '''
+    Serializes data to compact JSON (jsonify indents its output in debug mode)
+    with an ETag so repeated requests can be answered with a 304 response.
+    '''
+    body = json.dumps(data, separators=(',', ':'), sort_keys=True)
+    response = Response(body, mimetype='application/json')
+    response.add_etag()
+    return response.make_conditional(request)
+
+
+@app.route('/api/forecast/<kind>', defaults={'account': None})
+@app.route('/<account>/api/forecast/<kind>')
+def forecast_api(kind, account):
+    '''
+    Returns the adjusted hourly or daily forecast as JSON. Accepts an
+    optional steps query parameter.
+    '''
+    if kind not in DEFAULT_STEPS:
+        abort(404)
+    return json_response(forecast_json(kind, forecast_steps(kind),
+                                       account_models(account)))
+
+
+@app.route('/api/forecast', defaults={'account': None})
+@app.route('/<account>/api/forecast')
+def forecasts_api(account):
+    '''
+    Returns the adjusted hourly and daily forecasts as JSON in a single
+    response. Accepts optional hourly_steps and daily_steps query parameters.
+    '''
+    snapshot = account_models(account)
+    return json_response(
+        {kind: forecast_json(kind, forecast_steps(kind, kind + '_steps'), snapshot)
+         for kind in DEFAULT_STEPS})
+
+
+@app.route('/cache_stats', defaults={'account': None})
+@app.route('/<account>/cache_stats')
+def cache_stats(account):
+    '''
+    Reports the forecast cache hit and miss counters of an account and the
+    state of the model registry
+    '''
+    stats = account_models(account)[3].stats()
+    stats['registry'] = registry.stats()
+    return jsonify(stats)
 
 if __name__ == "__main__":
     '''
@@ -171,13 +448,16 @@ if __name__ == "__main__":
     
     logging.basicConfig()
 
-    last_hr_mtime = os.stat(hourly_model_file).st_mtime
-    last_wk_mtime = os.stat(weekly_model_file).st_mtime
-
-    weekly_model.load(weekly_model_file)
-    hourly_model.load(hourly_model_file)
-
-    scheduler.init_app(app)
-    scheduler.start()
+    # A deployment serving only other accounts may have no default models
+    version = None
+    if os.path.isdir(MODELS_DIR):
+        try:
+            version = model_version()
+            load_models(version)
+        except OSError:
+            print "No models for the default account"
+
+    # Reloads the models as soon as the model scripts have written new ones
+    watcher.start(version)
 
     app.run(host='0.0.0.0', port=8000)
@@ -0,0 +1,89 @@
+'''
+Gmail Data Modeling Tests
+
+Checks that a weekly model updated without refitting keeps its parameters only
+when the series it was fit on is the start of the new series, and that hourly
+models built in a batch match those built one by one. Run with
+"python -m unittest discover" from the app directory.
+
+Author: Daryle J. Serrant
+'''
+
+import unittest
+import warnings
+import numpy as np
+import pandas as pd
+from statsmodels.tsa.statespace.sarimax import SARIMAX
+import gmail_data_modeling as gdm
+
+
+def daily_counts(start, days, seed=0):
+    '''
+    Returns a synthetic daily count series with a weekly season
+    '''
+    rng = np.random.RandomState(seed)
+    index = pd.date_range(start, periods=days, freq='D', tz='US/Pacific')
+    weekday = 20 + 10 * (index.dayofweek < 5)
+    return pd.Series((weekday + rng.poisson(5, days)).astype(float), index=index)
+
+
+def next_day(model):
+    '''
+    Returns the forecast of an hourly holt winters model for the next 24 hours
+    '''
+    alpha, beta, gamma, period, level, trend, season, end = model
+    return gdm.hw.additive_forecast((level, trend, season), 24, alpha, beta, gamma)
+
+
+class UpdateWeeklyModelTest(unittest.TestCase):
+
+    def setUp(self):
+        warnings.simplefilter('ignore')
+        self.ts = daily_counts('2016-01-01', 120)
+        self.results = SARIMAX(self.ts, order=(1, 0, 0)).fit(disp=False)
+
+    def tearDown(self):
+        warnings.resetwarnings()
+
+    def test_grown_series_keeps_parameters(self):
+        ts = daily_counts('2016-01-01', 127)
+        # The last day fit on was recounted
+        ts[self.ts.index[-1]] += 3
+        updated = gdm.update_weekly_arima_model(self.results, ts, refit=False)
+        self.assertFalse(hasattr(updated, 'mle_retvals'))
+        np.testing.assert_array_equal(updated.params, self.results.params)
+        self.assertEqual(len(updated.fittedvalues), len(ts))
+
+    def test_changed_history_is_refit(self):
+        # Series ending after the fitted series but not starting with its dates
+        for ts in [daily_counts('2016-01-08', 120),
+                   daily_counts('2016-01-01', 127).drop(self.ts.index[50])]:
+            updated = gdm.update_weekly_arima_model(self.results, ts, refit=False)
+            self.assertTrue(hasattr(updated, 'mle_retvals'))
+
+
+class HourlyModelsTest(unittest.TestCase):
+
+    def test_batch_matches_single(self):
+        index = pd.date_range('2016-01-01', periods=6 * 7 * 24, freq='H', tz='US/Pacific')
+        hours = np.arange(len(index))
+        rng = np.random.RandomState(0)
+        df = pd.DataFrame(dict(
+            (label, (4 + 3 * np.sin(2 * np.pi * hours / 24)).clip(0) + rng.poisson(2, len(index)))
+            for label in ['INBOX', 'UPDATES', 'SOCIAL']), index=index).astype(float)
+        df['CHAT'] = 0.0
+
+        models = gdm.build_hourly_holt_winters_models(df)
+        self.assertEqual(sorted(models), sorted(df.columns))
+        for label in ['INBOX', 'UPDATES', 'SOCIAL']:
+            single = gdm.build_hourly_holt_winters_model(df[label])
+            self.assertEqual(models[label][3], single[3])
+            self.assertEqual(models[label][7], single[7])
+            # Same model up to the optimizer's tolerance
+            np.testing.assert_allclose(
+                next_day(models[label]), next_day(single), rtol=1e-2)
+        self.assertEqual(models['CHAT'][4:7], (0.0, 0.0, [0.0] * 24))
+
+
+if __name__ == '__main__':
+    unittest.main()
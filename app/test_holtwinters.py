@@ -0,0 +1,169 @@
+'''
+Holt Winters Tests
+
+Checks the analytic RMSE gradients of the holtwinters kernels against central
+differences, that the fitters reach the RMSE of a finite difference fit and that
+the batch fitter matches the single series one, with numba and without.
+Run with "python -m unittest discover" from the app directory.
+
+Author: Daryle J. Serrant
+'''
+
+import imp
+import os
+import sys
+import unittest
+import warnings
+import numpy as np
+from scipy.optimize import fmin_l_bfgs_b
+import holtwinters as hw
+
+HOURLY_PERIOD = 24
+
+
+def load_without_numba():
+    '''
+    Returns a copy of the holtwinters module running its plain Python kernels
+    '''
+    numba = sys.modules.get('numba')
+    sys.modules['numba'] = None
+    try:
+        return imp.load_source('holtwinters_python',
+                               os.path.splitext(hw.__file__)[0] + '.py')
+    finally:
+        if numba is None:
+            del sys.modules['numba']
+        else:
+            sys.modules['numba'] = numba
+
+
+def hourly_counts(n, seed=0, offset=0):
+    '''
+    Returns a synthetic hourly count series with a daily season
+    '''
+    rng = np.random.RandomState(seed)
+    hours = np.arange(n)
+    level = 4 + 3 * np.sin(2 * np.pi * hours / HOURLY_PERIOD)
+    return (level.clip(0) + rng.poisson(2, n) + offset).astype(float)
+
+
+def central_difference(params, args, h=1e-6):
+    '''
+    Returns the central difference gradient of holtwinters.RMSE
+    '''
+    return np.array([(hw.RMSE(params + step, *args) - hw.RMSE(params - step, *args)) / (2 * h)
+                     for step in np.eye(len(params)) * h])
+
+
+class GradientTest(unittest.TestCase):
+
+    def check(self, args, points):
+        for params in points:
+            params = np.array(params)
+            rmse, gradient = hw.RMSE_gradient(params, *args)
+            self.assertAlmostEqual(rmse, hw.RMSE(params, *args), places=10)
+            np.testing.assert_allclose(gradient, central_difference(params, args),
+                                       rtol=1e-4, atol=1e-6)
+
+    def test_linear(self):
+        Y = hw._buffer(hourly_counts(500))
+        self.check((Y, 'linear'), [[0.3, 0.1], [0.05, 0.5], [0.9, 0.02]])
+
+    def test_additive(self):
+        Y = hw._buffer(hourly_counts(2000))
+        self.check((Y, 'additive', HOURLY_PERIOD),
+                   [[0.3, 0.1, 0.1], [0.01, 0.01, 0.1], [0.2, 0.05, 0.3]])
+
+    def test_multiplicative(self):
+        # Counts offset so the seasonal factors stay positive
+        Y = hw._buffer(hourly_counts(2000, offset=6))
+        self.check((Y, 'multiplicative', HOURLY_PERIOD),
+                   [[0.3, 0.1, 0.1], [0.01, 0.01, 0.1], [0.2, 0.05, 0.3]])
+
+
+class FitTest(unittest.TestCase):
+
+    def reference(self, x, type):
+        # A fit with finite difference gradients from inside the box
+        return fmin_l_bfgs_b(hw.RMSE, np.array([0.3, 0.1, 0.1]),
+                             args=(hw._buffer(x), type, HOURLY_PERIOD),
+                             bounds=[(0, 1)] * 3, approx_grad=True)[1]
+
+    def test_additive_fit(self):
+        for seed in range(3):
+            x = hourly_counts(2000, seed)
+            rmse = hw.additive(x, HOURLY_PERIOD, 24)[4]
+            self.assertLessEqual(rmse, self.reference(x, 'additive') * 1.001)
+
+    def test_multiplicative_fit(self):
+        # Series on which the fit started at (0, 1, 0) stalled on the boundary
+        for seed, offset in [(0, 1), (2, 1), (10, 6)]:
+            x = hourly_counts(4400, seed, offset)
+            rmse = hw.multiplicative(x, HOURLY_PERIOD, 24)[4]
+            self.assertTrue(np.isfinite(rmse))
+            self.assertLessEqual(rmse, self.reference(x, 'multiplicative') * 1.001)
+
+
+class BatchTest(unittest.TestCase):
+
+    hw = hw
+
+    def setUp(self):
+        n = 8 * 7 * HOURLY_PERIOD
+        trend = np.linspace(0.2, 3, n)
+        self.X = np.array([hourly_counts(n, seed) for seed in range(4)] +
+                          [hourly_counts(n, 7, 3) * trend])
+        # A series whose level stays put while the season moves
+        rng = np.random.RandomState(1)
+        self.X = np.vstack([self.X, np.tile(np.arange(HOURLY_PERIOD, dtype=float),
+                                            n // HOURLY_PERIOD) + rng.normal(0, 1, n)])
+
+    def test_fit_no_worse(self):
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            out, alpha, beta, gamma, rmse = self.hw.additive_batch(
+                self.X, HOURLY_PERIOD, 24)
+        self.assertEqual([str(w.message) for w in caught], [])
+        for j, x in enumerate(self.X):
+            single = self.hw.additive(x, HOURLY_PERIOD, 24)
+            # Both fitters stop where the RMSE barely changes between steps
+            self.assertLessEqual(rmse[j], single[4] * (1 + 1e-5))
+            self.assertTrue(0 <= min(alpha[j], beta[j], gamma[j]) and
+                            max(alpha[j], beta[j], gamma[j]) <= 1)
+
+    def test_state(self):
+        out, alpha, beta, gamma, rmse = self.hw.additive_batch(self.X, HOURLY_PERIOD, 0)
+        states = self.hw.additive_batch_state(self.X, HOURLY_PERIOD, alpha, beta, gamma)
+        for j, x in enumerate(self.X):
+            level, trend, season = self.hw.additive_state(
+                x, HOURLY_PERIOD, alpha[j], beta[j], gamma[j])
+            np.testing.assert_allclose(states[j][:2], (level, trend), rtol=1e-9, atol=1e-9)
+            np.testing.assert_allclose(states[j][2], season, rtol=1e-9, atol=1e-9)
+
+    def test_constant_rows(self):
+        n = self.X.shape[1]
+        X = np.vstack([self.X[:2], np.zeros(n), np.ones(n) * 5])
+        out, alpha, beta, gamma, rmse = self.hw.additive_batch(X, HOURLY_PERIOD, 24)
+        np.testing.assert_array_equal(out[2:], [[0.0] * 24, [5.0] * 24])
+        np.testing.assert_array_equal(rmse[2:], [0, 0])
+        # The constant rows are left at the start point and do not change the
+        # fit of the others
+        np.testing.assert_allclose(alpha[2:], [0.3, 0.3])
+        fitted = self.hw.additive_batch(X[:2], HOURLY_PERIOD, 24)
+        np.testing.assert_array_equal(out[:2], fitted[0])
+        np.testing.assert_array_equal(rmse[:2], fitted[4])
+        states = self.hw.additive_batch_state(X, HOURLY_PERIOD, alpha, beta, gamma)
+        self.assertEqual(states[2], (0.0, 0.0, [0.0] * HOURLY_PERIOD))
+        self.assertEqual(states[3], (5.0, 0.0, [0.0] * HOURLY_PERIOD))
+
+
+class PythonBatchTest(BatchTest):
+
+    hw = load_without_numba()
+
+    def test_python_kernels(self):
+        self.assertIsNone(self.hw.njit)
+
+
+if __name__ == '__main__':
+    unittest.main()
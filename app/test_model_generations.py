@@ -0,0 +1,57 @@
+'''
+Model Generations Tests
+
+Checks that publishing a generation removes the temporary directories of runs
+that did not finish but not one another model script is still writing. Run
+with "python -m unittest discover" from the app directory.
+
+Author: Daryle J. Serrant
+'''
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import model_generations as mg
+
+
+def write_generation(models_dir, content):
+    '''
+    Writes a generation with one model file to a new temporary directory
+    '''
+    path = mg.new_generation(models_dir)
+    with open(os.path.join(path, 'weekly_model.pkl'), 'w') as f:
+        f.write(content)
+    return path
+
+
+class PublishTest(unittest.TestCase):
+
+    def setUp(self):
+        self.models_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.models_dir)
+
+    def test_concurrent_run_keeps_its_directory(self):
+        # A run that did not finish long ago and one still writing its models
+        abandoned = write_generation(self.models_dir, 'abandoned')
+        old = time.time() - mg.STALE_SECONDS - 60
+        os.utime(abandoned, (old, old))
+        writing = write_generation(self.models_dir, 'writing')
+
+        mg.publish_generation(write_generation(self.models_dir, 'first'), self.models_dir)
+        self.assertFalse(os.path.exists(abandoned))
+        self.assertTrue(os.path.isdir(writing))
+
+        published = mg.publish_generation(writing, self.models_dir)
+        self.assertEqual(mg.current_generation(self.models_dir),
+                         os.path.join(self.models_dir, mg.GENERATIONS_DIR,
+                                      os.path.basename(published)))
+        with open(mg.current_file('weekly_model.pkl', self.models_dir)) as f:
+            self.assertEqual(f.read(), 'writing')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+'''
+Model Registry Tests
+
+Checks that concurrent first requests for an account load its models once and
+that a failed load reaches every waiting request. Run with
+"python -m unittest discover" from the app directory.
+
+Author: Daryle J. Serrant
+'''
+
+import threading
+import time
+import unittest
+from model_registry import ModelRegistry
+
+THREADS = 8
+
+
+class SingleFlightTest(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+
+    def load(self, account, version):
+        self.calls.append(account)
+        # Long enough for every request to arrive while the load is running
+        time.sleep(0.2)
+        return (version, account)
+
+    def request(self, registry, account):
+        results = []
+
+        def get():
+            try:
+                results.append(registry.get(account))
+            except KeyError as e:
+                results.append(e)
+        threads = [threading.Thread(target=get) for _ in range(THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_concurrent_requests_load_once(self):
+        registry = ModelRegistry(lambda account: 1, self.load)
+        results = self.request(registry, 'a@example.com')
+        self.assertEqual(results, [(1, 'a@example.com')] * THREADS)
+        self.assertEqual(self.calls, ['a@example.com'])
+        self.assertEqual(registry.stats()['loads'], 1)
+
+    def test_missing_account_raises_for_every_request(self):
+        def version(account):
+            time.sleep(0.2)
+            raise OSError(account)
+        registry = ModelRegistry(version, self.load)
+        results = self.request(registry, 'a@example.com')
+        self.assertEqual(len(results), THREADS)
+        self.assertTrue(all(isinstance(r, KeyError) for r in results))
+        # Failed loads are not remembered
+        self.assertRaises(KeyError, registry.get, 'a@example.com')
+        self.assertEqual(self.calls, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
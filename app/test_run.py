@@ -0,0 +1,32 @@
+'''
+Dashboard Tests
+
+Checks that the dashboard of the default account is served at '/' and
+'/index' rather than redirected. Run with "python -m unittest discover" from
+the app directory.
+
+Author: Daryle J. Serrant
+'''
+
+import unittest
+import run
+
+
+class IndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.models = run.models
+        # The index page only needs the default account to have models
+        run.models = ('version',) + run.models[1:]
+        self.client = run.app.test_client()
+
+    def tearDown(self):
+        run.models = self.models
+
+    def test_index_served(self):
+        for url in ['/', '/index']:
+            self.assertEqual(self.client.get(url).status_code, 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+'''
+Update Models Tests
+
+Checks that the training data counted by the model scripts only covers whole
+days: a sync in the middle of the day must not add the rest of the day as
+zeros or a partial count for today, and the messages held back must be counted
+by the next run. Run with "python -m unittest discover" from the app directory.
+
+Author: Daryle J. Serrant
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+import pandas as pd
+import create_initial_models
+import update_models
+from message_store import MessageStore, epoch_ms
+
+TIMEZONE = 'US/Pacific'
+
+# The sync runs mid-afternoon, the day after daylight saving time ended
+FIRST_DAY = pd.Timestamp('2016-11-04', tz=TIMEZONE)
+TODAY = pd.Timestamp('2016-11-07', tz=TIMEZONE)
+NOW = pd.Timestamp('2016-11-07 15:30', tz=TIMEZONE)
+
+
+def messages_between(start, end, minutes=20):
+    '''
+    Returns messages arriving every few minutes from start up to end. Every
+    tenth message is one sent by the user.
+    '''
+    dates = pd.date_range(start, end, freq='{}min'.format(minutes), closed='left')
+    return [{'id': '%x' % epoch_ms(date.to_pydatetime()),
+             'internalDate': str(epoch_ms(date.to_pydatetime())),
+             'labelIds': ['SENT'] if k % 10 == 0 else ['INBOX']}
+            for k, date in enumerate(dates)]
+
+
+def received(messages, start, end):
+    '''
+    Returns the number of messages not sent by the user that arrived from start up
+    to end
+    '''
+    start, end = epoch_ms(start.to_pydatetime()), epoch_ms(end.to_pydatetime())
+    return sum(1 for m in messages if 'SENT' not in m['labelIds'] and
+               start <= int(m['internalDate']) < end)
+
+
+class WholeDaysTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.store = MessageStore(os.path.join(self.data_dir, 'messages.db'))
+        self.messages = messages_between(FIRST_DAY, NOW)
+        self.store.add(self.messages)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.data_dir)
+
+    def check_whole_days(self, daily, hourly, start, end):
+        # Every day and hour from start up to end, and nothing after
+        self.assertEqual(daily.index.min(), start)
+        self.assertEqual(daily.index.max(), end - pd.DateOffset(days=1))
+        self.assertEqual(hourly.index.min(), start)
+        self.assertEqual(hourly.index.max(), end - pd.Timedelta(hours=1))
+        self.assertTrue((daily.index < end).all() and (hourly.index < end).all())
+        self.assertEqual(daily.sum(), received(self.messages, start, end))
+        # Messages arrive every hour, so no hour is a zero-filled gap
+        self.assertTrue((hourly > 0).all())
+
+    def test_update_counts_whole_days(self):
+        daily, hourly = update_models.count_stored_messages(self.store, FIRST_DAY, TODAY)
+        self.check_whole_days(daily, hourly, FIRST_DAY, TODAY)
+        # The day daylight saving time ended has 25 hours
+        self.assertEqual(len(hourly), 3 * 24 + 1)
+
+    def test_held_back_messages_counted_next_run(self):
+        daily, hourly = update_models.count_stored_messages(self.store, FIRST_DAY, TODAY)
+
+        # The rest of today arrives and the next run counts from the last updated day
+        tomorrow = TODAY + pd.DateOffset(days=1)
+        rest = messages_between(NOW, tomorrow)
+        self.store.add(rest)
+        self.messages.extend(rest)
+        last_updated = daily.index.max()
+        new_daily, new_hourly = update_models.count_stored_messages(
+            self.store, last_updated, tomorrow)
+        self.check_whole_days(new_daily, new_hourly, last_updated, tomorrow)
+
+        # Recounting the last updated day gives the same counts
+        self.assertEqual(new_daily[last_updated], daily[last_updated])
+        self.assertEqual(new_daily[TODAY], received(self.messages, TODAY, tomorrow))
+
+    def test_replayed_update_changes_nothing(self):
+        # A run that saved the sync cursor but failed before saving the training
+        # data is replayed: the same messages are synced and counted again
+        daily, hourly = update_models.count_stored_messages(self.store, FIRST_DAY, TODAY)
+        trained = update_models.merge_counts(daily[:1], daily)
+
+        self.store.add(self.messages)
+        replayed, _ = update_models.count_stored_messages(self.store, FIRST_DAY, TODAY)
+        merged = update_models.merge_counts(trained, replayed)
+        self.assertTrue(merged.equals(trained))
+
+    def test_initial_models_count_whole_days(self):
+        daily, hourly = create_initial_models.create_timeseries_data(
+            self.store.between(FIRST_DAY.to_pydatetime()), TODAY)
+        self.check_whole_days(daily, hourly, FIRST_DAY, TODAY)
+
+
+if __name__ == '__main__':
+    unittest.main()
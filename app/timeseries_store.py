@@ -0,0 +1,148 @@
+'''
+Time Series Store Module
+
+This module defines an append friendly store for the daily and hourly mail
+count series used to train the forecasting models. Each series is kept as one
+file per calendar month, so that a nightly update only rewrites the months it
+touched and a load only reads the months it asks for. The files are Parquet if
+pyarrow is installed and pickles otherwise.
+
+Author: Daryle J. Serrant
+'''
+
+import os
+import pandas as pd
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+DATA_DIR = '../data'
+
+# The time zone the months are partitioned in
+TIMEZONE = 'US/Pacific'
+
+EXTENSIONS = ['.parquet', '.pkl']
+
+
+def _read_partition(filepath):
+    '''
+    Reads a month partition as a time series
+    '''
+    if filepath.endswith('.parquet'):
+        df = pd.read_parquet(filepath, engine='pyarrow')
+    else:
+        df = pd.read_pickle(filepath)
+    return pd.Series(df['count'].values, index=pd.DatetimeIndex(df['date']))
+
+
+def _write_partition(ts, filepath):
+    '''
+    Writes a month partition, replacing the previous file only once the new one
+    is complete
+    '''
+    df = pd.DataFrame({'date': ts.index, 'count': ts.values})
+    tmp_filepath = filepath + '.tmp'
+    if filepath.endswith('.parquet'):
+        df.to_parquet(tmp_filepath, engine='pyarrow', compression='snappy')
+    else:
+        df.to_pickle(tmp_filepath)
+    # A crash leaves either the old or the new file, never a partial one
+    fd = os.open(tmp_filepath, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.rename(tmp_filepath, filepath)
+
+
+class TimeSeriesStore(object):
+    '''
+    A time series stored as one file per month in a directory named after the
+    series
+    '''
+
+    def __init__(self, name, data_dir=DATA_DIR, tz=TIMEZONE):
+        '''
+        Instantiate a new instance of the TimeSeriesStore class
+
+        Arguments:
+          name - The name of the series (i.e. 'daily_ts' or 'hourly_ts')
+          data_dir - The directory holding the series directories
+          tz - The time zone of the series and its months
+        '''
+        self.path = os.path.join(data_dir, name)
+        self.tz = tz
+        self.extension = '.parquet' if pyarrow is not None else '.pkl'
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    def months(self):
+        '''
+        Returns a dictionary mapping each stored month (as 'YYYY-MM') to its file
+        '''
+        partitions = {}
+        for filename in os.listdir(self.path):
+            month, extension = os.path.splitext(filename)
+            if extension in EXTENSIONS:
+                partitions[month] = os.path.join(self.path, filename)
+        return partitions
+
+    def _month(self, date):
+        return pd.Timestamp(date).tz_convert(self.tz).strftime('%Y-%m')
+
+    def load(self, start=None, end=None):
+        '''
+        Loads the series between two dates. Only the months overlapping the date
+        range are read.
+
+        Arguments:
+          start - If specified, only values at or after this time zone aware date
+                  are loaded
+          end - If specified, only values before this date are loaded
+
+        Returns:
+          A timeseries object, empty if nothing is stored in the date range
+        '''
+        months = self.months()
+        first = self._month(start) if start is not None else ''
+        last = self._month(end) if end is not None else '9999-99'
+        selected = [months[m] for m in sorted(months) if first <= m <= last]
+        if not selected:
+            return pd.Series([], index=pd.DatetimeIndex([], tz=self.tz))
+
+        ts = pd.concat([_read_partition(filepath) for filepath in selected])
+        ts = ts.tz_convert(self.tz).sort_index()
+        if start is not None:
+            ts = ts[ts.index >= start]
+        if end is not None:
+            ts = ts[ts.index < end]
+        return ts
+
+    def save(self, ts, since=None):
+        '''
+        Saves the values of a series from a date on. Only the months holding those
+        values are rewritten; values already stored in them are kept unless the
+        series replaces them.
+
+        Arguments:
+          ts - A time zone aware time series
+          since - If specified, only the values at or after this date are saved
+        '''
+        if since is not None:
+            ts = ts[ts.index >= since]
+        if not len(ts):
+            return
+
+        months = self.months()
+        local = ts.tz_convert(self.tz)
+        for month, values in local.groupby(local.index.strftime('%Y-%m')):
+            if month in months:
+                values = values.combine_first(
+                    _read_partition(months[month]).tz_convert(self.tz))
+            filepath = os.path.join(self.path, month + self.extension)
+            _write_partition(values, filepath)
+            # A partition written by the other format is superseded
+            if month in months and months[month] != filepath:
+                os.remove(months[month])
@@ -14,108 +14,289 @@ import gmail_data_collection as gdc
 
 import gmail_data_processing as gdp
 import gmail_data_modeling as gdm
+import gmail_traffic_forecaster as gtf
+import model_generations as mg
+from accounts import Account, list_accounts, ACCOUNTS_DIR
+from message_store import MessageStore
+from timeseries_store import TimeSeriesStore
 from datetime import datetime, timedelta
-from statsmodels.tsa.statespace.sarimax import SARIMAX
+from statsmodels.tsa.statespace.sarimax import SARIMAX, SARIMAXResults
 from dateutil.relativedelta import relativedelta
 import cPickle as pickle
 from pytz import timezone
+from multiprocessing import Pool
+import os
 import sys
+import time
+import traceback
 
+# The number of messages counted at a time while they are collected
+CHUNK_SIZE = 10000
 
-def create_timeseries_data(messages, last_updated):
+# The number of accounts updated at once
+MAX_WORKERS = 4
+
+
+def create_timeseries_data(chunks, start, end):
     '''
-    Create daily and hourly time series data using the email messages returned from the GMAIL API
+    Create daily and hourly time series data using the email messages returned from the GMAIL API.
+    Only whole days are counted: messages that arrived on or after the end (the
+    coming midnight of an update run) are left for the next run.
 
     Arguments:
-        messages - a list of messages (implemented as dicts)
+        chunks - an iterable of lists of messages (implemented as dicts) or of tuples
+                 returned by gdp.project_message
+        start - the local midnight to count messages from
+        end - the local midnight to count messages up to
     Returns:
-        A tuple containing the daily and hourly time series data
+        A tuple containing the daily and hourly time series data, covering every day
+        and hour from start up to end
     '''
-    df = gdp.messages_to_dataframe(messages)
+    # Counts all messages except google hangout chat messages and messages that
+    # were sent by the user
+    daily_counts, hourly_counts = gdp.aggregate_message_chunks(
+        chunks, exclude_labels=['SENT', 'CHAT'], before=end)
 
-    if df is None:
-        start = last_updated.replace(hour=0, minute=0, second=0, microsecond=0)
-        end = datetime.now(timezone('US/Pacific')).replace(hour=0,
-                                                           minute=0, second=0, microsecond=0)
-
-        hourly_index = pd.date_range(
-            start, end, freq='H', tz=timezone('US/Pacific'))
-        hourly_counts = pd.Series(0, index=hourly_index)
+    # The last hour before the end; midnight is never at a daylight saving change
+    last = end - pd.Timedelta(hours=1)
+    daily_index = gdp.daily_index(start, last)
+    hourly_index = gdp.hourly_index(start, last)
+    if start >= end:
+        daily_index, hourly_index = daily_index[:0], hourly_index[:0]
 
-        daily_index = pd.date_range(
-            start, end, freq='D', tz=timezone(timezone('US/Pacific')))
+    if daily_counts is None:
         daily_counts = pd.Series(0, index=daily_index)
+        hourly_counts = pd.Series(0, index=hourly_index)
     else:
-        # Remove all google hangout chat messages and messages that were sent
-        # by the user
-        if 'is_sent' in df:
-            df = df[~df['is_sent']]
-        if 'is_chat' in df:
-            df = df[~df['is_chat']]
+        daily_counts = daily_counts.reindex(daily_index, fill_value=0)
+        hourly_counts = hourly_counts.reindex(hourly_index, fill_value=0)
 
-        hourly_counts = gdp.aggregate_mail_counts(df, by='hour')
-        daily_counts = gdp.aggregate_mail_counts(df, by='day')
+    return (daily_counts, hourly_counts)
 
-        end = datetime.now(timezone('US/Pacific')).replace(hour=0,
-                                                           minute=0, second=0, microsecond=0)
-        hourly_counts = gdp.fill_dates_between(hourly_counts, end, by='hour')
-        daily_counts = gdp.fill_dates_between(daily_counts, end, by='day')
 
-    return (daily_counts, hourly_counts)
+def count_stored_messages(store, start, end):
+    '''
+    Counts the messages in a message store that arrived on the whole days between
+    two local midnights
+
+    Arguments:
+        store - the MessageStore to count
+        start - the local midnight to count messages from
+        end - the local midnight to count messages up to
+
+    Returns:
+        A tuple in the same format as create_timeseries_data
+    '''
+    return create_timeseries_data(
+        store.between(start, end, chunk_size=CHUNK_SIZE), start, end)
+
+
+def merge_counts(ts, counts):
+    '''
+    Merges new counts into a training series. The counts replace the values of
+    the periods they cover, so merging the same counts again changes nothing.
+
+    Arguments:
+        ts - the training time series
+        counts - a time series returned by create_timeseries_data
+
+    Returns:
+        The merged time series
+    '''
+    return counts.combine_first(ts).tz_convert('US/Pacific')
+
+
+def migrate_training_data(data_dir='../data'):
+    '''
+    Moves the training data saved as whole pickled series by earlier versions
+    into the time series stores
+    '''
+    for name in ['daily_ts', 'hourly_ts']:
+        store = TimeSeriesStore(name, data_dir)
+        filepath = os.path.join(data_dir, '{}.pkl'.format(name))
+        if not store.months() and os.path.exists(filepath):
+            print "Moving {} into the time series store...".format(filepath)
+            store.save(pd.read_pickle(filepath))
 
 
-def load_training_data():
+def load_training_data(data_dir='../data'):
     '''
     Load the time series data used to train the hourly and daily time series
-    models
+    models. The daily model is trained on all the daily data; only the months of
+    hourly data the hourly model is trained on are read, while the store keeps
+    the full hourly history.
 
-    ToDo: Modify this function to read the training data out of a database (i.e. MongoDb)
-    instead of pickle files. That way, we can keep all the data collected from gmail.
+    Arguments:
+        data_dir - the directory holding the time series stores
     '''
-    daily_ts = pd.read_pickle('../data/daily_ts.pkl')
-    hourly_ts = pd.read_pickle('../data/hourly_ts.pkl')
+    migrate_training_data(data_dir)
 
     today = datetime.now(timezone('US/Pacific')).replace(hour=0,
                                                          minute=0, second=0, microsecond=0)
 
-    # We only need hourly data that fall within the last 6 months. The author determined
-    # via experimentation that
-    # data within these ranges provides the best out of sample predictions.
-    hourly_ts = hourly_ts[hourly_ts.index > (today - relativedelta(months=+6))]
+    # We only need hourly data that fall within the last 6 months. The author
+    # determined via experimentation that data within this range provides the best
+    # out of sample predictions.
+    daily_ts = TimeSeriesStore('daily_ts', data_dir).load()
+    hourly_start = today - relativedelta(months=+6)
+    hourly_ts = TimeSeriesStore('hourly_ts', data_dir).load(start=hourly_start)
+    hourly_ts = hourly_ts[hourly_ts.index > hourly_start]
     return (daily_ts, hourly_ts)
 
 
-def save_training_data(daily_ts, hourly_ts):
-    # Save new data to files.
-    daily_ts.to_pickle('../data/daily_ts.pkl')
-    hourly_ts.to_pickle('../data/hourly_ts.pkl')
+def save_training_data(daily_ts, hourly_ts, since, data_dir='../data'):
+    '''
+    Saves the training data from a date on to the time series stores. Only the
+    months from that date on are rewritten.
+
+    Arguments:
+        daily_ts - the daily time series data
+        hourly_ts - the hourly time series data
+        since - a tuple of the dates the daily and hourly data changed from
+        data_dir - the directory holding the time series stores
+    '''
+    TimeSeriesStore('daily_ts', data_dir).save(daily_ts, since[0])
+    TimeSeriesStore('hourly_ts', data_dir).save(hourly_ts, since[1])
 
-if __name__ == "__main__":
-    weekly_model_file = '../models/weekly_model.pkl'
-    hourly_model_file = '../models/hourly_model.pkl'
 
-    daily_ts, hourly_ts = load_training_data()
+def update_models(account, refit=True):
+    '''
+    Updates the models of an account with the messages that arrived since the
+    last update and publishes them as a new generation
+
+    Arguments:
+        account - the Account to update
+        refit - If False, the models keep their parameters and are only updated
+                with the new data
+    '''
+    # The models of the current generation are updated
+    weekly_model_file = mg.current_file('weekly_model.pkl', account.models_dir)
+    hourly_model_file = mg.current_file('hourly_model.pkl', account.models_dir)
+
+    daily_ts, hourly_ts = load_training_data(account.data_dir)
 
     # Get the last date the models were updated
-    last_updated = daily_ts.index.max().to_datetime()
+    last_updated = daily_ts.index.max()
+    today = pd.Timestamp.now(tz='US/Pacific').normalize()
+
+    # Brings the message store up to date. Without stored messages to count, the
+    # mailbox is resynced from the last update.
+    store = MessageStore(account.message_store)
+    cursor = gdc.load_sync_cursor(account.sync_cursor) if len(store) else None
+    chunks, history_id, incremental = gdc.sync_messages(
+        last_updated.to_pydatetime(), cursor, gdp.project_message, stream=True,
+        chunk_size=CHUNK_SIZE, store=store, credentials=account.credentials)
+    for chunk in chunks:
+        pass
 
-    messages = gdc.collect_messages(
-        (datetime.now(timezone('US/Pacific')), last_updated))
+    # The synced messages are in the store, so the cursor is saved before the
+    # training data. The days since the last update are counted from the store,
+    # the last updated day included, and the counts replace those in the training
+    # set; a run that fails after saving the cursor counts the same stored
+    # messages again rather than adding them twice. Messages from today are left
+    # in the store until the day is over.
+    gdc.save_sync_cursor(history_id, account.sync_cursor)
+    daily_counts, hourly_counts = count_stored_messages(store, last_updated, today)
+    store.close()
 
-    daily_counts, hourly_counts = create_timeseries_data(
-        messages, last_updated)
+    # Only the new counts need saving
+    since = (last_updated, last_updated)
 
-    # Merge the latest timeseries data into the training set.
-    daily_ts = daily_ts.combine_first(daily_counts).tz_convert('US/Pacific')
-    hourly_ts = hourly_ts.combine_first(hourly_counts).tz_convert('US/Pacific')
+    daily_ts = merge_counts(daily_ts, daily_counts)
+    hourly_ts = merge_counts(hourly_ts, hourly_counts)
+
+    # Update models. The weekly model is refit starting from the parameters of the
+    # previous one. Without refitting the models keep their parameters: the weekly
+    # model only applies them to the new days and the hourly model only folds the
+    # new hours into its stored state instead of being refit on the whole history.
+    if os.path.exists(weekly_model_file):
+        weekly_model = gdm.update_weekly_arima_model(
+            SARIMAXResults.load(weekly_model_file), daily_ts, refit=refit)
+    else:
+        start = time.time()
+        weekly_model = gdm.build_weekly_arima_model(daily_ts)
+        gdm.report_arima_fit('Cold weekly', weekly_model, time.time() - start)
+
+    hourly_model = None
+    if not refit:
+        with open(hourly_model_file, 'r') as f:
+            hourly_model = pickle.load(f)
+        # Older pickles do not carry the model state and have to be rebuilt
+        if len(hourly_model) == 5:
+            hourly_model = None
+        else:
+            hourly_model = gdm.update_hourly_holt_winters_model(
+                hourly_model, hourly_ts)
+
+    if hourly_model is None:
+        hourly_model = gdm.build_hourly_holt_winters_model(hourly_ts)
+
+    # The models are published as a new generation; the dashboard never sees a
+    # partly written one or a weekly model from another run than the hourly one
+    generation = mg.new_generation(account.models_dir)
+    gtf.save_models(weekly_model, hourly_model, generation)
+    mg.publish_generation(generation, account.models_dir)
+
+    save_training_data(daily_ts, hourly_ts, since, account.data_dir)
 
-    # Update models
-    weekly_model = gdm.build_weekly_arima_model(daily_ts)
-    hourly_model = gdm.build_hourly_holt_winters_model(hourly_ts)
 
-    weekly_model.save(weekly_model_file)
+def _update_account(task):
+    '''
+    Updates the models of one account in a worker process. Returns the account
+    name and, if the update failed, the error.
+    '''
+    name, refit = task
+    try:
+        update_models(Account(name), refit)
+    except Exception:
+        return name, traceback.format_exc()
+    return name, None
+
 
-    with open(hourly_model_file, 'w') as f:
-        pickle.dump(hourly_model, f)
+if __name__ == "__main__":
+    # Usage: python update_models.py [--no-refit] [--workers=N] [--all | account ...]
+    # Without accounts, the models of the default account are updated. --all
+    # updates the accounts under the accounts directory, not the default account.
+    refit = '--no-refit' not in sys.argv
+    workers = MAX_WORKERS
+    names = []
+    all_accounts = False
+    for arg in sys.argv[1:]:
+        if arg.startswith('--workers='):
+            workers = int(arg.split('=', 1)[1])
+        elif arg == '--all':
+            all_accounts = True
+            names.extend(list_accounts())
+        elif not arg.startswith('--'):
+            names.append(arg)
+
+    if all_accounts and not names:
+        print "No accounts found under {}".format(ACCOUNTS_DIR)
+        sys.exit(1)
+    elif not names:
+        update_models(Account(), refit)
+    else:
+        # Each account is updated in its own process, so a failing or slow mailbox
+        # does not hold up the others
+        failed = []
+        start = time.time()
+        pool = Pool(min(workers, len(names)))
+        try:
+            for name, error in pool.imap_unordered(_update_account,
+                                                   [(name, refit) for name in names]):
+                if error is None:
+                    print "Updated the models of {}".format(name)
+                else:
+                    print "Failed to update the models of {}:\n{}".format(name, error)
+                    failed.append(name)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
 
-    save_training_data(daily_ts, hourly_ts)
+        print "Updated {} of {} accounts in {:.1f}s".format(
+            len(names) - len(failed), len(names), time.time() - start)
+        if failed:
+            sys.exit(1)